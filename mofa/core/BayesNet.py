@@ -15,12 +15,13 @@ import pandas as pd
 import sys
 
 from .variational_nodes import Variational_Node
+from . import checkpoint
 from .utils import corr, nans
 
 
 
 class BayesNet(object):
-    def __init__(self, dim, nodes, schedule, options, trial=1):
+    def __init__(self, dim, nodes, schedule, options, trial=1, rng=None):
         """ Initialisation of a Bayesian network
 
         PARAMETERS
@@ -35,6 +36,9 @@ class BayesNet(object):
             training options, such as maximum number of iterations, training options, etc.
         trial: int
             this is an auxiliary variable for parallelised running of multiple trials
+        rng: numpy.random.RandomState
+            random number generator of the stochastic steps of the training (dropping of factors and sampling of the minibatches).
+            If None, a copy of the current state of the global generator
         """
 
         self.dim = dim
@@ -43,9 +47,23 @@ class BayesNet(object):
         self.options = options
         self.trial = trial
 
+        # Each network draws from its own generator, so that trials trained in alternation give the same results as trials trained one after another
+        if rng is None:
+            rng = s.random.RandomState()
+            rng.set_state(s.random.get_state())
+        self.rng = rng
+
         # Training flag
         self.trained = False
 
+        # Number of iterations performed so far and convergence flag
+        self.iteration = 0
+        self.converged = False
+
+        # Indices of the factors removed in each call to removeFactors (to restore a checkpoint), and time of the last checkpoint
+        self.dropped_factors = []
+        self.checkpoint_time = time()
+
     def removeInactiveFactors(self, by_norm=None, by_pvar=None, by_cor=None, by_r2=None):
         """Method to remove inactive factors
 
@@ -77,47 +95,14 @@ class BayesNet(object):
 
         # Shut down based on coefficient of determination with respect to the residual variance
         #   Advantages: it takes into account both weights and latent variables, is based on how well the model fits the data
-        #   Disadvantages: slow, doesnt work with non-gaussian data
+        #   Disadvantages: doesnt work with non-gaussian data
         if by_r2 is not None:
-            Z = self.nodes['Z'].getExpectation()
-            Y = self.nodes["Y"].getExpectation()
-            W = self.nodes["SW"].getExpectation()
-            all_r2 = s.zeros([self.dim['M'], self.dim['K']])
-            for m in range(self.dim['M']):
-
-                # Fetch the mask for missing vlaues
-                mask = self.nodes["Y"].getNodes()[m].getMask()
-
-                # Calculate predictions and mask them
-                Ypred_m = s.dot(Z, W[m].T)
-                Ypred_m[mask] = 0.
-
-                # If there is an intercept term, regress it out, as it greatly decreases the fraction of variance explained by the other factors
-                # (THIS IS NOT IDEAL...)
-                if s.all(Z[:,0]==1.):
-                    Ypred_m_intercept = s.outer(Z[:,0], W[m][:,0].T) 
-                    Ypred_m_intercept[mask] = 0. # DO WE NEED TO DO THIS???
-                    Ypred_m -= Ypred_m_intercept
-                    all_r2[:,0] = 1.
-                    SS = (Ypred_m**2.).sum()
-                    for k in range(1,self.dim['K']):
-                        Ypred_mk = s.outer(Z[:,k], W[m][:,k])
-                        Ypred_mk[mask] = 0.
-                        Res = ((Ypred_m - Ypred_mk)**2.).sum()
-                        all_r2[m,k] = 1. - Res/SS
-                # No intercept term
-                else:
-                    SS = (Ypred_m**2.).sum()
-                    for k in range(self.dim['K']):
-                        Ypred_mk = s.outer(Z[:,k], W[m][:,k])
-                        Ypred_mk[mask] = 0.
-                        Res = ((Ypred_m - Ypred_mk)**2.).sum()
-                        all_r2[m,k] = 1. - Res/SS
+            all_r2 = self.calculateR2()
 
             if by_r2 is not None:
                 drop_dic["by_r2"] = s.where( (all_r2>by_r2).sum(axis=0) == 0)[0]
                 if len(drop_dic["by_r2"]) > 0:
-                    drop_dic["by_r2"] = [ s.random.choice(drop_dic["by_r2"]) ]
+                    drop_dic["by_r2"] = [ self.rng.choice(drop_dic["by_r2"]) ]
 
         # Shut down based on the proportion of residual variance explained by each factor
         # IT DOESNT WORK, THERE IS SOME ERROR TO BE FIXED
@@ -151,27 +136,118 @@ class BayesNet(object):
 
         # Drop the factors
         drop = s.unique(s.concatenate(list(drop_dic.values())))
+        self.removeFactors(drop)
+
+    def calculateR2(self):
+        """Method to calculate the coefficient of determination of each factor in each view, with respect to the prediction
+        of the model without the factor (used to drop factors, see removeInactiveFactors)
+
+        RETURNS
+        -------
+        all_r2: ndarray with dimensions (M,K)
+        """
+        # For each factor k, the r2 of the (masked) prediction P with respect to the prediction without the factor is
+        #   1 - |P - O*z_k*w_k'|^2 / |P|^2 = ( 2<P,O*z_k*w_k'> - |O*z_k*w_k'|^2 ) / |P|^2
+        # where O is the observation mask. For the fully observed features all terms follow from the Gram matrices Z'Z and W'W,
+        # only the features with missing values need their masked prediction.
+        Z = self.nodes['Z'].getExpectation()
+        W = self.nodes["SW"].getExpectation()
+        all_r2 = s.zeros([self.dim['M'], self.dim['K']])
+
+        # If there is an intercept term, regress it out, as it greatly decreases the fraction of variance explained by the other factors
+        # (THIS IS NOT IDEAL...)
+        intercept = s.all(Z[:,0]==1.)
+        Zpred = Z.copy()
+        if intercept:
+            Zpred[:,0] = 0.
+            all_r2[:,0] = 1.
+        ZZ, ZZpred, Z2 = s.dot(Z.T,Z), s.dot(Z.T,Zpred), s.square(Z)
+
+        for m in range(self.dim['M']):
+            Ynode = self.nodes["Y"].getNodes()[m]
+
+            # Fully observed features
+            Wc = W[m][Ynode.complete,:]
+            WW = s.dot(Wc.T,Wc)
+            SS = (s.dot(Zpred.T,Zpred)*WW).sum()
+            cross = (ZZpred*WW).sum(axis=1)
+            sq = s.diag(ZZ)*s.diag(WW)
+
+            # Features with missing values (their observation mask is streamed by blocks in out-of-core training)
+            if len(Ynode.incomplete) > 0:
+                if Ynode.out_of_core:
+                    blocks = ( (d,observed) for d, _, observed in Ynode.iterBlocks(Ynode.incomplete) )
+                else:
+                    blocks = [ (Ynode.incomplete, Ynode.observed) ]
+                for d, observed in blocks:
+                    Wi = W[m][d,:]
+                    Ypred = s.dot(Zpred, Wi.T) * observed
+                    SS += s.square(Ypred).sum()
+                    cross += (s.dot(Z.T,Ypred)*Wi.T).sum(axis=1)
+                    sq += (s.dot(Z2.T,observed)*s.square(Wi).T).sum(axis=1)
+
+            all_r2[m,int(intercept):] = ((2.*cross - sq)/SS)[int(intercept):]
+        return all_r2
+
+    def removeFactors(self, drop):
+        """Method to remove factors from all nodes
+
+        PARAMETERS
+        ----------
+        drop: ndarray
+            indices of the factors to remove
+        """
         if len(drop) > 0:
             for node in self.nodes.keys():
                 self.nodes[node].removeFactors(drop)
+            self.dropped_factors.append(drop)
         self.dim['K'] -= len(drop)
 
         if self.dim['K']==0:
             print("Shut down all components, no structure found in the data.")
             exit()
 
-        pass
+    def saveCheckpointIfDue(self):
+        """Method to save a checkpoint of the training every 'iter' iterations or 'time' seconds (see train_opts['checkpoint']),
+        or after a termination signal, in which case the training stops with checkpoint.TrainingInterrupted"""
+        opts = self.options.get('checkpoint',{})
+        if opts.get('file') is None: return
+        signum = checkpoint.receivedSignal()
+        due = signum is not None
+        due = due or (opts.get('iter') is not None and self.iteration % opts['iter'] == 0)
+        due = due or (opts.get('time') is not None and time()-self.checkpoint_time >= opts['time'])
+        if due:
+            filename = checkpoint.checkpointFile(opts['file'], self.trial, self.options.get('trials',1))
+            checkpoint.saveCheckpoint(self, filename)
+            self.checkpoint_time = time()
+            print("Saved a checkpoint of trial %d at iteration %d in %s" % (self.trial, self.iteration, filename))
+        if signum is not None:
+            raise checkpoint.TrainingInterrupted(signum)
+
+    def iterate(self, niter=None):
+        """Method to start iterating and updating the variables using the VB algorithm
 
-    def iterate(self):
-        """Method to start iterating and updating the variables using the VB algorithm"""
+        PARAMETERS
+        ----------
+        niter: int or None
+            maximum number of iterations to perform in this call. The training can be resumed by calling iterate() again,
+            which allows a scheduler to advance several trials in rounds. If None, iterate until convergence or until the maximum number of iterations
+        """
+
+        if self.trained: return
+        if self.options.get('svi',{}).get('batch_size') is not None:
+            return self.iterateStochastic(niter)
 
         # Define some variables to monitor training
-        nodes = list(self.getVariationalNodes().keys())
-        elbo = pd.DataFrame(data = nans((self.options['maxiter'], len(nodes)+1 )), columns = nodes+["total"] )
-        activeK = nans((self.options['maxiter']))
-        
+        if self.iteration == 0:
+            nodes = list(self.getVariationalNodes().keys())
+            self.elbo = pd.DataFrame(data = nans((self.options['maxiter'], len(nodes)+1 )), columns = nodes+["total"] )
+            self.activeK = nans((self.options['maxiter']))
+        elbo, activeK = self.elbo, self.activeK
+
         # Start training
-        for i in range(self.options['maxiter']):
+        last = self.options['maxiter'] if niter is None else min(self.iteration+niter, self.options['maxiter'])
+        for i in range(self.iteration, last):
             t = time();
 
             # Remove inactive latent variables
@@ -211,8 +287,8 @@ class BayesNet(object):
 
                     # Assess convergence
                     if (0 <= delta_elbo < self.options['tolerance']) and (not self.options['forceiter']):
-                        activeK = activeK[:(i+1)]
-                        elbo = elbo[:(i+1)]
+                        self.iteration = i+1
+                        self.converged = True
                         print ("Converged!\n")
                         break
 
@@ -222,11 +298,118 @@ class BayesNet(object):
 
             # Flush (we need this to print when running on the cluster)
             sys.stdout.flush()
+            self.iteration = i+1
+            self.saveCheckpointIfDue()
+
+        if self.converged or self.iteration >= self.options['maxiter']:
+            self.finishTraining()
+
+    def iterateStochastic(self, niter=None):
+        """Method to iterate using stochastic variational inference: in every iteration the latent variables are updated
+        for a minibatch of samples and the global nodes take a natural gradient step towards the update given by the minibatch,
+        with the sufficient statistics rescaled to the full number of samples. The step size follows the schedule
+        ro = learning_rate*(iteration+delay)^(-forget_rate).
+        The lower bound is estimated from the minibatch, so convergence is assessed on its moving average over 'window' estimates
+
+        PARAMETERS
+        ----------
+        niter: int or None
+            maximum number of iterations to perform in this call (see iterate)
+        """
+        opts = self.options['svi']
+        Ynodes = [ self.nodes["Y"].getNodes()[m] for m in self.nodes["Y"].activeM ]
+        if not all(hasattr(node,"setMinibatch") for node in Ynodes):
+            print("Error: stochastic variational inference is only implemented for gaussian likelihoods")
+            exit()
+        N = self.dim['N']
+        batch_size = min(N, max(1, int(round(opts['batch_size']*N))))
+
+        # Define some variables to monitor training
+        if self.iteration == 0:
+            nodes = list(self.getVariationalNodes().keys())
+            self.elbo = pd.DataFrame(data = nans((self.options['maxiter'], len(nodes)+1 )), columns = nodes+["total"] )
+            self.activeK = nans((self.options['maxiter']))
+            self.minibatches = []
+        elbo, activeK = self.elbo, self.activeK
+
+        # Start training
+        last = self.options['maxiter'] if niter is None else min(self.iteration+niter, self.options['maxiter'])
+        for i in range(self.iteration, last):
+            t = time();
+
+            # Remove inactive latent variables (using all samples)
+            if (i >= self.options["startdrop"]) and (i % self.options['freqdrop']) == 0:
+                if any(self.options['drop'].values()):
+                    self.setMinibatch(None)
+                    self.removeInactiveFactors(**self.options['drop'])
+                activeK[i] = self.dim["K"]
+
+            # Sample the minibatch: the samples are visited in random order, one epoch after another
+            if len(self.minibatches) == 0:
+                perm = self.rng.permutation(N)
+                self.minibatches = [ s.sort(perm[j:(j+batch_size)]) for j in range(0, N, batch_size) ]
+            self.setMinibatch(self.minibatches.pop(0))
+
+            # Update node by node: the latent variables get the optimal update, the global nodes a natural gradient step
+            ro = opts['learning_rate']*(i+1.+opts['delay'])**(-opts['forget_rate'])
+            for node in self.schedule:
+                if node=="Theta" and i<self.options['startSparsity']:
+                    continue
+                self.nodes[node].updateStochastic(ro)
 
-        # Finish by collecting the training statistics
+            # Estimate the Evidence Lower Bound from the minibatch. All samples are only restored when they are needed
+            # (dropping factors and at the end of the training), the next minibatch replaces this one otherwise
+            if (i+1) % self.options['elbofreq'] == 0:
+                elbo.iloc[i] = self.calculateELBO()
+                estimates = elbo["total"].values[:(i+1)]
+                estimates = estimates[~s.isnan(estimates)]
+                window = min(opts['window'], len(estimates))
+                smooth = estimates[-window:].mean()
+
+                # Check convergence using the moving average of the ELBO
+                if len(estimates) >= 2*opts['window']:
+                    delta_elbo = (smooth - estimates[-2*window:-window].mean())/window
+                    print("Trial %d, Iteration %d: time=%.2f ELBO=%.2f, smoothed ELBO=%.2f, deltaELBO=%.4f, ro=%.4f, Factors=%d" % (self.trial, i+1, time()-t, elbo.iloc[i]["total"], smooth, delta_elbo, ro, (~self.nodes["Z"].covariates).sum() ))
+                    if abs(delta_elbo) < self.options['tolerance'] and (not self.options['forceiter']):
+                        self.iteration = i+1
+                        self.converged = True
+                        print ("Converged!\n")
+                        break
+                else:
+                    print("Trial %d, Iteration %d: time=%.2f ELBO=%.2f, smoothed ELBO=%.2f, ro=%.4f, Factors=%d" % (self.trial, i+1, time()-t, elbo.iloc[i]["total"], smooth, ro, (~self.nodes["Z"].covariates).sum() ))
+                if self.options['verbose']:
+                    print("".join([ "%s=%.2f  " % (k,v) for k,v in elbo.iloc[i].drop("total").iteritems() ]) + "\n")
+            else:
+                print("Iteration %d: time=%.2f, K=%d\n" % (i+1,time()-t,self.dim["K"]))
+
+            sys.stdout.flush()
+            self.iteration = i+1
+            self.saveCheckpointIfDue()
+
+        self.setMinibatch(None)
+        if self.converged or self.iteration >= self.options['maxiter']:
+            self.finishTraining()
+
+    def setMinibatch(self, ix):
+        """Method to restrict the latent variables and the data to a minibatch of samples (stochastic variational inference),
+        or to use all samples if ix is None"""
+        self.nodes["Z"].setMinibatch(ix)
+        for m in self.nodes["Y"].activeM:
+            self.nodes["Y"].getNodes()[m].setMinibatch(ix)
+
+    def finishTraining(self):
+        """Method to stop the training and collect the training statistics of the iterations performed so far"""
+        activeK = self.activeK[:self.iteration]
+        elbo = self.elbo[:self.iteration]
         self.train_stats = { 'activeK':activeK, 'elbo':elbo["total"].values, 'elbo_terms':elbo.drop("total",1) }
         self.trained = True
 
+    def getCurrentELBO(self):
+        """Method to return the most recent value of the lower bound (nan if it has not been calculated yet)"""
+        elbo = self.elbo["total"].values[:self.iteration]
+        elbo = elbo[~s.isnan(elbo)]
+        return elbo[-1] if len(elbo) > 0 else s.nan
+
     def getParameters(self, *nodes):
         """Method to collect all parameters of a given set of nodes (all by default)
 
@@ -2,19 +2,26 @@
 Module with functions to initialise the model 
 
 runSingleTrial: run a single trial
-runMultipleTrial: run multiple trials, optionally in Parallel (not implemented)
+runMultipleTrial: run multiple trials, optionally in parallel using a pool of processes
 
 """
 
 import scipy as s
+import sys
 from sys import path
 from time import time,sleep
 import pandas as pd
 import numpy as np
-#from joblib import Parallel, delayed
+import numpy.ma as ma
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory, RawValue
 
 from .init_nodes import *
 from .BayesNet import BayesNet
+from . import checkpoint
+from .checkpoint import checkpointFile, loadCheckpoint, handleSignals, TrainingInterrupted
+from .model_writer import ModelWriter
 from .utils import *
 
 def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1, verbose=False):
@@ -27,6 +34,22 @@ def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1,
     trial:
     verbose:
 
+    PARAMETERS
+    ----------
+    """
+    net = buildTrial(data, data_opts, model_opts, train_opts, seed, trial)
+    trainModel(net, train_opts)
+    return net
+
+def buildTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1):
+    """Method to build the Bayesian network of a single trial of a MOFA model, ready to be trained
+    data: 
+    data_opts
+    model_opts:
+    train_opts:
+    seed:
+    trial:
+
     PARAMETERS
     ----------
     """
@@ -36,6 +59,10 @@ def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1,
         seed = int(round(time()*1000)%1e6)
     s.random.seed(seed)
 
+    # The initial values of the nodes and the covariates are modified in place during training,
+    # so each trial works on its own copy of the options
+    data_opts, model_opts = deepcopy(data_opts), deepcopy(model_opts)
+
 
     ###########################
     ## Perform sanity checks ##
@@ -53,6 +80,9 @@ def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1,
     # Mask
     if 'maskAtRandom' in data_opts or 'maskNSamples' in data_opts:
         if any(data_opts['maskAtRandom']) or any(data_opts['maskNSamples']):
+            if any(isinstance(view, DiskView) for view in data):
+                print("Error: masking is not implemented for out-of-core training")
+                exit()
             data = maskData(data, data_opts)
 
     ######################
@@ -66,6 +96,11 @@ def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1,
     print ("\n")
     sleep(1)
 
+    # Cast the data to the working floating point precision
+    dtype = train_opts.get('dtype')
+    if dtype is not None:
+        data = [ data[m].astype(dtype, copy=False) for m in range(len(data)) ]
+
     # Define dimensionalities
     M = len(data)
     N = data[0].shape[0]
@@ -81,12 +116,14 @@ def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1,
     # Latent variables
     init.initZ(pmean=model_opts["priorZ"]["mean"], pvar=model_opts["priorZ"]["var"],
                qmean=model_opts["initZ"]["mean"], qvar=model_opts["initZ"]["var"], qE=model_opts["initZ"]["E"], qE2=model_opts["initZ"]["E2"],
-               covariates=data_opts['covariates'], scale_covariates=data_opts['scale_covariates'])
+               covariates=data_opts['covariates'], scale_covariates=data_opts['scale_covariates'],
+               vectorised=train_opts.get('vectorised',True))
 
     # Sparse weights
     init.initSW(ptheta=model_opts["priorSW"]["Theta"], pmean_S0=model_opts["priorSW"]["mean_S0"], pvar_S0=model_opts["priorSW"]["var_S0"], pmean_S1=model_opts["priorSW"]["mean_S1"], pvar_S1=model_opts["priorSW"]["var_S1"],
                 qtheta=model_opts["initSW"]["Theta"], qmean_S0=model_opts["initSW"]["mean_S0"], qvar_S0=model_opts["initSW"]["var_S0"], qmean_S1=model_opts["initSW"]["mean_S1"], qvar_S1=model_opts["initSW"]["var_S1"],
-                qEW_S0=model_opts["initSW"]["EW_S0"], qEW_S1=model_opts["initSW"]["EW_S1"], qES=model_opts["initSW"]["ES"])
+                qEW_S0=model_opts["initSW"]["EW_S0"], qEW_S1=model_opts["initSW"]["EW_S1"], qES=model_opts["initSW"]["ES"],
+                vectorised=train_opts.get('vectorised',True))
 
     # ARD on weights
     init.initAlphaW_mk(pa=model_opts["priorAlphaW"]['a'], pb=model_opts["priorAlphaW"]['b'],
@@ -129,12 +166,27 @@ def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1,
     nodes["Y"].addMarkovBlanket(Z=nodes["Z"], SW=nodes["SW"], Tau=nodes["Tau"])
     nodes["Tau"].addMarkovBlanket(Z=nodes["Z"], SW=nodes["SW"], Y=nodes["Y"])
 
+    # Keep the moments and the parameters of all nodes in the working floating point precision
+    if dtype is not None:
+        for node in nodes.values(): node.setDtype(dtype)
+
     ##################################
     ## Add the nodes to the network ##
     ##################################
 
-    # Initialise Bayesian Network
-    net = BayesNet(dim=dim, trial=trial, schedule=model_opts["schedule"], nodes=init.getNodes(), options=train_opts)
+    # Initialise Bayesian Network, whose generator continues the stream of the seed of the trial after the initialisation
+    rng = s.random.RandomState(); rng.set_state(s.random.get_state())
+    net = BayesNet(dim=dim, trial=trial, schedule=model_opts["schedule"], nodes=init.getNodes(), options=train_opts, rng=rng)
+
+    # Continue the training from the last checkpoint of the trial
+    opts = train_opts.get('checkpoint',{})
+    if opts.get('resume') and opts.get('file') is not None:
+        filename = checkpointFile(opts['file'], trial, train_opts.get('trials',1))
+        if os.path.isfile(filename):
+            loadCheckpoint(net, filename)
+            print("Resuming trial %d from iteration %d of the checkpoint %s" % (trial, net.iteration, filename))
+        else:
+            print("No checkpoint found in %s, trial %d starts from the beginning" % (filename, trial))
 
     ####################
     ## Start training ##
@@ -146,11 +198,225 @@ def runSingleTrial(data, data_opts, model_opts, train_opts, seed=None, trial=1,
     print ("#"*45)
     print ("\n")
     sleep(1)
-    
-    net.iterate()
 
     return net
 
+def trainModel(net, train_opts, niter=None):
+    """Method to train (or resume the training of) a MOFA model
+
+    PARAMETERS
+    ----------
+    net: BayesNet
+    train_opts: dict
+    niter: int or None
+        maximum number of iterations to perform. If None, train until convergence or until the maximum number of iterations
+    """
+
+    # Update the views of the nodes concurrently: given Z, the views of SW, AlphaW, Tau and Y are independent.
+    # The BLAS calls release the GIL, so a thread pool is enough to overlap the views
+    # A termination signal stops the training with a last checkpoint, if checkpoints are enabled
+    checkpoints = train_opts.get('checkpoint',{}).get('file') is not None
+    threads = train_opts.get('threads', 1)
+    if threads > 1:
+        executor = ThreadPoolExecutor(max_workers=threads)
+        for node in ["SW","AlphaW","Tau","Y"]: net.nodes[node].setExecutor(executor)
+        try:
+            with limitBLASThreads(train_opts.get('blasThreads')), handleSignals(checkpoints):
+                net.iterate(niter)
+        finally:
+            for node in ["SW","AlphaW","Tau","Y"]: net.nodes[node].setExecutor(None)
+            executor.shutdown()
+    else:
+        with limitBLASThreads(train_opts.get('blasThreads')), handleSignals(checkpoints):
+            net.iterate(niter)
+
+def runSuccessiveHalving(data, data_opts, model_opts, train_opts, seeds, callback=None):
+    """Method to run several trials in rounds, terminating early the trials whose lower bound is dominated (successive halving).
+    All trials are trained for a grace period, then every round the trials that are still running are ranked
+    (together with the converged ones) by their current lower bound and only the best fraction keeps training.
+    The terminated trials keep the training statistics of the iterations performed so far.
+
+    PARAMETERS
+    ----------
+    data: list of pandas.DataFrame
+    data_opts:
+    model_opts:
+    train_opts: dict
+        train_opts['halving'] defines the fraction of trials to keep after each round ('keep'),
+        the number of iterations before the first round ('grace') and the number of iterations per round ('round')
+    seeds: list
+        seed of each trial
+    callback: function
+        called with each trained model as soon as it is terminated, and with the other models at the end.
+        The models passed to the callback are not returned
+    """
+    opts = train_opts['halving']
+    nets = [ buildTrial(list(data), data_opts, model_opts, train_opts, seeds[t-1], t) for t in range(1,len(seeds)+1) ]
+
+    # Trials that compete for the next round, either still training or converged
+    competing = list(nets)
+    niter = opts['grace']
+    while any(not net.trained for net in competing):
+        for net in competing:
+            if not net.trained: trainModel(net, train_opts, niter)
+        niter = opts['round']
+
+        # Rank the trials by their current lower bound (skip the round if it has not been calculated for all of them)
+        elbo = s.array([ net.getCurrentELBO() for net in competing ])
+        if s.isnan(elbo).any(): continue
+        nkeep = max(1, int(s.ceil(opts['keep']*len(competing))))
+        ranked = [ competing[i] for i in s.argsort(-elbo) ]
+        for net in ranked[nkeep:]:
+            if not net.trained:
+                print("Trial %d terminated at iteration %d, its lower bound (%.2f) is dominated by the other trials\n" % (net.trial, net.iteration, net.getCurrentELBO()))
+                net.finishTraining()
+                if callback is not None:
+                    nets.remove(net)
+                    callback(net)
+        competing = ranked[:nkeep]
+
+    if callback is not None:
+        while len(nets) > 0: callback(nets.pop(0))
+    return nets
+
+def trialSeeds(seed, ntrials):
+    """Method to derive an independent and reproducible seed for each trial from a single seed.
+    The first trial uses the seed itself, so that a single trial can be reproduced as before.
+
+    PARAMETERS
+    ----------
+    seed: int or None
+        base seed. If None or 0, the base seed is defined from the current time
+    ntrials: int
+        number of trials
+    """
+    if seed is None or seed==0:
+        seed = int(round(time()*1000)%1e6)
+    return [seed] + [ int(np.random.SeedSequence((seed,t)).generate_state(1)[0]) for t in range(2,ntrials+1) ]
+
+# Views of the input data in shared memory, attached once by every worker process
+_shared_data = None
+_shared_memory = None
+
+def _initWorker(received):
+    """Method to pass on to a worker process the termination signals received by the parent process (see checkpoint.receivedSignal)"""
+    checkpoint.shared_signal = received
+
+def _attachSharedArray(name, shape, dtype, order):
+    """Method to attach a read-only array from shared memory in a worker process"""
+    shm = shared_memory.SharedMemory(name=name)
+    values = np.ndarray(shape, dtype=dtype, buffer=shm.buf, order=order)
+    values.flags.writeable = False
+    _shared_memory.append(shm)
+    return values
+
+def _attachSharedData(specs, received):
+    """Method to attach the input data from shared memory in a worker process (read-only, no copies).
+    Each view is a masked array of the zero-filled data and the observation mask, which the nodes use as they are
+
+    PARAMETERS
+    ----------
+    specs: list
+        name of the shared memory block of the data and of the mask (None if there are no missing values), shape,
+        dtype and memory layout of each view
+    received: multiprocessing.RawValue
+        termination signal received by the parent process
+    """
+    global _shared_data, _shared_memory
+    _initWorker(received)
+    _shared_data, _shared_memory = [], []
+    for name, mask_name, shape, dtype, order in specs:
+        values = _attachSharedArray(name, shape, dtype, order)
+        mask = ma.nomask if mask_name is None else _attachSharedArray(mask_name, shape, bool, order)
+        _shared_data.append(ma.array(values, mask=mask, copy=False))
+
+def _runSharedTrial(data_opts, model_opts, train_opts, seed, trial):
+    """Method to run a single trial in a worker process, using the data in shared memory"""
+    return runSingleTrial(list(_shared_data), data_opts, model_opts, train_opts, seed, trial)
+
+def runParallelTrials(data, data_opts, model_opts, train_opts, seeds, cores, callback=None):
+    """Method to run several trials in a pool of processes.
+    The input matrices are copied once to shared memory, with the missing values set to zero and their mask shared
+    as well, and accessed read-only by the workers.
+
+    PARAMETERS
+    ----------
+    data: list of pandas.DataFrame
+        input data for each view
+    data_opts:
+    model_opts:
+    train_opts:
+    seeds: list
+        seed of each trial
+    cores: int
+        number of worker processes
+    callback: function
+        called with each trained model as soon as its trial finishes. The models passed to the callback are not returned
+        (nor kept in memory)
+    """
+    trials = range(1,len(seeds)+1)
+
+    # A termination signal received by this process is passed on to the workers, which save a checkpoint and raise
+    # TrainingInterrupted: the trials that have not started are cancelled and the running ones are waited for
+    received = RawValue('i', 0)
+    checkpoint.shared_signal = received
+
+    def collect(futures):
+        pending = set(futures)
+        try:
+            if callback is None:
+                return [ future.result() for future in futures ]
+            del futures[:]
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done: callback(future.result())
+                del done, future
+            return []
+        except TrainingInterrupted:
+            for future in pending: future.cancel()
+            wait(pending)
+            raise
+
+    blocks = []
+    try:
+        # Views on disk (out-of-core training) are opened by every worker
+        if any(isinstance(view, DiskView) for view in data):
+            with ProcessPoolExecutor(max_workers=min(cores,len(seeds)), initializer=_initWorker, initargs=(received,)) as executor:
+                futures = [ executor.submit(runSingleTrial, list(data), data_opts, model_opts, train_opts, seeds[t-1], t) for t in trials ]
+                return collect(futures)
+
+        specs = []
+        def share(values, order):
+            shm = shared_memory.SharedMemory(create=True, size=max(1,values.nbytes))
+            blocks.append(shm)
+            shared = np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf, order=order)
+            shared[:] = values
+            return shm.name, shared
+
+        for m in range(len(data)):
+            # Keep the memory layout of the input matrices, so that the results do not depend on the backend
+            values = data[m].values
+            order = 'F' if values.flags.f_contiguous else 'C'
+            name, shared = share(values, order)
+
+            # The missing values are set to zero once here, so that the workers do not keep a zero-filled copy of the view
+            mask = np.isnan(shared)
+            mask_name = None
+            if mask.any():
+                shared[mask] = 0.
+                mask_name = share(mask, order)[0]
+            del mask, shared
+            specs.append((name, mask_name, values.shape, values.dtype, order))
+
+        with ProcessPoolExecutor(max_workers=min(cores,len(seeds)), initializer=_attachSharedData, initargs=(specs,received)) as executor:
+            futures = [ executor.submit(_runSharedTrial, data_opts, model_opts, train_opts, seeds[t-1], t) for t in trials ]
+            return collect(futures)
+    finally:
+        checkpoint.shared_signal = None
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
 def runMultipleTrials(data, data_opts, model_opts, train_opts, keep_best_run, seed=None, verbose=True):
 
     """Method to run multiple trials of a MOFA model
@@ -161,46 +427,92 @@ def runMultipleTrials(data, data_opts, model_opts, train_opts, keep_best_run, se
     data_opts
     model_opts:
     train_opts:
+    keep_best_run: bool
+        save only the trial with the highest lower bound, otherwise each trial is saved in its own file.
+        Either way, at most the best model so far and the model being trained are kept in memory (besides the models
+        waiting to be saved, see ModelWriter and the trials advanced together in successive halving or in parallel)
     seed:
     trial:
     verbose:
     """
-    # trained_models = Parallel(n_jobs=train_opts['cores'], backend="threading")(
-    # trained_models = Parallel(n_jobs=train_opts['cores'])(
-    #     delayed(runSingleTrial)(data,data_opts,model_opts,train_opts,seed,i) for i in range(1,train_opts['trials']+1))
-    trained_models = [ runSingleTrial(data,data_opts,model_opts,train_opts,seed,i) for i in range(1,train_opts['trials']+1) ]
-
-    print("\n")
-    print("#"*43)
-    print("## Training finished, processing results ##")
-    print("#"*43)
-    print("\n")
-
-    #####################
-    ## Process results ##
-    #####################
-
-    # Select the trial with the best lower bound or keep all models
-    if train_opts['trials'] > 1:
-        if keep_best_run:
-            lb = map(lambda x: x.getTrainingStats()["elbo"][-1], trained_models)
-            save_models = [ trials[s.argmax(lb)] ]
-            outfiles = [ data_opts['outfile'] ]
-        else:
-            save_models = trained_models
-            tmp = os.path.splitext(data_opts['outfile'])
-            outfiles = [ tmp[0]+"_"+str(t)+tmp[1]for t in range(train_opts['trials']) ]
+
+    # Each trial gets its own seed, so the results are the same whether they run sequentially or in parallel
+    seeds = trialSeeds(seed, train_opts['trials'])
+    cores = train_opts.get('cores', 1)
+
+    # Output files: either the best trial, or each trial in its own file
+    keep_all = train_opts['trials'] > 1 and not keep_best_run
+    if keep_all:
+        tmp = os.path.splitext(data_opts['outfile'])
+        outfiles = [ tmp[0]+"_"+str(t)+tmp[1]for t in range(train_opts['trials']) ]
     else:
-        save_models = trained_models
         outfiles = [ data_opts['outfile'] ]
 
     ##################
     ## Save results ##
     ##################
-    
+
+    # The models are saved in a background thread, while the next trials are training. The options are copied,
+    # as saveModel modifies them
     sample_names = data[0].index.tolist()
     feature_names = [  data[m].columns.values.tolist() for m in range(len(data)) ]
-    for t in range(len(save_models)):
+    save_opts = data_opts.get('save') or {}
+    writer = ModelWriter(save_opts.get('queue', 1))
+    def save(model, t):
         print("Saving model %d in %s...\n" % (t,outfiles[t]))
-        saveModel(save_models[t], outfile=outfiles[t], view_names=data_opts['view_names'],
-            sample_names=sample_names, feature_names=feature_names, train_opts=train_opts, model_opts=model_opts)
+        writer.submit(model, outfiles[t], view_names=data_opts['view_names'], sample_names=sample_names, feature_names=feature_names,
+            train_opts=deepcopy(train_opts), model_opts=deepcopy(model_opts), save_opts=save_opts)
+
+    # The trials are processed as soon as they finish, so that the trained models are not all kept in memory:
+    # if all trials are kept, each one is handed off to the writer, otherwise only the best model so far is kept
+    best = { 'model':None, 'elbo':-s.inf }
+    def finished(model):
+        if keep_all:
+            save(model, model.trial-1)
+            return
+        elbo = model.getCurrentELBO()
+        if s.isnan(elbo): elbo = -s.inf
+        if best['model'] is None or elbo > best['elbo']:
+            best['model'], best['elbo'] = model, elbo
+
+    # A termination signal stops the trials with a last checkpoint (if checkpoints are enabled). The program exits once
+    # the worker processes have stopped and the models already trained are saved
+    checkpoints = train_opts.get('checkpoint',{}).get('file') is not None
+    interrupted = None
+    try:
+        with handleSignals(checkpoints):
+            if train_opts.get('halving',{}).get('keep') is not None and train_opts['trials'] > 1:
+                # The trials are advanced in rounds within this process
+                runSuccessiveHalving(data, data_opts, model_opts, train_opts, seeds, finished)
+            elif cores > 1 and train_opts['trials'] > 1:
+                runParallelTrials(data, data_opts, model_opts, train_opts, seeds, cores, finished)
+            else:
+                for i in range(1,train_opts['trials']+1):
+                    finished(runSingleTrial(list(data),data_opts,model_opts,train_opts,seeds[i-1],i))
+
+        print("\n")
+        print("#"*43)
+        print("## Training finished, processing results ##")
+        print("#"*43)
+        print("\n")
+
+        #####################
+        ## Process results ##
+        #####################
+
+        # Save the trial with the best lower bound
+        if not keep_all:
+            if train_opts['trials'] > 1:
+                print("Trial %d has the best lower bound (%.2f)\n" % (best['model'].trial, best['elbo']))
+            save(best['model'], 0)
+            best['model'] = None
+    except TrainingInterrupted as e:
+        interrupted = e.signum
+    finally:
+        # Wait until all models are written and checked
+        writer.close()
+
+    if interrupted is not None:
+        print("Training interrupted, it can be continued with --resume")
+        sys.stdout.flush()
+        sys.exit(128+interrupted)
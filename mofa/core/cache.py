@@ -0,0 +1,193 @@
+"""
+Module to define a cache of the preprocessed data
+
+The entries are keyed by a hash of the contents of the input files and the data options that define the
+preprocessing. Each entry is an HDF5 file with the layout of the binary inputs (see disk_views), that is
+memory-mapped by the following runs instead of parsing and preprocessing the inputs again:
+    data/<view>: (N,D) preprocessed matrix of each view
+    samples: (N,) sample names
+    features/<view>: (D,) feature names of each view
+    dropped/<view>: names of the features removed by the preprocessing
+
+The size of the cache is bounded, the least recently used entries are evicted first.
+
+The hashes of the input files are recorded in digests.json, with the size and the modification time of each file,
+so that an input is only hashed again when it has changed.
+"""
+
+from __future__ import division
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import h5py
+
+from .utils import readBinaryView, writeBinaryData
+
+# Version of the layout of the entries, which is part of the key
+CACHE_VERSION = 1
+
+# File of the cache directory with the hashes of the input files
+DIGESTS_FILE = "digests.json"
+
+# Data options that define the preprocessing
+CACHE_OPTIONS = ['view_names', 'delimiter', 'rownames', 'colnames', 'center_features', 'scale_views', 'scale_features', 'RemoveIncompleteSamples']
+
+def hashFile(filename, block_size=2**24):
+    """ Method to compute the SHA-256 hash of the contents of a file """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            digest.update(block)
+            block = f.read(block_size)
+    return digest.hexdigest()
+
+def fileDigest(filename, cache_dir=None):
+    """ Method to return the SHA-256 hash of the contents of a file, which is read from the hashes recorded in the cache
+    directory if the path, the size and the modification time of the file match, and computed (and recorded) otherwise
+
+    PARAMETERS
+    ----------
+    filename: str
+    cache_dir: str
+        directory of the cache (if None, the file is always hashed)
+    """
+    if cache_dir is None:
+        return hashFile(filename)
+    path, stat = os.path.abspath(filename), os.stat(filename)
+    index = os.path.join(cache_dir, DIGESTS_FILE)
+    try:
+        with open(index, 'r') as f:
+            digests = json.load(f)
+    except (IOError, ValueError):
+        digests = {}
+    entry = digests.get(path)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha256']
+
+    digest = hashFile(path)
+    digests[path] = { 'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns, 'sha256':digest }
+    # The files that no longer exist are forgotten. The index is written to a temporary file and then renamed,
+    # if concurrent runs update it at the same time one of the hashes is lost and computed again by the next run
+    digests = { k:v for k,v in digests.items() if os.path.isfile(k) }
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp = "%s.%d.tmp" % (index, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(digests, f)
+    os.replace(tmp, index)
+    return digest
+
+def cacheKey(data_opts):
+    """ Method to compute the key of the preprocessed data, from the contents of the input files and the data options
+
+    PARAMETERS
+    ----------
+    data_opts: dic
+    """
+    options = { k:data_opts.get(k) for k in CACHE_OPTIONS }
+    options['version'] = CACHE_VERSION
+    # A single HDF5 input contains all views, each file is hashed once (and only if it has changed since the last run)
+    digests = { file:fileDigest(file, data_opts.get('cache_dir')) for file in set(data_opts['input_files']) }
+    options['input_files'] = [ digests[file] for file in data_opts['input_files'] ]
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+def cachePath(data_opts):
+    """ Method to return the path of the cache entry of the data """
+    if 'cache_key' not in data_opts:
+        data_opts['cache_key'] = cacheKey(data_opts)
+    return os.path.join(data_opts['cache_dir'], data_opts['cache_key'] + ".hdf5")
+
+def loadCachedData(data_opts):
+    """ Method to load the preprocessed data from the cache, memory-mapped
+
+    PARAMETERS
+    ----------
+    data_opts: dic
+        data_opts['cache_dir'] is the directory of the cache
+
+    RETURNS
+    -------
+    list of pandas.DataFrame with the preprocessed views, or None if the data are not in the cache
+    """
+    path = cachePath(data_opts)
+    if not os.path.isfile(path):
+        return None
+
+    # Mark the entry as recently used
+    os.utime(path, None)
+
+    print("Loading the preprocessed data from the cache %s..." % path)
+    M = len(data_opts['view_names'])
+    data = [None]*M
+    data_opts['dropped_features'] = [None]*M
+    with h5py.File(path, 'r') as f:
+        for m in range(M):
+            data_opts['dropped_features'][m] = pd.Index(f['dropped'][data_opts['view_names'][m]][()].astype(str))
+    for m in range(M):
+        Y, index, columns = readBinaryView(path, data_opts['view_names'][m])
+        data[m] = pd.DataFrame(Y, index=index, columns=columns, copy=False)
+        print("view %d has %d samples and %d features..." % (m, data[m].shape[0], data[m].shape[1]))
+    return data
+
+def cacheData(data, data_opts):
+    """ Method to store the preprocessed data in the cache, evicting the least recently used entries if the cache is full.
+    The data are then loaded back from the cache, so that a run gives the same results whether the data were cached or not
+
+    PARAMETERS
+    ----------
+    data: list of pandas.DataFrame
+        preprocessed views
+    data_opts: dic
+        data_opts['cache_dir'] is the directory of the cache and data_opts['cache_size'] its maximum size in GB
+    """
+    path = cachePath(data_opts)
+    if not os.path.isdir(data_opts['cache_dir']):
+        os.makedirs(data_opts['cache_dir'])
+
+    # The entry is written to a temporary file and then renamed, so that concurrent runs never read a partial entry
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    writeBinaryData(tmp, data, data_opts['view_names'])
+    with h5py.File(tmp, 'a') as f:
+        for m in range(len(data)):
+            dropped = data_opts.get('dropped_features', [[]]*len(data))[m]
+            f.create_dataset("dropped/"+data_opts['view_names'][m], data=np.array(pd.Index(dropped).astype(str), dtype='S'))
+    os.replace(tmp, path)
+    print("Saved the preprocessed data in the cache %s..." % path)
+
+    evictCache(data_opts['cache_dir'], data_opts.get('cache_size', 20.), keep=path)
+    return loadCachedData(data_opts)
+
+def evictCache(cache_dir, size, keep=None):
+    """ Method to remove the least recently used entries until the cache fits in the given size
+
+    PARAMETERS
+    ----------
+    cache_dir: str
+    size: float
+        maximum size of the cache in GB
+    keep: str
+        path of an entry that is never removed
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith(".hdf5") and os.path.isfile(path):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+
+    total = sum([ entry[1] for entry in entries ])
+    for mtime, nbytes, path in entries:
+        if total <= size*2**30: break
+        if path == keep: continue
+        try:
+            os.remove(path)
+            print("Removed %s from the cache..." % path)
+        except OSError:
+            # Already removed by a concurrent run
+            pass
+        total -= nbytes
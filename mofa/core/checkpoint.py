@@ -0,0 +1,183 @@
+"""
+Module to save and restore checkpoints of the training
+
+A checkpoint is an HDF5 file with the state of a BayesNet after an iteration, from which the training continues
+exactly as if it had not been interrupted:
+    nodes/<node>: parameters and expectations of the variational distributions (see Node.getState)
+    dropped/<i>: indices of the factors removed in each call to BayesNet.removeFactors, replayed on the initial model
+    elbo: (iteration,nodes+1) lower bound of each node and total at each iteration
+    activeK: (iteration,) number of active factors at each iteration
+    minibatches: remaining minibatches of the current epoch (stochastic variational inference)
+    rng: state of the random number generator of the network (BayesNet.rng)
+The file is written to a temporary file that replaces the previous checkpoint, so a checkpoint is never partially written.
+
+The training can be interrupted with SIGTERM or SIGINT: the current iteration is finished, a last checkpoint is saved and
+TrainingInterrupted is raised. When the trials run in worker processes, the signal received by the parent process is passed
+on to the workers through shared_signal.
+"""
+
+from __future__ import division
+from contextlib import contextmanager
+import os
+import signal
+import threading
+
+import numpy as np
+import scipy as s
+import pandas as pd
+import h5py
+
+from .utils import nans
+
+# Termination signal received during the training (None if there was none)
+interrupted = None
+
+# Termination signal received by the parent process (0 if there was none), shared with the worker processes of the trials
+shared_signal = None
+
+class TrainingInterrupted(Exception):
+    """ Exception raised when the training stops after a termination signal, once the checkpoint is saved """
+    def __init__(self, signum):
+        Exception.__init__(self, signum)
+        self.signum = signum
+
+def receivedSignal():
+    """ Method to return the termination signal received by this process or by the parent process (None if there was none) """
+    if interrupted is None and shared_signal is not None and shared_signal.value != 0:
+        return shared_signal.value
+    return interrupted
+
+def checkpointFile(filename, trial, ntrials=1):
+    """ Method to return the checkpoint file of a trial, with the same suffix as the output file of the trial
+
+    PARAMETERS
+    ----------
+    filename: str
+        checkpoint file of the model
+    trial: int
+        trial number (starting at 1)
+    ntrials: int
+        total number of trials
+    """
+    if ntrials == 1: return filename
+    tmp = os.path.splitext(filename)
+    return tmp[0] + "_" + str(trial-1) + tmp[1]
+
+def writeState(group, state):
+    """ Method to write a nested dictionary of arrays to an HDF5 group (None values are skipped).
+    The masked entries of the masked arrays are stored as nan """
+    for k,v in state.items():
+        if isinstance(v, dict):
+            writeState(group.create_group(k), v)
+        elif np.ma.isMaskedArray(v):
+            group.create_dataset(k, data=np.ma.filled(v, np.nan))
+            group[k].attrs['masked'] = True
+        elif v is not None:
+            group.create_dataset(k, data=v)
+
+def readState(group):
+    """ Method to read a nested dictionary of arrays from an HDF5 group """
+    state = {}
+    for k,v in group.items():
+        if isinstance(v, h5py.Group):
+            state[k] = readState(v)
+        elif v.attrs.get('masked', False):
+            state[k] = np.ma.masked_invalid(v[()], copy=False)
+        else:
+            state[k] = v[()]
+    return state
+
+def saveCheckpoint(net, filename):
+    """ Method to save the state of the training
+
+    PARAMETERS
+    ----------
+    net: BayesNet
+    filename: str
+    """
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    with h5py.File(tmp, 'w') as f:
+        f.attrs['iteration'] = net.iteration
+        f.attrs['converged'] = net.converged
+        f.attrs['trial'] = net.trial
+        f.attrs['N'], f.attrs['M'], f.attrs['K'] = net.dim['N'], net.dim['M'], net.dim['K']
+
+        writeState(f.create_group("nodes"), { k:node.getState() for k,node in net.getNodes().items() })
+        writeState(f.create_group("dropped"), { str(i):drop for i,drop in enumerate(net.dropped_factors) })
+
+        f.create_dataset("elbo", data=net.elbo.values[:net.iteration])
+        f["elbo"].attrs['columns'] = np.array(net.elbo.columns, dtype='S')
+        f.create_dataset("activeK", data=net.activeK[:net.iteration])
+        if hasattr(net, "minibatches"):
+            writeState(f.create_group("minibatches"), { str(i):ix for i,ix in enumerate(net.minibatches) })
+
+        name, keys, pos, has_gauss, cached_gaussian = net.rng.get_state()
+        rng = f.create_group("rng")
+        rng.attrs['name'] = name
+        rng.create_dataset("keys", data=keys)
+        rng.attrs['pos'], rng.attrs['has_gauss'], rng.attrs['cached_gaussian'] = pos, has_gauss, cached_gaussian
+    os.replace(tmp, filename)
+
+def loadCheckpoint(net, filename):
+    """ Method to restore the state of the training in a model built with the same data and options
+
+    PARAMETERS
+    ----------
+    net: BayesNet
+        model just after its initialisation
+    filename: str
+    """
+    with h5py.File(filename, 'r') as f:
+        assert f.attrs['N'] == net.dim['N'] and f.attrs['M'] == net.dim['M'], "The checkpoint %s does not match the data" % filename
+
+        # Remove the factors that were dropped, in the same order, and restore the nodes
+        dropped = readState(f["dropped"])
+        for i in range(len(dropped)):
+            net.removeFactors(s.atleast_1d(dropped[str(i)]))
+        assert f.attrs['K'] == net.dim['K'], "The checkpoint %s does not match the number of factors" % filename
+        states = readState(f["nodes"])
+        for k,node in net.getNodes().items():
+            node.setState(states.get(k, {}))
+
+        # Restore the training statistics, with room for the maximum number of iterations of this run
+        net.iteration = int(f.attrs['iteration'])
+        net.converged = bool(f.attrs['converged'])
+        columns = [ c.decode() for c in f["elbo"].attrs['columns'] ]
+        net.elbo = pd.DataFrame(data=nans((max(net.options['maxiter'],net.iteration), len(columns))), columns=columns)
+        net.elbo.iloc[:net.iteration] = f["elbo"][()]
+        net.activeK = nans((max(net.options['maxiter'],net.iteration)))
+        net.activeK[:net.iteration] = f["activeK"][()]
+        if "minibatches" in f:
+            minibatches = readState(f["minibatches"])
+            net.minibatches = [ minibatches[str(i)] for i in range(len(minibatches)) ]
+
+        rng = f["rng"]
+        net.rng.set_state((rng.attrs['name'], rng["keys"][()], int(rng.attrs['pos']), int(rng.attrs['has_gauss']), float(rng.attrs['cached_gaussian'])))
+
+@contextmanager
+def handleSignals(enabled=True):
+    """ Context manager to catch SIGTERM and SIGINT during the training: instead of terminating the process,
+    the signal is recorded in 'interrupted' so that the training saves a checkpoint at the end of the iteration.
+    The handlers can only be installed in the main thread, otherwise the signals keep their default behaviour
+
+    PARAMETERS
+    ----------
+    enabled: bool
+        if False, the signals are not caught
+    """
+    global interrupted
+    if not enabled or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def handler(signum, frame):
+        global interrupted
+        interrupted = signum
+        if shared_signal is not None: shared_signal.value = signum
+        print("\nReceived signal %d, saving a checkpoint at the end of the iteration..." % signum)
+
+    previous = { signum:signal.signal(signum, handler) for signum in (signal.SIGTERM, signal.SIGINT) }
+    try:
+        yield
+    finally:
+        for signum, old in previous.items(): signal.signal(signum, old)
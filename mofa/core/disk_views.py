@@ -0,0 +1,227 @@
+"""
+Module to define views of the data that stay on disk (out-of-core training)
+
+The input file is an HDF5 file with one dataset per view with dimensions (samples,features), chunked by blocks of
+features with all samples (see mofa convert --outOfCore), where missing values are stored as nan:
+    data/<view>: (N,D) matrix of each view
+    samples: (N,) sample names (optional)
+    features/<view>: (D,) feature names of each view (optional)
+
+The views are never loaded in memory: the nodes stream over blocks of features, and the next block
+is read in a background thread while the current one is being processed.
+"""
+
+from __future__ import division
+from time import sleep
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import h5py
+
+
+class DiskView(object):
+    """ Class for a view of the data stored in an HDF5 dataset, with the feature filtering, centering and scaling
+    of the data processing applied on the fly to each block
+
+    PARAMETERS
+    ----------
+    filename: str
+        path to the HDF5 file
+    dataset: str
+        name of the dataset with dimensions (samples,features)
+    features: ndarray
+        indices of the features (columns of the dataset) in the view. If None, all features
+    center: ndarray or float
+        value subtracted from each feature
+    scale: ndarray or float
+        value that divides each feature (after centering)
+    block_size: float
+        maximum size of a block of features in MB
+    index: pandas.Index
+        sample names
+    columns: pandas.Index
+        feature names
+    """
+    def __init__(self, filename, dataset, features=None, center=0., scale=1., block_size=256., index=None, columns=None):
+        self.filename = filename
+        self.dataset = dataset
+        self.file = None
+
+        # The blocks are returned in single precision by default, as the text inputs in loadData
+        shape = self.open().shape
+        self.features = np.arange(shape[1]) if features is None else np.asarray(features)
+        self.shape = (shape[0], len(self.features))
+        self.dtype = np.dtype(np.float32)
+        self.center = np.broadcast_to(np.asarray(center, dtype=self.dtype), (self.shape[1],))
+        self.scale = np.broadcast_to(np.asarray(scale, dtype=self.dtype), (self.shape[1],))
+        self.block_size = block_size
+
+        self.index = pd.RangeIndex(self.shape[0]) if index is None else pd.Index(index)
+        self.columns = pd.RangeIndex(self.shape[1]) if columns is None else pd.Index(columns)
+
+    def open(self):
+        """ Method to return the HDF5 dataset, opening the file if required """
+        if self.file is None:
+            self.file = h5py.File(self.filename, 'r')
+        return self.file[self.dataset]
+
+    def __getstate__(self):
+        # The file handle is not picklable, each process opens the file on its own
+        state = self.__dict__.copy()
+        state['file'] = None
+        return state
+
+    def astype(self, dtype, **kwargs):
+        """ Method to return the view with the blocks in a given floating point precision (the data on disk are not modified) """
+        view = copy.copy(self)
+        view.dtype = np.dtype(dtype)
+        view.center, view.scale = self.center.astype(dtype), self.scale.astype(dtype)
+        return view
+
+    def blockLength(self):
+        """ Method to return the number of features per block """
+        return max(1, int(self.block_size*2**20 // (self.shape[0]*self.dtype.itemsize)))
+
+    def readBlock(self, d):
+        """ Method to read a block of features
+
+        PARAMETERS
+        ----------
+        d: ndarray
+            sorted indices of the features in the view
+
+        RETURNS
+        -------
+        Y: ndarray with dimensions (N,len(d)), the processed data with the missing values set to zero
+        observed: boolean ndarray with dimensions (N,len(d)), False for the missing values
+        """
+        # Dense blocks are read as the range of columns that contains them in a single call, which follows the chunk layout.
+        # Sparse blocks (incomplete or filtered features) are read column by column with a fancy index, so that the
+        # memory used stays within the block size
+        cols = self.features[d]
+        span = cols[-1] - cols[0] + 1
+        if span <= 2*len(cols):
+            Y = self.open()[:, cols[0]:(cols[0]+span)]
+            if len(cols) < span: Y = Y[:, cols-cols[0]]
+        else:
+            Y = self.open()[:, cols.tolist()]
+        Y = ((Y - self.center[d]) / self.scale[d]).astype(self.dtype, copy=False)
+        observed = ~np.isnan(Y)
+        Y[~observed] = 0.
+        return Y, observed
+
+    def iterBlocks(self, features=None):
+        """ Generator over blocks of features, the next block is read in a background thread while the current one is processed
+
+        PARAMETERS
+        ----------
+        features: ndarray
+            sorted indices of the features to read. If None, all features
+
+        YIELDS
+        ------
+        d: ndarray with the indices of the features in the block
+        Y: ndarray with dimensions (N,len(d)), the processed data with the missing values set to zero
+        observed: boolean ndarray with dimensions (N,len(d)), False for the missing values
+        """
+        features = np.arange(self.shape[1]) if features is None else np.asarray(features)
+        length = self.blockLength()
+        blocks = [ features[j:(j+length)] for j in range(0, len(features), length) ]
+        if len(blocks) == 0: return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self.readBlock, blocks[0])
+            for j in range(len(blocks)):
+                Y, observed = future.result()
+                if j+1 < len(blocks): future = executor.submit(self.readBlock, blocks[j+1])
+                yield blocks[j], Y, observed
+
+    def featureStatistics(self):
+        """ Method to compute the number of observations, the mean and the variance of each feature in a single pass """
+        nobs, mean, var = np.zeros(self.shape[1], dtype=int), np.zeros(self.shape[1]), np.zeros(self.shape[1])
+        for d, Y, observed in self.iterBlocks():
+            # Every block contains all samples, so the statistics of each feature are computed in two passes over the block
+            nobs[d] = observed.sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean[d] = Y.sum(axis=0, dtype=np.float64) / nobs[d]
+                var[d] = (np.square(Y - mean[d]) * observed).sum(axis=0, dtype=np.float64) / nobs[d]
+        return nobs, mean, var
+
+    def mean(self, axis=0):
+        """ Method to compute the mean of each feature of the processed data, ignoring the missing values (as pandas.DataFrame.mean) """
+        assert axis == 0, "The mean of a view on disk can only be computed over the samples"
+        return self.featureStatistics()[1]
+
+    def writeTransposed(self, group, name, **options):
+        """ Method to copy the view to an HDF5 group by blocks of features, with dimensions (features,samples) and nan for the missing values
+
+        PARAMETERS
+        ----------
+        group: h5py.Group
+        name: str
+            name of the dataset
+        options:
+            storage options of the dataset (dtype, chunks, compression), passed to h5py
+        """
+        options.setdefault('dtype', self.dtype)
+        dataset = group.create_dataset(name, shape=(self.shape[1],self.shape[0]), **options)
+        for d, Y, observed in self.iterBlocks():
+            Y[~observed] = np.nan
+            dataset[d[0]:(d[-1]+1),:] = Y.T
+
+def loadDiskData(data_opts, verbose=True):
+    """ Method to define the views for out-of-core training.
+    The data processing of loadData (removing features without observations or variance, centering and scaling)
+    is computed with a single streaming pass over each view and applied on the fly when the blocks are read
+
+    PARAMETERS
+    ----------
+    data_opts: dic
+        data_opts['input_files'] contains a single HDF5 file, data_opts['block_size'] the size of the blocks in MB
+    verbose: boolean
+        print the banner of the command line interface
+    """
+
+    # The data processing is shared with the text inputs (utils imports this module)
+    from .utils import featureProcessing, readNames
+
+    if verbose:
+        print ("\n")
+        print ("#"*18)
+        print ("## Loading data ##")
+        print ("#"*18)
+        print ("\n")
+        sleep(1)
+
+    assert len(set(data_opts['input_files'])) == 1, "Out-of-core training requires a single HDF5 input file"
+    filename = data_opts['input_files'][0]
+    block_size = data_opts.get('block_size', 256.)
+
+    with h5py.File(filename, 'r') as f:
+        samples = readNames(f['samples']) if 'samples' in f else None
+        features = [ readNames(f['features'][view]) if 'features' in f and view in f['features'] else None for view in data_opts['view_names'] ]
+
+    M = len(data_opts['view_names'])
+    Y = [None]*M
+    for m in range(M):
+        view = DiskView(filename, "data/"+data_opts['view_names'][m], block_size=block_size, index=samples, columns=features[m])
+        print("Loaded view %s from %s with %d samples and %d features..." % (data_opts['view_names'][m], filename, view.shape[0], view.shape[1]))
+        if view.open().chunks is None and view.shape[1] > view.blockLength():
+            print("Warning: the dataset %s is stored by samples, so every block of features reads a part of each row of the file. "
+                "Convert the inputs with 'mofa convert --outOfCore' to chunk them by blocks of features" % view.dataset)
+        nobs, mean, var = view.featureStatistics()
+
+        keep, center, scale = featureProcessing(nobs, mean, var, data_opts, m)
+        Y[m] = DiskView(filename, view.dataset, features=keep, center=center, scale=scale, block_size=block_size,
+            index=view.index, columns=view.columns[keep])
+
+    # Check that the dimensions match
+    if len(set([Y[m].shape[0] for m in range(M)])) != 1:
+        print("\nThe number of samples does not match between the views, aborting. The datasets must have dimensions (samples,features)")
+        exit()
+
+    print("\nAfter data processing:")
+    for m in range(M): print("view %d has %d samples and %d features..." % (m, Y[m].shape[0], Y[m].shape[1]))
+
+    return Y
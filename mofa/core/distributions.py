@@ -27,6 +27,7 @@ class Distribution(object):
     """ General class for a statistical distribution """
     def __init__(self, dim):
         self.dim = dim
+        self.dtype = None
 
     def density(self):
         """ General method to calculate density """
@@ -50,8 +51,53 @@ class Distribution(object):
 
     def setParameters(self,**params):
         """ General setter function for parameters """
+        if self.dtype is not None:
+            params = { k:s.asarray(v).astype(self.dtype, copy=False) for k,v in params.items() }
         self.params = params
 
+    def setDtype(self, dtype):
+        """ General method to set the floating point precision of the parameters and expectations.
+        Once set, the parameters are cast to this precision every time they are updated.
+
+        PARAMETERS
+        ----------
+        dtype: numpy dtype or str
+            floating point type, e.g. 'float32'
+        """
+        self.dtype = s.dtype(dtype)
+        self.setParameters(**self.params)
+        self.expectations = { k:s.asarray(v).astype(self.dtype, copy=False) for k,v in self.expectations.items() }
+
+    def stepParameters(self, old, ro):
+        """ General method for a natural gradient step (stochastic inference): it returns the parameters
+        moved from their old value towards the current ones, which are the optimal update.
+        The step is linear in the natural parameters, which is a linear interpolation of the parameters
+        for distributions such as the Gamma and the Beta
+
+        PARAMETERS
+        ----------
+        old: dict
+            parameters before the update
+        ro: float
+            step size (learning rate) between 0 and 1
+        """
+        return { k:(1.-ro)*old[k] + ro*self.params[k] for k in self.params }
+
+    def naturalGradientStep(self, old, ro):
+        """ General method to set the parameters after a natural gradient step (see stepParameters).
+        The parameters that were not initialised (nan) take the current value
+
+        PARAMETERS
+        ----------
+        old: dict
+            parameters before the update
+        ro: float
+            step size (learning rate) between 0 and 1
+        """
+        new = self.getParameters()
+        step = self.stepParameters(old, ro)
+        self.setParameters(**{ k:s.where(s.isnan(v), new[k], v) for k,v in step.items() })
+
     def getExpectation(self):
         """ General getter function for expectations """
         return self.expectations['E']
@@ -240,6 +286,12 @@ class UnivariateGaussian(Distribution):
         E2 = E**2 + self.params['var']
         self.expectations = { 'E':E, 'E2':E2 }
 
+    def stepParameters(self, old, ro):
+        # Natural gradient step: interpolate the precision and the precision-weighted mean
+        precision = (1.-ro)/old['var'] + ro/self.params['var']
+        mean = ((1.-ro)*old['mean']/old['var'] + ro*self.params['mean']/self.params['var']) / precision
+        return { 'mean':mean, 'var':1./precision }
+
 
     def density(self, x):
         assert x.shape == self.dim, "Problem with the dimensionalities"
@@ -408,7 +460,29 @@ class BernoulliGaussian(Distribution):
         self.S.setParameters(theta=params['theta'])
         self.W_S0.setParameters(mean=params['mean_S0'], var=params['var_S0'])
         self.W_S1.setParameters(mean=params['mean_S1'], var=params['var_S1'])
-        self.params = params
+        self.updateParameters()
+
+    def setDtype(self, dtype):
+        # Method to set the floating point precision of the constituent distributions
+        self.dtype = s.dtype(dtype)
+        self.S.setDtype(dtype)
+        self.W_S0.setDtype(dtype)
+        self.W_S1.setDtype(dtype)
+        self.updateParameters()
+        self.updateExpectations()
+
+    def stepParameters(self, old, ro):
+        # Natural gradient step: the log odds of S and the natural parameters of W|S=1 are interpolated,
+        # whereas W|S=0 does not depend on the data and takes the current value.
+        # The old probabilities are bounded away from 0 and 1 so that they can move, but a current value of exactly 0 or 1
+        # (i.e. a factor without sparsity) is kept
+        eps = s.finfo(self.params['theta'].dtype).eps
+        logit = lambda theta: s.log(theta) - s.log1p(-theta)
+        with s.errstate(divide='ignore'):
+            lnodds = (1.-ro)*logit(s.clip(old['theta'],eps,1.-eps)) + ro*logit(self.params['theta'])
+        S1 = self.W_S1.stepParameters({ 'mean':old['mean_S1'], 'var':old['var_S1'] }, ro)
+        return { 'theta':1./(1.+s.exp(-lnodds)), 'mean_S1':S1['mean'], 'var_S1':S1['var'],
+                 'mean_S0':self.params['mean_S0'], 'var_S0':self.params['var_S0'] }
 
     def updateParameters(self):
         # Method to update the parameters of the joint distribution based on its constituent distributions
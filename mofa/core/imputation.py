@@ -0,0 +1,190 @@
+"""
+Module to compute predictions and to impute missing values from a trained model (as predict and imputeMissing in MOFAtools)
+
+The predictions of each view are computed from the moments of the latent variables (Z) and the weights (SW),
+by blocks of features, and written block by block into chunked HDF5 datasets, so that the full matrices are never
+kept in memory. The datasets have dimensions (features,samples), as the data in the model files:
+    predictions/<view>: predicted values E[Z]E[SW]', on the scale given by 'type'
+    variance/<view>: variance of the linear predictor, sum_k E[z_k^2]E[(s_k w_k)^2] - (E[z_k]E[s_k w_k])^2
+    imputed/<view>: training data with the missing values replaced by the predictions
+    samples, features/<view>: sample and feature names
+"""
+
+from __future__ import division
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import scipy as s
+import numpy as np
+import h5py
+
+from .utils import sigmoid, datasetOptions, writeNames
+from .training_data import trainingData
+from .load_model import MOFAModel
+
+
+def linkInverse(X, likelihood, type="inRange"):
+    """ Method to transform the linear predictions to the scale of the data
+
+    PARAMETERS
+    ----------
+    X: ndarray
+        linear predictions
+    likelihood: str
+    type: str
+        "link" returns the linear predictions, "response" the mean for gaussian and poisson and the probabilities for bernoulli,
+        "inRange" rounds the response for integer-valued distributions
+    """
+    if type == "link" or likelihood == "gaussian":
+        return X
+    if likelihood == "bernoulli":
+        X = sigmoid(X)
+    elif likelihood == "poisson":
+        X = s.exp(X)
+    else:
+        print("Likelihood %s not implemented for predictions" % likelihood)
+        exit()
+    return s.around(X) if type == "inRange" else X
+
+def loadMoments(model_file, factors=None):
+    """ Method to read the first and second moments of the latent variables and the weights from a saved model
+
+    PARAMETERS
+    ----------
+    model_file: str
+        hdf5 file of the saved model
+    factors: list
+        indices of the factors used in the predictions (the intercept and the covariates are always used). If None, all factors
+
+    RETURNS
+    -------
+    dictionary with E[Z] and E[Z^2] (samples,factors), and E[SW] and E[(SW)^2] (features,factors), the likelihood and the names of each view
+    """
+    moments = { 'SW':{}, 'SWW':{}, 'likelihood':{}, 'features':{} }
+    with MOFAModel(model_file, cache_size=0) as saved:
+        # The covariates (and the intercept) are always used
+        if factors is None:
+            factors = s.arange(saved.K)
+        else:
+            factors = s.union1d(saved.covariates, s.asarray(factors, dtype=int))
+        Z, Zvar = saved.getParameter("Z", "mean", factors=factors), saved.getParameter("Z", "var", factors=factors)
+        moments['Z'], moments['ZZ'] = Z, s.square(Z) + Zvar
+
+        moments['views'] = saved.views
+        for view in moments['views']:
+            Q = { k:saved.getParameter("SW", k, view, factors=factors) for k in ("theta","mean_S1","var_S1") }
+            moments['SW'][view] = Q['theta']*Q['mean_S1']
+            moments['SWW'][view] = Q['theta']*(s.square(Q['mean_S1']) + Q['var_S1'])
+            moments['likelihood'][view] = saved.likelihoods[view]
+            moments['features'][view] = saved.getFeatures(view)
+        moments['samples'] = saved.samples
+    return moments
+
+def predictBlock(moments, view, d, type="inRange"):
+    """ Method to compute the predictions of a block of features
+
+    PARAMETERS
+    ----------
+    moments: dic
+        output of loadMoments
+    view: str
+    d: slice
+        block of features
+    type: str
+        scale of the predictions (see linkInverse)
+
+    RETURNS
+    -------
+    predictions and variance of the linear predictor, ndarrays with dimensions (samples,features)
+    """
+    Z, ZZ = moments['Z'], moments['ZZ']
+    SW, SWW = moments['SW'][view][d,:], moments['SWW'][view][d,:]
+    prediction = s.dot(Z, SW.T)
+    variance = s.dot(ZZ, SWW.T) - s.dot(s.square(Z), s.square(SW).T)
+    return linkInverse(prediction, moments['likelihood'][view], type), s.maximum(variance, 0.)
+
+def predictView(moments, view, data, out, type="inRange", impute=True, variance=True, block_size=64.):
+    """ Method to write the predictions of a view by blocks of features
+
+    PARAMETERS
+    ----------
+    moments: dic
+        output of loadMoments
+    view: str
+    data: SavedView
+        training data of the view (see trainingData), required to impute the missing values
+    out: h5py.File
+        output file, with the chunked datasets of the view
+    type: str
+        scale of the predictions (see linkInverse)
+    impute: bool
+        write the training data with the missing values imputed
+    variance: bool
+        write the variance of the linear predictor
+    block_size: float
+        maximum size of a block of features in MB
+    """
+    N, D = moments['Z'].shape[0], moments['SW'][view].shape[0]
+    length = max(1, int(block_size*2**20 // (N*8)))
+    for j in range(0, D, length):
+        d = slice(j, min(j+length, D))
+        prediction, var = predictBlock(moments, view, d, type)
+        out['predictions'][view][d,:] = prediction.T
+        if variance:
+            out['variance'][view][d,:] = var.T
+        if impute:
+            Y = data[d,:]
+            missing = s.isnan(Y)
+            Y[missing] = prediction.T[missing]
+            out['imputed'][view][d,:] = Y
+
+def predict(model_file, outfile, views=None, factors=None, type="inRange", impute=True, variance=True, block_size=64., threads=None, save_opts=None, input_files=None):
+    """ Method to compute the predictions (and impute the missing values) of a trained model, written to an hdf5 file
+
+    PARAMETERS
+    ----------
+    model_file: str
+        hdf5 file of the saved model
+    outfile: str
+        output hdf5 file
+    views: list
+        names of the views to predict. If None, all views
+    factors: list
+        indices of the factors used in the predictions (the intercept and the covariates are always used). If None, all factors
+    type: str
+        "inRange" (default), "response" or "link" (see linkInverse)
+    impute: bool
+        write the training data with the missing values replaced by the predictions
+    variance: bool
+        write the variance of the linear predictor
+    block_size: float
+        maximum size of a block of features in MB
+    threads: int
+        number of views predicted in parallel (by default, all of them)
+    save_opts: dic
+        storage options of the datasets (see datasetOptions)
+    input_files: list
+        paths of the input files, if the training data were saved as a reference to the inputs and the files have been moved
+    """
+    assert type in ["inRange","response","link"], "'type' has to be 'inRange', 'response' or 'link'"
+    moments = loadMoments(model_file, factors)
+    if views is None:
+        views = moments['views']
+    else:
+        assert all([ view in moments['views'] for view in views ]), "Views %s are not in the model" % ", ".join(set(views)-set(moments['views']))
+
+    with h5py.File(model_file, 'r') as model, h5py.File(outfile, 'w') as out:
+        data = trainingData(model, views, input_files) if impute else {}
+        writeNames(out, "samples", moments['samples'])
+        N = moments['Z'].shape[0]
+        for view in views:
+            writeNames(out, "features/"+view, moments['features'][view])
+            D = moments['SW'][view].shape[0]
+            for name in ['predictions'] + (['imputed'] if impute else []) + (['variance'] if variance else []):
+                out.create_dataset(name+"/"+view, shape=(D,N), **datasetOptions((D,N), np.float64, save_opts))
+
+        # The BLAS calls release the GIL, so the views are predicted concurrently with a pool of threads
+        nthreads = threads or min(len(views), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            futures = [ executor.submit(predictView, moments, view, data.get(view), out, type, impute, variance, block_size) for view in views ]
+            for future in futures: future.result()
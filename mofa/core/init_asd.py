@@ -1,12 +1,23 @@
 import argparse
+import os
+import sys
 import pandas as pd
 import scipy as s
 from time import sleep
 
 from .build_model import *
+from .training_data import loadTrainingData, dataReference
+from .warm_start import loadInitialisation
+from .projection import project, saveProjection
 
 def entry_point():
 
+  # Subcommands
+  if len(sys.argv) > 1 and sys.argv[1] == "convert":
+    return convert(sys.argv[2:])
+  if len(sys.argv) > 1 and sys.argv[1] == "project":
+    return projectSamples(sys.argv[2:])
+
   banner = """
   ###########################################################
   ###                 __  __  ___  _____ _                ### 
@@ -24,12 +35,21 @@ def entry_point():
   p = argparse.ArgumentParser( description='Run script for MOFA' )
 
   # I/O
-  p.add_argument( '--inFiles',           type=str, nargs='+', required=True,                  help='Input data files (including extension)' )
+  p.add_argument( '--inFiles',           type=str, nargs='+', required=True,                  help='Input data files (including extension): delimited text (optionally gzipped), .npy or a single HDF5 file' )
   p.add_argument( '--outFile',           type=str, required=True,                             help='Output data file (hdf5 format)' )
   p.add_argument( '--delimiter',         type=str, default=" ",                               help='Delimiter for input files' )
   p.add_argument( '--covariatesFile',    type=str, default=None,                               help='Input data file for covariates' )
   p.add_argument( '--header_cols',       action='store_true',                                 help='Do the input files contain column names?' )
   p.add_argument( '--header_rows',       action='store_true',                                 help='Do the input files contain row names?' )
+  p.add_argument( '--outOfCore',         action='store_true',                                 help='Keep the data on disk and stream it during training (the input is a single HDF5 file with the datasets data/<view>)' )
+  p.add_argument( '--blockSize',         type=float, default=256.,                            help='Size in MB of the blocks of data read from disk in out-of-core training' )
+  p.add_argument( '--cacheDir',          type=str, default=None,                              help='Directory of the cache of preprocessed data, reused by the runs with the same inputs and data options' )
+  p.add_argument( '--cacheSize',         type=float, default=20.,                             help='Maximum size in GB of the cache of preprocessed data' )
+  p.add_argument( '--compression',       type=str, default=None, choices=['gzip','lzf'],      help='Compression of the datasets of the output file (lzf can only be read with h5py)' )
+  p.add_argument( '--compressionLevel',  type=int, default=4,                                 help='Level of the gzip compression of the output file (0-9)' )
+  p.add_argument( '--saveData',          type=str, default="full", choices=['full','compact','reference'], help='Storage of the training data in the output file: full, compact (integer count and binary views, no copy of the gaussian views) or a reference to the input files (models saved with reference can only be loaded in Python, not with loadModel in R)' )
+  p.add_argument( '--saveQueue',         type=int, default=1,                                 help='Maximum number of trained models waiting to be saved in the background (0 saves them before continuing the training)' )
+  p.add_argument( '--saveDtype',         type=str, default=None, choices=['float32','float64'], help='Floating point precision of the datasets of the output file (by default, the precision of the model)' )
 
   # Data options
   p.add_argument( '--center_features',   action="store_true",                                 help='Center the features to zero-mean?' )
@@ -49,11 +69,17 @@ def entry_point():
   p.add_argument( '--learnTheta',        type=int, nargs="+", default=1,                      help='Learn the sparsity parameter from the spike-and-slab (theta)?' )
   p.add_argument( '--initTheta',         type=float, nargs="+", default=1. ,                  help='Initialisation for the sparsity parameter of the spike-and-slab (theta)')
   p.add_argument( '--learnIntercept',    action='store_true',                                 help='Learn the feature-wise mean?' )
+  p.add_argument( '--initFrom',          type=str, default=None,                              help='Initialise the model from a saved model (hdf5 format), matching the samples, features and views by name' )
 
   # Training options
   p.add_argument( '--elbofreq',          type=int, default=1,                                 help='Frequency of computation of ELBO' )
   p.add_argument( '--iter',              type=int, default=5000,                              help='Maximum number of iterations' )
   p.add_argument( '--ntrials',           type=int, default=1,                                 help='Number of trials' )
+  p.add_argument( '--keepBestRun',       action='store_true',                                 help='Save only the trial with the highest lower bound (by default, each trial is saved in its own file)' )
+  p.add_argument( '--cores',             type=int, default=1,                                 help='Number of cores to run the trials in parallel' )
+  p.add_argument( '--halvingKeep',       type=float, default=None,                            help='Terminate early the trials with a low ELBO, keeping this fraction of trials after each round' )
+  p.add_argument( '--halvingGrace',      type=int, default=100,                               help='Number of iterations before terminating trials early' )
+  p.add_argument( '--halvingRound',      type=int, default=50,                                help='Number of iterations between rounds of early termination of trials' )
   p.add_argument( '--startSparsity',     type=int, default=100,                               help='Iteration to activate the spike-and-slab')
   p.add_argument( '--tolerance',         type=float, default=0.01 ,                            help='Tolerance for convergence (based on the change in ELBO)')
   p.add_argument( '--startDrop',         type=int, default=1 ,                                help='First iteration to start dropping factors')
@@ -62,6 +88,19 @@ def entry_point():
   p.add_argument( '--nostop',            action='store_true',                                 help='Do not stop when convergence criterion is met' )
   p.add_argument( '--verbose',           action='store_true',                                 help='Use more detailed log messages?')
   p.add_argument( '--seed',              type=int, default=0 ,                                help='Random seed' )
+  p.add_argument( '--referenceUpdates',  action='store_true',                                 help='Use the reference (non-vectorised) loops to update the nodes?' )
+  p.add_argument( '--dtype',             type=str, default=None, choices=['float32','float64'], help='Floating point precision used for training (float32 halves the memory usage)' )
+  p.add_argument( '--threads',           type=int, default=1,                                 help='Number of threads used to update the views in parallel' )
+  p.add_argument( '--blasThreads',       type=int, default=None,                              help='Maximum number of BLAS threads used by each thread' )
+  p.add_argument( '--batchSize',         type=float, default=None,                            help='Fraction of samples in each minibatch (activates stochastic variational inference)' )
+  p.add_argument( '--learningRate',      type=float, default=1.,                              help='Initial step size of stochastic variational inference' )
+  p.add_argument( '--forgetRate',        type=float, default=0.75,                            help='Decay of the step size of stochastic variational inference (between 0.5 and 1)' )
+  p.add_argument( '--learningDelay',     type=float, default=1.,                              help='Delay of the decay of the step size of stochastic variational inference' )
+  p.add_argument( '--elboWindow',        type=int, default=10,                                help='Number of lower bound estimates averaged to assess the convergence of stochastic variational inference' )
+  p.add_argument( '--checkpointIter',    type=int, default=None,                              help='Save a checkpoint of the training every this number of iterations' )
+  p.add_argument( '--checkpointTime',    type=float, default=None,                            help='Save a checkpoint of the training every this number of seconds' )
+  p.add_argument( '--checkpointFile',    type=str, default=None,                              help='Checkpoint file (hdf5 format), by default next to the output file' )
+  p.add_argument( '--resume',            action='store_true',                                 help='Continue the training from the last checkpoint' )
 
 
   args = p.parse_args()
@@ -80,6 +119,17 @@ def entry_point():
   # View names
   data_opts['view_names'] = args.views
 
+  # Out-of-core training
+  data_opts['out_of_core'] = args.outOfCore
+  data_opts['block_size'] = args.blockSize
+
+  # Cache of the preprocessed data (not used in out-of-core training, where the data stay on disk)
+  data_opts['cache_dir'] = args.cacheDir if not args.outOfCore else None
+  data_opts['cache_size'] = args.cacheSize
+
+  # Storage of the output file: chunks, compression and floating point precision of the datasets
+  data_opts['save'] = { 'compression':args.compression, 'compression_opts':args.compressionLevel, 'dtype':args.saveDtype, 'data':args.saveData, 'queue':args.saveQueue }
+
   # Headers
   if args.header_rows:
     data_opts['rownames'] = 0
@@ -95,6 +145,11 @@ def entry_point():
   ## Data processing ##
   #####################
 
+  # In out-of-core training all views are read from a single HDF5 file
+  if data_opts['out_of_core']:
+    assert len(data_opts['input_files']) == 1, "Out-of-core training requires a single HDF5 input file"
+  if len(data_opts['input_files']) == 1 and os.path.splitext(data_opts['input_files'][0])[1].lower() in ('.h5','.hdf5'):
+    data_opts['input_files'] = data_opts['input_files']*len(data_opts['view_names'])
   M = len(data_opts['input_files'])
   assert M == len(data_opts['view_names']), "Length of view names and input files does not match"
 
@@ -139,12 +194,12 @@ def entry_point():
   ## Load data ##
   ###############
 
-  # Load observations
-  data = loadData(data_opts)
+  # Load the observations (from the cache of preprocessed data if it is enabled)
+  data = loadTrainingData(data_opts)
 
-  # Remove samples with missing views
-  if data_opts['RemoveIncompleteSamples']:
-    data = removeIncompleteSamples(data)
+  # Reference to the inputs, saved instead of the data
+  if data_opts['save']['data'] == "reference":
+    data_opts['save']['reference'] = dataReference(data_opts)
 
   # Calculate dimensionalities
   N = data[0].shape[0]
@@ -320,6 +375,14 @@ def entry_point():
       model_opts["initTheta"]["E"][m][:,0] = 1.
 
 
+  ##############################################
+  ## Warm start from a previously saved model ##
+  ##############################################
+
+  if args.initFrom is not None:
+    loadInitialisation(args.initFrom, data, data_opts, model_opts)
+
+
   #################################
   ## Define the training options ##
   #################################
@@ -352,14 +415,109 @@ def entry_point():
   # Number of trials
   train_opts['trials'] = args.ntrials
 
+  # Number of cores to run the trials in parallel
+  train_opts['cores'] = args.cores
+
+  # Early termination of the trials with a dominated lower bound (successive halving)
+  train_opts['halving'] = { 'keep':args.halvingKeep, 'grace':args.halvingGrace, 'round':args.halvingRound }
+
+  # Use the vectorised updates (or fall back to the reference loops)
+  train_opts['vectorised'] = not args.referenceUpdates
+
+  # Floating point precision of the data and the nodes (the lower bound is always accumulated in double precision)
+  if args.dtype is not None: train_opts['dtype'] = args.dtype
+
+  # Number of threads to update the views in parallel, and maximum number of BLAS threads per thread
+  train_opts['threads'] = args.threads
+  train_opts['blasThreads'] = args.blasThreads
+
+  # Stochastic variational inference: minibatch size and schedule of the step size ro = learning_rate*(iteration+delay)^(-forget_rate)
+  train_opts['svi'] = { 'batch_size':args.batchSize, 'learning_rate':args.learningRate, 'forget_rate':args.forgetRate, 'delay':args.learningDelay, 'window':args.elboWindow }
+  if args.batchSize is not None: assert 0. < args.batchSize <= 1., "The minibatch size has to be a fraction of the samples"
+
+  # Checkpoints of the training, saved every 'iter' iterations or 'time' seconds and after SIGTERM/SIGINT, and resumed with --resume
+  checkpoints = args.checkpointIter is not None or args.checkpointTime is not None or args.resume or args.checkpointFile is not None
+  checkpoint_file = args.checkpointFile if args.checkpointFile is not None else os.path.splitext(args.outFile)[0] + "_checkpoint.hdf5"
+  train_opts['checkpoint'] = { 'file':checkpoint_file if checkpoints else None, 'iter':args.checkpointIter, 'time':args.checkpointTime, 'resume':args.resume }
+
 
   #####################
   ## Train the model ##
   #####################
 
   # Keep the trial with the highest lower bound?
-  keep_best_run = False
+  keep_best_run = args.keepBestRun
 
   # Go!
   # runSingleTrial(data, data_opts, model_opts, train_opts, seed=None)
   runMultipleTrials(data, data_opts, model_opts, train_opts, keep_best_run, args.seed)
+
+
+def convert(argv=None):
+  """ Entry point of 'mofa convert', to convert the text inputs into a single HDF5 file that is memory-mapped
+  (or streamed in out-of-core training) by the following runs, without any parse step. The data are stored without processing """
+
+  p = argparse.ArgumentParser( prog='mofa convert', description='Convert text input files of MOFA into a binary HDF5 file' )
+  p.add_argument( '--inFiles',           type=str, nargs='+', required=True,                  help='Input data files (including extension)' )
+  p.add_argument( '--outFile',           type=str, required=True,                             help='Output data file (hdf5 format)' )
+  p.add_argument( '--views',             type=str, nargs='+', required=True,                  help='View names')
+  p.add_argument( '--delimiter',         type=str, default=" ",                               help='Delimiter for input files' )
+  p.add_argument( '--header_cols',       action='store_true',                                 help='Do the input files contain column names?' )
+  p.add_argument( '--header_rows',       action='store_true',                                 help='Do the input files contain row names?' )
+  p.add_argument( '--outOfCore',         action='store_true',                                 help='Chunk the views by blocks of features for out-of-core training (the file is then read into memory instead of memory-mapped by the other runs)' )
+  args = p.parse_args(argv)
+
+  assert len(args.inFiles) == len(args.views), "Length of view names and input files does not match"
+  data_opts = {}
+  data_opts['input_files'] = args.inFiles
+  data_opts['delimiter'] = args.delimiter
+  data_opts['rownames'] = 0 if args.header_rows else None
+  data_opts['colnames'] = 0 if args.header_cols else None
+
+  Y, index, columns, stats = readTextFiles(data_opts)
+  data = [ pd.DataFrame(Y[m], index=index[m], columns=columns[m], copy=False) for m in range(len(Y)) ]
+  writeBinaryData(args.outFile, data, args.views, out_of_core=args.outOfCore)
+  print("Saved the %d views in %s" % (len(data), args.outFile))
+
+
+def projectSamples(argv=None):
+  """ Entry point of 'mofa project', to infer the latent variables of new samples from a trained model with the weights fixed.
+  The input files contain the samples in the rows and have to be processed as the training data """
+
+  p = argparse.ArgumentParser( prog='mofa project', description='Project new samples onto a trained MOFA model' )
+  p.add_argument( '--model',             type=str, required=True,                             help='Trained model (hdf5 format)' )
+  p.add_argument( '--inFiles',           type=str, nargs='+', required=True,                  help='Input data files with the new samples (including extension): delimited text, .npy or HDF5' )
+  p.add_argument( '--views',             type=str, nargs='+', required=True,                  help='View names of the input files (views of the model that are not given are treated as missing)')
+  p.add_argument( '--outFile',           type=str, required=True,                             help='Output file with the latent variables of the new samples (hdf5 format)' )
+  p.add_argument( '--delimiter',         type=str, default=" ",                               help='Delimiter for input files' )
+  p.add_argument( '--header_cols',       action='store_true',                                 help='Do the input files contain column names?' )
+  p.add_argument( '--header_rows',       action='store_true',                                 help='Do the input files contain row names?' )
+  p.add_argument( '--covariatesFile',    type=str, default=None,                              help='Input data file for the covariates of the new samples' )
+  p.add_argument( '--batchSize',         type=int, default=1000,                              help='Number of samples projected together' )
+  p.add_argument( '--iter',              type=int, default=100,                               help='Maximum number of iterations' )
+  p.add_argument( '--tolerance',         type=float, default=1e-6,                            help='Tolerance for convergence (based on the change in the latent variables)' )
+  args = p.parse_args(argv)
+
+  assert len(args.inFiles) == len(args.views), "Length of view names and input files does not match"
+  data_opts = {}
+  data_opts['delimiter'] = args.delimiter
+  data_opts['rownames'] = 0 if args.header_rows else None
+  data_opts['colnames'] = 0 if args.header_cols else None
+
+  # The views can have different samples, so they are not transposed as in loadData
+  new_views = {}
+  for file, view in zip(args.inFiles, args.views):
+    if isBinaryInput(file):
+      Y, index, columns = readBinaryView(file, view)
+    else:
+      Y, index, columns, stats = parseTextFile(file, data_opts)
+    new_views[view] = pd.DataFrame(Y, index=index, columns=columns, copy=False)
+    print("Loaded %s with %d samples and %d features..." % (file, Y.shape[0], Y.shape[1]))
+
+  covariates = None
+  if args.covariatesFile is not None:
+    covariates = pd.read_csv(args.covariatesFile, delimiter=" ", header=None).values
+
+  projection = project(args.model, new_views, covariates=covariates, batch_size=args.batchSize, maxiter=args.iter, tolerance=args.tolerance)
+  saveProjection(projection, args.outFile)
+  print("Saved the latent variables of %d samples in %s" % (projection['mean'].shape[0], args.outFile))
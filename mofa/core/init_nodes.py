@@ -27,6 +27,7 @@ from .nodes import *
 from .multiview_nodes import *
 from .nongaussian_nodes import *
 from .updates import *
+from .disk_views import DiskView
 
 
 class initModel(object):
@@ -53,7 +54,7 @@ class initModel(object):
         # Set the seed
         s.random.seed(seed)
 
-    def initZ(self, pmean, pvar, qmean, qvar, qE=None, qE2=None, covariates=None, scale_covariates=None):
+    def initZ(self, pmean, pvar, qmean, qvar, qE=None, qE2=None, covariates=None, scale_covariates=None, vectorised=True):
         """Method to initialise the latent variables
 
         PARAMETERS
@@ -67,6 +68,8 @@ class initModel(object):
         covariates: nd array
             matrix of covariates with dimensions (nsamples,ncovariates)
         scale_covariates: 
+        vectorised: bool
+            use the vectorised updates based on cached residuals (True) or the reference loops (False)
         """
 
         # Initialise mean of the Q distribution
@@ -87,6 +90,11 @@ class initModel(object):
 
             elif isinstance(qmean,s.ndarray):
                 assert qmean.shape == (self.N,self.K)
+                # The entries without an initial value (new samples of a warm start) are initialised randomly
+                missing = s.isnan(qmean)
+                if missing.any():
+                    qmean = qmean.copy()
+                    qmean[missing] = stats.norm.rvs(loc=0, scale=1, size=missing.sum())
 
             elif isinstance(qmean,(int,float)):
                 qmean = s.ones((self.N,self.K)) * qmean
@@ -123,14 +131,17 @@ class initModel(object):
                         qmean=s.ones((self.N,self.K))*qmean,
                         qvar=s.ones((self.N,self.K))*qvar,
                         qE=qE, qE2=qE2,
-                        idx_covariates=idx_covariates)
+                        idx_covariates=idx_covariates,
+                        vectorised=vectorised)
         self.nodes["Z"] = self.Z
 
-    def initSW(self, pmean_S0, pmean_S1, pvar_S0, pvar_S1, ptheta, qmean_S0, qmean_S1, qvar_S0, qvar_S1, qtheta, qEW_S0, qEW_S1, qES):
+    def initSW(self, pmean_S0, pmean_S1, pvar_S0, pvar_S1, ptheta, qmean_S0, qmean_S1, qvar_S0, qvar_S1, qtheta, qEW_S0, qEW_S1, qES, vectorised=True):
         """Method to initialise the spike-slab variable (product of bernoulli and gaussian variables)
 
         PARAMETERS
         ----------
+        vectorised: bool
+            use the vectorised updates based on cached sufficient statistics (True) or the reference loops (False)
         """
         SW_list = [None]*self.M
         for m in range(self.M):
@@ -168,6 +179,8 @@ class initModel(object):
                 qES=qES[m],
                 qEW_S0=qEW_S0[m],
                 qEW_S1=qEW_S1[m],
+
+                vectorised=vectorised
                 )
 
         self.SW = Multiview_Variational_Node(self.M, *SW_list)
@@ -227,7 +240,13 @@ class initModel(object):
         # Method to initialise the observed data
         Y_list = [None]*self.M
         for m in range(self.M):
-            if self.lik[m]=="gaussian":
+            if isinstance(self.data[m], DiskView):
+                # Out-of-core training, the data stay on disk
+                if self.lik[m] != "gaussian":
+                    print("Error: out-of-core training is only implemented for gaussian likelihoods")
+                    exit()
+                Y_list[m] = Y_Disk_Node(dim=(self.N,self.D[m]), value=self.data[m])
+            elif self.lik[m]=="gaussian":
                 Y_list[m] = Y_Node(dim=(self.N,self.D[m]), value=self.data[m])
             elif self.lik[m]=="poisson":
                 # tmp = stats.norm.rvs(loc=0, scale=1, size=(self.N,self.D[m]))
@@ -0,0 +1,374 @@
+"""
+Module to read a saved model lazily (Python counterpart of loadModel in MOFAtools)
+
+MOFAModel keeps the hdf5 file open and reads each dataset only when it is requested, selecting the requested factors,
+samples and features with h5py slicing, so that the rest of the file is never read. The names, the name->index lookups
+and the small arrays (options, training statistics, variance explained) are read once and memoized, the arrays that are
+requested are kept in a cache of bounded size where the least recently used ones are dropped first.
+The projection of new samples and the predictions read the saved models through it, so that the layout of the file
+(order of the views, covariates, names) is only known here.
+
+The arrays are returned with the dimensions of the model (as the nodes), not of the file where they are transposed:
+    Z: (samples,factors), SW and Theta: (features,factors), AlphaW: (factors,),
+    Y, Tau and data: (samples,features) or (features,) for the precision of the gaussian views
+The factors are selected by position, the samples and the features by name or by position.
+"""
+
+from __future__ import division
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import h5py
+
+from .utils import readNames, FACTOR_NODES
+from .training_data import trainingData
+
+
+def savedAxes(node, ndim):
+    """ Method to return the axes of a dataset saved for a node, in the order of the file
+
+    PARAMETERS
+    ----------
+    node: str
+        name of the node
+    ndim: int
+        number of dimensions of the dataset
+    """
+    if node in FACTOR_NODES:
+        return ('factors', 'samples' if node == "Z" else 'features')[:ndim]
+    if node.startswith("Alpha"):
+        return ('factors',)[:ndim]
+    return ('features', 'samples')[:ndim]
+
+def readSubset(dataset, selection):
+    """ Method to read a subset of a dataset, with one selection per axis
+
+    h5py only accepts one list of increasing indices per read: the first list is used to read the dataset
+    (as a slice if the indices are contiguous) and the other lists are applied in memory
+
+    PARAMETERS
+    ----------
+    dataset: h5py.Dataset
+    selection: list
+        ndarray of indices, in any order, or None (all) for each axis
+    """
+    if len(selection) == 0:
+        return dataset[()]
+
+    hdf5_selection, memory_selection, fancy = [], [], False
+    for indices in selection:
+        if indices is None:
+            hdf5_selection.append(slice(None))
+            memory_selection.append(slice(None))
+            continue
+        unique, inverse = np.unique(indices, return_inverse=True)
+        if len(unique) == 0:
+            hdf5_selection.append(slice(0, 0))
+            memory_selection.append(slice(None))
+        elif unique[-1] - unique[0] + 1 == len(unique):
+            hdf5_selection.append(slice(int(unique[0]), int(unique[-1])+1))
+            memory_selection.append(inverse)
+        elif not fancy:
+            hdf5_selection.append(unique)
+            memory_selection.append(inverse)
+            fancy = True
+        else:
+            hdf5_selection.append(slice(None))
+            memory_selection.append(indices)
+
+    X = dataset[tuple(hdf5_selection)]
+    # The axes are reordered one at a time, as numpy combines several index arrays elementwise
+    for axis, indices in enumerate(memory_selection):
+        if not isinstance(indices, slice):
+            X = np.take(X, indices, axis=axis)
+    return X
+
+class MOFAModel(object):
+    """ Lazy reader of a model saved by saveModel
+
+    PARAMETERS
+    ----------
+    filename: str
+        hdf5 file of the saved model
+    cache_size: float
+        maximum size in MB of the arrays kept in memory, so that the same request is only read once from the file
+        (0 to read every request from the file)
+    input_files: list
+        paths of the input files, if the training data were saved as a reference to the inputs and the files have been moved
+    """
+    def __init__(self, filename, cache_size=64., input_files=None):
+        self.filename = filename
+        self.cache_size = cache_size
+        self.input_files = input_files
+        self.file = h5py.File(filename, 'r')
+        self.format_version = int(self.file.attrs.get('format_version', 1))
+        self.cache = {}
+        self.arrays, self.arrays_size = OrderedDict(), 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ Method to close the file and clear the memoized values """
+        self.cache = {}
+        self.arrays, self.arrays_size = OrderedDict(), 0
+        self.file.close()
+
+    def cached(self, key, read):
+        """ Method to return a memoized value, calling read() if it is not in the cache """
+        if key not in self.cache:
+            self.cache[key] = read()
+        return self.cache[key]
+
+    def cachedArray(self, key, read):
+        """ Method to return an array from the cache of the least recently used arrays, calling read() if it is not in it """
+        if key in self.arrays:
+            self.arrays.move_to_end(key)
+            return self.arrays[key]
+        value = read()
+        self.arrays[key] = value
+        self.arrays_size += value.nbytes
+        while self.arrays_size > self.cache_size*2**20 and len(self.arrays) > 0:
+            self.arrays_size -= self.arrays.popitem(last=False)[1].nbytes
+        return value
+
+    # Names and dimensions
+
+    @property
+    def views(self):
+        """ View names, in the order of the file (alphabetical) """
+        return self.cached(("views",), lambda: list(self.file['parameters']['SW'].keys()))
+
+    @property
+    def likelihoods(self):
+        """ Likelihood of each view """
+        def read():
+            likelihood = [ lik.decode() for lik in self.file['model_opts']['likelihood'][()] ]
+            return dict(zip(self.views, likelihood))
+        return self.cached(("likelihoods",), read)
+
+    @property
+    def samples(self):
+        """ Sample names """
+        return self.cached(("samples",), lambda: pd.Index(readNames(self.file['samples'])))
+
+    def getFeatures(self, view):
+        """ Method to return the feature names of a view """
+        self.checkView(view)
+        return self.cached(("features",view), lambda: pd.Index(readNames(self.file['features'][view])))
+
+    @property
+    def features(self):
+        """ Feature names of each view """
+        return { view:self.getFeatures(view) for view in self.views }
+
+    @property
+    def K(self):
+        """ Number of factors, including the intercept and the covariates """
+        return self.file['parameters']['Z']['var'].shape[0]
+
+    @property
+    def covariates(self):
+        """ Indices of the covariates among the factors (including the intercept), which have a null variance """
+        return self.cached(("covariates",), lambda: np.where((self.file['parameters']['Z']['var'][()]==0).all(axis=1))[0])
+
+    @property
+    def intercept(self):
+        """ Whether the intercept is learnt (the first factor) """
+        return self.modelOpts['learnIntercept'] == "True"
+
+    def checkView(self, view):
+        assert view in self.views, "View %s is not in the model" % view
+
+    # Name->index lookups, built once
+
+    def sampleIndex(self):
+        """ Method to return the position of each sample name """
+        return self.cached(("sampleIndex",), lambda: { name:i for i,name in enumerate(self.samples) })
+
+    def featureIndex(self, view):
+        """ Method to return the position of each feature name of a view """
+        return self.cached(("featureIndex",view), lambda: { name:i for i,name in enumerate(self.getFeatures(view)) })
+
+    def indices(self, selection, size, lookup=None, axis="samples"):
+        """ Method to convert a selection of factors, samples or features into an array of positions (None for all)
+
+        PARAMETERS
+        ----------
+        selection: None, int, str, slice, boolean mask or list of ints or names
+        size: int
+            length of the dimension
+        lookup: function
+            returns the name->index dictionary of the dimension (None for the factors, which have no names)
+        axis: str
+            name of the dimension, for the error messages
+        """
+        if selection is None:
+            return None
+        if isinstance(selection, slice):
+            return np.arange(size)[selection]
+        if isinstance(selection, (str, int, np.integer)):
+            selection = [selection]
+        selection = np.asarray(selection)
+        if len(selection) == 0:
+            return np.array([], dtype=int)
+        if selection.dtype == bool:
+            assert len(selection) == size, "The boolean mask of the %s has length %d instead of %d" % (axis, len(selection), size)
+            return np.where(selection)[0]
+        if selection.dtype.kind in ('i', 'u'):
+            assert ((selection >= -size) & (selection < size)).all(), "Some %s are out of range" % axis
+            return selection % size
+        assert lookup is not None, "The %s are selected by position" % axis
+        positions = lookup()
+        missing = [ name for name in selection if str(name) not in positions ]
+        assert len(missing) == 0, "%s not in the model: %s" % (axis.capitalize(), ", ".join(map(str, missing[:10])))
+        return np.array([ positions[str(name)] for name in selection ], dtype=int)
+
+    # Arrays
+
+    def dataset(self, group, node, view=None, name="E"):
+        """ Method to return a dataset of the file, without reading it """
+        if view is not None:
+            self.checkView(view)
+            assert view in self.file[group][node], "Node %s has no %s for view %s" % (node, group, view)
+            grp = self.file[group][node][view]
+        else:
+            grp = self.file[group][node]
+        assert name in grp, "%s of node %s has no %s, the available ones are %s" % (group.capitalize(), node, name, ", ".join(grp.keys()))
+        return grp[name]
+
+    def available(self, group, node, view=None):
+        """ Method to return the names of the expectations or the parameters saved for a node (and a view) """
+        grp = self.file[group][node]
+        if view is not None:
+            self.checkView(view)
+            grp = grp[view] if view in grp else {}
+        return list(grp.keys())
+
+    def read(self, group, node, view=None, name="E", factors=None, samples=None, features=None):
+        """ Method to read a subset of an expectation or a parameter, with the dimensions of the model """
+        dataset = self.dataset(group, node, view, name)
+        axes = savedAxes(node, dataset.ndim)
+        selection = {
+            'factors': self.indices(factors, self.K, axis="factors") if 'factors' in axes else None,
+            'samples': self.indices(samples, len(self.samples), self.sampleIndex) if 'samples' in axes else None,
+            'features': self.indices(features, dataset.shape[axes.index('features')],
+                lambda: self.featureIndex(view), axis="features") if 'features' in axes else None,
+        }
+        key = (group, node, view, name) + tuple(None if selection[axis] is None else tuple(selection[axis]) for axis in axes)
+        return self.cachedArray(key, lambda: readSubset(dataset, [ selection[axis] for axis in axes ]).T)
+
+    def getExpectation(self, node, view=None, name="E", factors=None, samples=None, features=None):
+        """ Method to read an expectation of a node
+
+        PARAMETERS
+        ----------
+        node: str
+            "Z", "SW", "Theta", "AlphaW", "Tau" or "Y"
+        view: str
+            view name, for the multi-view nodes
+        name: str
+            name of the expectation ("E", or "ES" and "EW" for SW)
+        factors: int, slice, boolean mask or list of ints
+        samples: str, int, slice, boolean mask or list of names or ints
+        features: str, int, slice, boolean mask or list of names or ints
+
+        RETURNS
+        -------
+        ndarray with the dimensions of the model (see the module documentation), restricted to the selection
+        """
+        # The expectations of Y of the gaussian views are the data, which are not saved twice (see saveTrainingData)
+        if node == "Y" and name == "E" and view in self.file['expectations']['Y'] and name not in self.file['expectations']['Y'][view]:
+            return self.getData(view, samples, features).values
+        return self.read("expectations", node, view, name, factors, samples, features)
+
+    def getParameter(self, node, name, view=None, factors=None, samples=None, features=None):
+        """ Method to read a parameter of the variational distribution of a node (see getExpectation)
+
+        PARAMETERS
+        ----------
+        name: str
+            name of the parameter, for example "mean" and "var" for Z, "mean_S1", "var_S1" and "theta" for SW
+        """
+        return self.read("parameters", node, view, name, factors, samples, features)
+
+    def getFactors(self, factors=None, samples=None):
+        """ Method to return the expectation of the latent variables, pandas.DataFrame (samples,factors) """
+        Z = self.getExpectation("Z", factors=factors, samples=samples)
+        samples = self.indices(samples, len(self.samples), self.sampleIndex)
+        factors = self.indices(factors, self.K, axis="factors")
+        return pd.DataFrame(Z, index=self.samples if samples is None else self.samples[samples],
+                            columns=np.arange(self.K) if factors is None else factors)
+
+    def getWeights(self, view, factors=None, features=None):
+        """ Method to return the expectation of the weights of a view, pandas.DataFrame (features,factors) """
+        SW = self.getExpectation("SW", view, factors=factors, features=features)
+        names = self.getFeatures(view)
+        features = self.indices(features, len(names), lambda: self.featureIndex(view), axis="features")
+        factors = self.indices(factors, self.K, axis="factors")
+        return pd.DataFrame(SW, index=names if features is None else names[features],
+                            columns=np.arange(self.K) if factors is None else factors)
+
+    def getData(self, view, samples=None, features=None):
+        """ Method to return the training data of a view, pandas.DataFrame (samples,features) with nan for the missing values.
+        The data of a model saved with a reference to the inputs are loaded again from the inputs (once for all views) """
+        self.checkView(view)
+        dataset = self.cached(("trainingData",), lambda: trainingData(self.file, input_files=self.input_files, verbose=False))[view]
+        names = self.getFeatures(view)
+        samples = self.indices(samples, len(self.samples), self.sampleIndex)
+        features = self.indices(features, len(names), lambda: self.featureIndex(view), axis="features")
+        key = ("data", view) + tuple(None if x is None else tuple(x) for x in (features, samples))
+        Y = self.cachedArray(key, lambda: readSubset(dataset, [features, samples]).T)
+        return pd.DataFrame(Y, index=self.samples if samples is None else self.samples[samples],
+                            columns=names if features is None else names[features])
+
+    # Options and statistics
+
+    @property
+    def modelOpts(self):
+        """ Model options, as strings """
+        def read():
+            opts = {}
+            for k,v in self.file['model_opts'].items():
+                v = v[()]
+                opts[k] = v.decode() if isinstance(v, bytes) else [ x.decode() for x in v ]
+            return opts
+        return self.cached(("modelOpts",), read)
+
+    @property
+    def trainingOpts(self):
+        """ Training options """
+        def read():
+            dataset = self.file['training_opts']
+            opts = dict(zip([ k.decode() for k in dataset.attrs['names'] ], dataset[()]))
+            opts.update({ k:v.decode() if isinstance(v, bytes) else v for k,v in dataset.attrs.items() if k != 'names' })
+            return opts
+        return self.cached(("trainingOpts",), read)
+
+    @property
+    def trainingStats(self):
+        """ Training statistics: number of active factors and lower bound at each iteration, and its terms (pandas.DataFrame) """
+        def read():
+            grp = self.file['training_stats']
+            terms = grp['elbo_terms']
+            return { 'activeK':grp['activeK'][()], 'elbo':grp['elbo'][()],
+                     'elbo_terms':pd.DataFrame(terms[()].T, columns=[ c.decode() if isinstance(c, bytes) else c for c in terms.attrs['colnames'] ]) }
+        return self.cached(("trainingStats",), read)
+
+    @property
+    def varianceExplained(self):
+        """ Variance explained (see calculateVarianceExplained): R2 of each view, of each factor in each view
+        (pandas.DataFrame (views,factors)), and of each feature (pandas.Series for each view) """
+        def read():
+            assert 'variance_explained' in self.file, "The variance explained is not saved in %s" % self.filename
+            grp = self.file['variance_explained']
+            return {
+                'total':pd.Series({ view:grp['total'][view][()] for view in self.views }),
+                'per_factor':pd.DataFrame([ grp['per_factor'][view][()] for view in self.views ], index=self.views),
+                'per_feature':{ view:pd.Series(grp['per_feature'][view][()], index=self.getFeatures(view)) for view in self.views },
+            }
+        return self.cached(("varianceExplained",), read)
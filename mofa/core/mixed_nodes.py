@@ -64,9 +64,26 @@ class Mixed_Theta_Nodes(Variational_Node, Constant_Node):
         # the argument contains the indices of the non_annotated factors
         self.learnTheta.updateParameters(s.nonzero(self.idx)[0])
 
+    def updateStochastic(self, ro):
+        # Natural gradient step for the learnt Theta (stochastic inference)
+        old = { k:s.array(v, copy=True) for k,v in self.learnTheta.Q.getParameters().items() }
+        self.updateParameters()
+        self.learnTheta.Q.naturalGradientStep(old, ro)
+        self.updateExpectations()
+
     def calculateELBO(self):
         return self.learnTheta.calculateELBO()
 
+    def setDtype(self, dtype):
+        self.learnTheta.setDtype(dtype)
+        self.constTheta.setDtype(dtype)
+
+    def getState(self):
+        return self.learnTheta.getState()
+
+    def setState(self, state):
+        self.learnTheta.setState(state)
+
     def removeFactors(self, *idx):
         for i in idx:
             if self.idx[idx] == 1:
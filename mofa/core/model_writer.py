@@ -0,0 +1,143 @@
+"""
+Module to save the trained models in a background thread
+
+The models are handed off to the writer as soon as their trial finishes, and saved (see saveModel) while the next
+trials are training. The queue of models waiting to be saved is bounded: when it is full, the training waits for the
+writer, so that the number of trained models held in memory is bounded too.
+
+Each model is written to a temporary file, flushed to disk, checked (every dataset is read back and the latent
+variables are compared with the model) and then renamed to the output file, so that an output file is never partially
+written. At the end, the training waits until all models are written and raises the errors of the writer.
+"""
+
+from __future__ import division
+import os
+import queue
+import threading
+
+import numpy as np
+import h5py
+
+from .utils import saveModel
+
+# Groups that every model file contains
+MODEL_GROUPS = ["expectations", "parameters", "training_stats", "training_opts", "model_opts", "data", "samples", "features"]
+
+def syncFile(filename):
+    """ Method to flush a file and its directory entry to disk """
+    with open(filename, 'rb+') as f:
+        os.fsync(f.fileno())
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def verifyModel(filename, model, block_size=64.):
+    """ Method to check a saved model: all groups are present, every dataset can be read back and the latent variables
+    are the ones of the model
+
+    PARAMETERS
+    ----------
+    filename: str
+    model: a BayesNet instance
+    block_size: float
+        maximum size in MB of the blocks of rows read from the datasets
+    """
+    with h5py.File(filename, 'r') as f:
+        missing = [ group for group in MODEL_GROUPS if group not in f ]
+        assert len(missing) == 0, "%s is missing %s" % (filename, ", ".join(missing))
+
+        def read(name, obj):
+            if isinstance(obj, h5py.Dataset) and obj.shape is not None and obj.ndim > 0:
+                length = max(1, int(block_size*2**20 // max(1, obj.dtype.itemsize*np.prod(obj.shape[1:]))))
+                for j in range(0, obj.shape[0], length):
+                    obj[j:(j+length)]
+        f.visititems(read)
+
+        Z = f['expectations']['Z']['E']
+        expected = np.asarray(model.getNodes()["Z"].getExpectation()).T.astype(Z.dtype)
+        assert Z.shape == expected.shape and np.array_equal(Z[()], expected, equal_nan=True), \
+            "The latent variables saved in %s do not match the model" % filename
+
+def writeModel(model, outfile, **kwargs):
+    """ Method to save a model (see saveModel) to a temporary file that is flushed to disk, checked and renamed to the output file
+
+    PARAMETERS
+    ----------
+    model: a BayesNet instance
+    outfile: str
+    kwargs:
+        arguments of saveModel
+    """
+    tmp = "%s.%d.tmp" % (outfile, os.getpid())
+    try:
+        saveModel(model, tmp, **kwargs)
+        syncFile(tmp)
+        verifyModel(tmp, model)
+        os.replace(tmp, outfile)
+        syncFile(outfile)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+class ModelWriter(object):
+    """ Background thread that saves the models handed off by submit
+
+    PARAMETERS
+    ----------
+    maxsize: int
+        maximum number of models waiting to be saved (besides the one being written). When the queue is full,
+        submit waits until a model is written. If 0, the models are saved in the calling thread
+    """
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.errors = []
+        self.written = []
+        self.thread = None
+        if maxsize > 0:
+            self.queue = queue.Queue(maxsize=maxsize)
+            self.thread = threading.Thread(target=self.run, name="ModelWriter", daemon=True)
+            self.thread.start()
+
+    def submit(self, model, outfile, **kwargs):
+        """ Method to hand off a model to the writer (see writeModel for the arguments) """
+        self.raiseErrors()
+        if self.thread is None:
+            writeModel(model, outfile, **kwargs)
+            self.written.append(outfile)
+        else:
+            self.queue.put((model, outfile, kwargs))
+
+    def run(self):
+        """ Method of the writer thread, which saves the models in the order they are submitted """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            model, outfile, kwargs = item
+            try:
+                writeModel(model, outfile, **kwargs)
+                self.written.append(outfile)
+            except Exception as e:
+                self.errors.append((outfile, e))
+            # The model is released as soon as it is written
+            del item, model, kwargs
+            self.queue.task_done()
+
+    def raiseErrors(self):
+        """ Method to raise the first error of the writer """
+        if len(self.errors) > 0:
+            outfile, e = self.errors[0]
+            raise IOError("Saving the model in %s failed: %s" % (outfile, e))
+
+    def close(self):
+        """ Method to wait until all models are written, and raise the errors of the writer """
+        if self.thread is not None:
+            if self.queue.unfinished_tasks > 0:
+                print("Waiting for %d model(s) to be saved...\n" % self.queue.unfinished_tasks)
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.raiseErrors()
@@ -33,6 +33,7 @@ class Multiview_Node(Node):
         self.M = M
         self.activeM = [ m for m,node in enumerate(nodes) if node is not None]
         self.nodes = nodes
+        self.executor = None
 
     def addMarkovBlanket(self, **kwargs):
         """Method to define the Markov blanket"""
@@ -64,10 +65,68 @@ class Multiview_Node(Node):
         """
         for m in self.activeM: self.nodes[m].removeFactors(idx)
 
+    def setDtype(self, dtype):
+        """Method to set the floating point precision of the nodes
+
+        PARAMETERS
+        ----------
+        dtype: numpy dtype or str
+        """
+        for m in self.activeM: self.nodes[m].setDtype(dtype)
+
+    def getState(self):
+        """Method to get the state of the nodes of each view, to save a checkpoint"""
+        return { str(m):self.nodes[m].getState() for m in self.activeM }
+
+    def setState(self, state):
+        """Method to restore the state of the nodes of each view from a checkpoint
+
+        PARAMETERS
+        ----------
+        state: dict
+            state of each view, as returned by getState
+        """
+        for m in self.activeM: self.nodes[m].setState(state.get(str(m), {}))
+
     def getNodes(self):
         """Method to get the nodes"""
         return self.nodes
-        
+
+    def setExecutor(self, executor):
+        """Method to define an executor to update the views concurrently
+
+        PARAMETERS
+        ----------
+        executor: concurrent.futures.Executor or None
+            executor (i.e. a thread pool) used to update the single-view nodes. If None, the views are updated sequentially
+        """
+        self.executor = executor
+
+    def mapViews(self, fn):
+        """Method to apply a function to the single-view nodes, using the executor if defined.
+        The largest views are submitted first so that they do not delay the end of the iteration.
+
+        PARAMETERS
+        ----------
+        fn: function
+            function that takes a single-view node as input
+        """
+        if self.executor is None or len(self.activeM) < 2:
+            return [ fn(self.nodes[m]) for m in self.activeM ]
+        order = sorted(self.activeM, key=lambda m: s.prod(self.nodes[m].dim), reverse=True)
+        futures = { m:self.executor.submit(fn, self.nodes[m]) for m in order }
+        return [ futures[m].result() for m in self.activeM ]
+
+    def updateStochastic(self, ro):
+        """Method to update the nodes in stochastic variational inference
+
+        PARAMETERS
+        ----------
+        ro: float
+            step size of the natural gradient
+        """
+        self.mapViews(lambda node: node.updateStochastic(ro))
+
     def getExpectation(self):
         """Method to get the first moments (expectation)"""
         return [ self.nodes[m].getExpectation() for m in self.activeM ]
@@ -102,9 +161,10 @@ class Multiview_Variational_Node(Multiview_Node, Variational_Node):
 
     def update(self):
         """ Method to update both parameters and expectations of the node"""
-        for m in self.activeM:
-            self.nodes[m].updateParameters()
-            self.nodes[m].updateExpectations()
+        def update(node):
+            node.updateParameters()
+            node.updateExpectations()
+        self.mapViews(update)
     def updateExpectations(self):
         """Method to update expectations using current estimates of the parameters"""
         for m in self.activeM: self.nodes[m].updateExpectations()
@@ -134,7 +194,7 @@ class Multiview_Mixed_Node(Multiview_Constant_Node, Multiview_Variational_Node):
 
     def update(self):
         """Method to update values of the nodes"""
-        for m in self.activeM: self.nodes[m].update()
+        self.mapViews(lambda node: node.update())
 
     def calculateELBO(self):
         """Method to calculate variational evidence lower bound
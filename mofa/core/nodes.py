@@ -43,6 +43,11 @@ class Node(object):
         self.updateParameters()
         self.updateExpectations()
 
+    def updateStochastic(self, ro):
+        """ General method to update the node in stochastic variational inference, where 'ro' is the step size.
+        By default the node gets the full update """
+        self.update()
+
     def updateExpectations(self):
         """ General method to update the expectations of a node """
         pass
@@ -67,6 +72,18 @@ class Node(object):
         """ General function to get the parameters of the node """
         pass
 
+    def setDtype(self, dtype):
+        """ General method to set the floating point precision of the node """
+        pass
+
+    def getState(self):
+        """ General method to get the state of the node that changes during training, to save a checkpoint """
+        return {}
+
+    def setState(self, state):
+        """ General method to restore the state of the node from a checkpoint (see getState) """
+        pass
+
     def updateDim(self, axis, new_dim):
         """ Method to update the dimensionality of a node 
         PARAMETERS
@@ -95,6 +112,10 @@ class Constant_Node(Node):
         """ Method to return the values of the node """
         return self.value
 
+    def setDtype(self, dtype):
+        """ Method to cast the values of the node to a given floating point precision """
+        self.value = self.value.astype(dtype, copy=False)
+
     def getExpectation(self):
         """ Method to return the first moment of the node, which just points to the values """
         return self.getValue()
@@ -23,7 +23,7 @@ import numpy.ma as ma
 
 from .variational_nodes import Unobserved_Variational_Node
 from .nodes import Node
-from .utils import sigmoid, lambdafn
+from .utils import sigmoid, lambdafn, splitFeatures
 
 
 ##############################
@@ -32,6 +32,9 @@ from .utils import sigmoid, lambdafn
 
 class PseudoY(Unobserved_Variational_Node):
     """ General class for pseudodata nodes """
+    # The pseudodata are kept in memory
+    out_of_core = False
+
     def __init__(self, dim, obs, params=None, E=None):
         """
         PARAMETERS
@@ -54,10 +57,22 @@ class PseudoY(Unobserved_Variational_Node):
         else:
             self.params = {}
 
+        # Floating point precision of the pseudodata (None keeps the precision of the updates)
+        self.dtype = None
+
+        # Last linear predictor Z*SW', shared between the lower bound and the next update
+        self.prediction = None
+
+        # The pseudodata always cover all samples (no minibatches in stochastic inference)
+        self.scale = 1.
+
         # Create a boolean mask of the data to hidden missing values
         if type(self.obs) != ma.MaskedArray:
             self.mask()
 
+        # Split the features into fully observed features and features with missing values
+        self.complete, self.incomplete, self.observed = splitFeatures(ma.getmaskarray(self.obs))
+
         # Precompute some terms
         # self.precompute()
 
@@ -79,6 +94,26 @@ class PseudoY(Unobserved_Variational_Node):
     def getMask(self):
         return ma.getmask(self.obs)
 
+    def setDtype(self, dtype):
+        # Cast the observations and the pseudodata to the given floating point precision
+        self.dtype = s.dtype(dtype)
+        self.obs = self.obs.astype(dtype, copy=False)
+        if self.E is not None: self.E = self.E.astype(dtype, copy=False)
+
+    def update(self):
+        Unobserved_Variational_Node.update(self)
+        # Masked array arithmetic promotes to double precision, so cast the pseudodata back
+        if self.dtype is not None: self.E = self.E.astype(self.dtype, copy=False)
+
+    def getState(self):
+        # The pseudodata and their parameters are saved in checkpoints (the missing values as nan)
+        return { 'params':self.params, 'E':self.E }
+
+    def setState(self, state):
+        self.params = state.get('params', {})
+        if state.get('E') is not None:
+            self.E = state['E']
+
     def precompute(self):
         # Precompute some terms to speed up the calculations
         pass
@@ -93,6 +128,20 @@ class PseudoY(Unobserved_Variational_Node):
     def getExpectations(self):
         return { 'E':self.getExpectation() }
 
+    def getFilledExpectation(self):
+        # Return the pseudodata with the missing values set to zero
+        return ma.filled(self.E, 0.)
+
+    def getPrediction(self):
+        # Return the linear predictor Z*SW'. The lower bound is calculated at the end of each iteration and the
+        # pseudodata are updated at the start of the next one with the same Z and SW, so the product is cached
+        # together with a copy of Z and SW and only recomputed when they have changed (updates or dropped factors)
+        Z = self.markov_blanket["Z"].getExpectation()
+        SW = self.markov_blanket["SW"].getExpectation()
+        if self.prediction is None or not (s.array_equal(self.prediction[0],Z) and s.array_equal(self.prediction[1],SW)):
+            self.prediction = (Z.copy(), SW.copy(), s.dot(Z,SW.T))
+        return self.prediction[2]
+
     def getObservations(self):
         return self.obs
 
@@ -120,9 +169,7 @@ class PseudoY_Seeger(PseudoY):
         PseudoY.__init__(self, dim=dim, obs=obs, params=params, E=E)
 
     def updateParameters(self):
-        Z = self.markov_blanket["Z"].getExpectation()
-        SW = self.markov_blanket["SW"].getExpectation()
-        self.params["zeta"] = s.dot(Z,SW.T)
+        self.params["zeta"] = self.getPrediction()
 
 class Poisson_PseudoY(PseudoY_Seeger):
     """
@@ -174,10 +221,8 @@ class Poisson_PseudoY(PseudoY_Seeger):
 
     def calculateELBO(self):
         # Compute Lower Bound using the Poisson likelihood with observed data
-        Z = self.markov_blanket["Z"].getExpectation()
-        SW = self.markov_blanket["SW"].getExpectation()
-        tmp = self.ratefn(s.dot(Z,SW.T))
-        lb = s.sum( self.obs*s.log(tmp) - tmp)
+        tmp = self.ratefn(self.getPrediction())
+        lb = s.sum( self.obs*s.log(tmp) - tmp, dtype=s.float64)
         return lb
 class Bernoulli_PseudoY(PseudoY_Seeger):
     """
@@ -213,10 +258,8 @@ class Bernoulli_PseudoY(PseudoY_Seeger):
 
     def calculateELBO(self):
         # Compute Lower Bound using the Bernoulli likelihood with observed data
-        Z = self.markov_blanket["Z"].getExpectation()
-        SW = self.markov_blanket["SW"].getExpectation()
-        tmp = s.dot(Z,SW.T)
-        lik = s.sum( self.obs*tmp - s.log(1+s.exp(tmp)) )
+        tmp = self.getPrediction()
+        lik = s.sum( self.obs*tmp - s.log(1+s.exp(tmp)), dtype=s.float64 )
         return lik
 class Binomial_PseudoY(PseudoY_Seeger):
     """
@@ -260,16 +303,13 @@ class Binomial_PseudoY(PseudoY_Seeger):
 
     def calculateELBO(self):
         # Compute Lower Bound using the Bernoulli likelihood with observed data
-        Z = self.markov_blanket["Z"].getExpectation()
-        SW = self.markov_blanket["SW"].getExpectation()
-
-        tmp = sigmoid(s.dot(Z,SW.T))
+        tmp = sigmoid(self.getPrediction())
 
         # TODO change apprximation
         tmp[tmp==0] = 0.00000001
         tmp[tmp==1] = 0.99999999
-        lik = s.log(s.special.binom(self.tot,self.obs)).sum() + s.sum(self.obs*s.log(tmp)) + \
-            s.sum((self.tot-self.obs)*s.log(1-tmp))
+        lik = s.log(s.special.binom(self.tot,self.obs)).sum(dtype=s.float64) + s.sum(self.obs*s.log(tmp), dtype=s.float64) + \
+            s.sum((self.tot-self.obs)*s.log(1-tmp), dtype=s.float64)
         return lik
 
 
@@ -290,19 +330,32 @@ class Tau_Jaakkola(Node):
         else:
             assert value.shape == dim, "Dimensionality mismatch"
             self.value = value
+        self.dtype = None
 
     def updateExpectations(self):
         self.value = 2*lambdafn(self.markov_blanket["Y"].getParameters()["zeta"])
+        if self.dtype is not None: self.value = self.value.astype(self.dtype, copy=False)
 
     def getValue(self):
         return self.value
 
+    def setDtype(self, dtype):
+        self.dtype = s.dtype(dtype)
+        self.value = self.value.astype(dtype, copy=False)
+
     def getExpectation(self):
         return self.getValue()
 
     def getExpectations(self):
         return { 'E':self.getValue(), 'lnE':s.log(self.getValue()) }
 
+    def getState(self):
+        # The precision is updated from the parameters of the pseudodata at the end of each iteration
+        return { 'value':self.value }
+
+    def setState(self, state):
+        if 'value' in state: self.value = state['value']
+
     def removeFactors(self, idx, axis=None):
         pass
 class Bernoulli_PseudoY_Jaakkola(PseudoY):
@@ -340,13 +393,11 @@ class Bernoulli_PseudoY_Jaakkola(PseudoY):
     def updateParameters(self):
         Z = self.markov_blanket["Z"].getExpectations()
         SW = self.markov_blanket["SW"].getExpectations()
-        self.params["zeta"] = s.sqrt( s.square(Z["E"].dot(SW["E"].T)) - s.dot(s.square(Z["E"]),s.square(SW["E"].T)) + s.dot(Z["E2"], SW["ESWW"].T) )
+        self.params["zeta"] = s.sqrt( s.square(self.getPrediction()) - s.dot(s.square(Z["E"]),s.square(SW["E"].T)) + s.dot(Z["E2"], SW["ESWW"].T) )
         self.params["zeta"] = ma.masked_invalid(self.params["zeta"])
 
     def calculateELBO(self):
         # Compute Lower Bound using the Bernoulli likelihood with observed data
-        Z = self.markov_blanket["Z"].getExpectation()
-        SW = self.markov_blanket["SW"].getExpectation()
-        tmp = s.dot(Z,SW.T)
-        lik = ma.sum( self.obs*tmp - s.log(1+s.exp(tmp)) )
+        tmp = self.getPrediction()
+        lik = ma.sum( self.obs*tmp - s.log(1+s.exp(tmp)), dtype=s.float64 )
         return lik
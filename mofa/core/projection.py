@@ -0,0 +1,214 @@
+"""
+Module to project new samples onto a trained model
+
+The weights (SW) and the precision of the noise (Tau) of the gaussian views are read from the saved model and kept
+fixed, so that only the latent variables of the new samples are inferred: the Z updates of the training are iterated
+on the new samples, by batches, until convergence. The pseudodata of the non-gaussian views and their precision
+(Jaakkola's bound) are updated together with the latent variables.
+
+The new views have to be processed as the training data (centering and scaling). A view can be missing for some
+samples (rows of nan) or missing entirely, in which case the latent variables are inferred from the other views.
+"""
+
+from __future__ import division
+import scipy as s
+import numpy as np
+import pandas as pd
+import h5py
+
+from .init_nodes import initModel
+from .nongaussian_nodes import Tau_Jaakkola
+from .utils import writeNames
+from .load_model import MOFAModel
+
+
+def loadProjectionModel(model_file):
+    """ Method to read the quantities of a saved model required to project new samples
+
+    PARAMETERS
+    ----------
+    model_file: str
+        hdf5 file of the saved model
+
+    RETURNS
+    -------
+    dictionary with the view names, the likelihood, the feature names, the parameters of SW and the expectation of Tau
+    of each view, and the indices of the intercept and the covariates among the factors
+    """
+    model = { 'SW':{}, 'Tau':{}, 'features':{}, 'likelihood':{} }
+    with MOFAModel(model_file, cache_size=0) as saved:
+        model['views'] = saved.views
+        for view in model['views']:
+            model['likelihood'][view] = saved.likelihoods[view]
+            model['features'][view] = saved.getFeatures(view)
+            model['SW'][view] = { k:saved.getParameter("SW", k, view) for k in saved.available("parameters", "SW", view) }
+            if 'E' in saved.available("expectations", "Tau", view) and model['likelihood'][view] == "gaussian":
+                model['Tau'][view] = saved.getExpectation("Tau", view)
+
+        # The covariates have a null variance, the intercept is the first one
+        model['K'] = saved.K
+        model['covariates'] = saved.covariates
+        model['intercept'] = saved.intercept
+    return model
+
+def alignViews(model, new_views):
+    """ Method to match the samples and the features of the new views with the model
+
+    PARAMETERS
+    ----------
+    model: dic
+        output of loadProjectionModel
+    new_views: dic
+        pandas.DataFrame or ndarray with dimensions (samples,features) for each view name. The features are matched by name,
+        or by position if they have no names
+
+    RETURNS
+    -------
+    list of view names, list of ndarrays with dimensions (samples,features of the model) with nan for the missing values,
+    and the sample names
+    """
+    views = [ view for view in model['views'] if view in new_views ]
+    assert len(views) > 0, "None of the views %s is in the model" % ", ".join(new_views.keys())
+    for view in new_views:
+        if view not in model['views']: print("View %s is not in the model, it is ignored..." % view)
+
+    data = {}
+    for view in views:
+        Y = new_views[view]
+        if not isinstance(Y, pd.DataFrame): Y = pd.DataFrame(Y)
+        if isinstance(Y.columns, pd.RangeIndex):
+            assert Y.shape[1] == len(model['features'][view]), "View %s has no feature names and a different number of features than the model" % view
+            Y = Y.set_axis(model['features'][view], axis=1)
+        else:
+            Y = Y.set_axis(Y.columns.astype(str), axis=1)
+            missing = (~model['features'][view].isin(Y.columns)).sum()
+            if missing > 0: print("%d features of view %s are not in the new data, they are treated as missing values..." % (missing, view))
+        data[view] = Y
+
+    # The samples that are missing in a view are treated as missing values
+    samples = data[views[0]].index
+    for view in views[1:]:
+        samples = samples.append(data[view].index[~data[view].index.isin(samples)])
+    data = [ data[view].reindex(index=samples, columns=model['features'][view]).values.astype(float) for view in views ]
+    return views, data, samples
+
+def projectBatch(model, views, data, covariates=None, maxiter=100, tolerance=1e-6):
+    """ Method to infer the latent variables of a batch of samples with the weights fixed
+
+    PARAMETERS
+    ----------
+    model: dic
+        output of loadProjectionModel
+    views: list
+        view names of the data
+    data: list
+        ndarrays with dimensions (samples,features) for each view
+    covariates: ndarray
+        covariates of the samples (other than the intercept)
+    maxiter: int
+        maximum number of iterations
+    tolerance: float
+        the iterations stop when the maximum change in the mean of the latent variables is below this value
+
+    RETURNS
+    -------
+    mean and variance of the latent variables, ndarrays with dimensions (samples,factors)
+    """
+    M = len(views)
+    N = data[0].shape[0]
+    K = model['K']
+    dim = { 'M':M, 'N':N, 'D':s.asarray([ Y.shape[1] for Y in data ]), 'K':K }
+    lik = [ model['likelihood'][view] for view in views ]
+
+    init = initModel(dim, data, lik)
+
+    # Latent variables, with the intercept and the covariates fixed
+    idx = model['covariates']
+    if len(idx) > 0:
+        Zcovariates = s.ones((N,len(idx)))
+        if covariates is not None:
+            Zcovariates[:,int(model['intercept']):] = covariates
+    pvar = s.ones((K,))
+    pvar[idx] = s.nan
+    qvar = s.ones((K,))
+    qvar[idx] = 0.
+    init.initZ(pmean=0., pvar=pvar, qmean=0., qvar=qvar, covariates=Zcovariates if len(idx) > 0 else None, scale_covariates=[False]*len(idx))
+
+    # Weights and precision of the noise of the model
+    SW = [ model['SW'][view] for view in views ]
+    init.initSW(pmean_S0=[s.nan]*M, pmean_S1=[s.nan]*M, pvar_S0=[s.nan]*M, pvar_S1=[s.nan]*M, ptheta=[s.nan]*M,
+                qmean_S0=[ sw['mean_S0'] for sw in SW ], qmean_S1=[ sw['mean_S1'] for sw in SW ],
+                qvar_S0=[ sw['var_S0'] for sw in SW ], qvar_S1=[ sw['var_S1'] for sw in SW ], qtheta=[ sw['theta'] for sw in SW ],
+                qEW_S0=[None]*M, qEW_S1=[None]*M, qES=[None]*M)
+    init.initTau(pa=[s.nan]*M, pb=[s.nan]*M, qa=[s.nan]*M, qb=[s.nan]*M, qE=[ model['Tau'].get(view) for view in views ])
+    init.initY()
+
+    nodes = init.getNodes()
+    nodes["Z"].addMarkovBlanket(SW=nodes["SW"], Tau=nodes["Tau"], Y=nodes["Y"])
+    nodes["Y"].addMarkovBlanket(Z=nodes["Z"], SW=nodes["SW"], Tau=nodes["Tau"])
+    nodes["Tau"].addMarkovBlanket(Z=nodes["Z"], SW=nodes["SW"], Y=nodes["Y"])
+
+    # Only the latent variables, the pseudodata and the precision of Jaakkola's bound are updated
+    jaakkola = [ node for node in nodes["Tau"].getNodes() if isinstance(node, Tau_Jaakkola) ]
+    for i in range(maxiter):
+        previous = nodes["Z"].getParameters()['mean'].copy()
+        nodes["Y"].update()
+        nodes["Z"].update()
+        for node in jaakkola: node.update()
+        if s.absolute(nodes["Z"].getParameters()['mean'] - previous).max() < tolerance: break
+
+    Q = nodes["Z"].getParameters()
+    return Q['mean'], Q['var']
+
+def project(model_file, new_views, covariates=None, batch_size=1000, maxiter=100, tolerance=1e-6):
+    """ Method to infer the latent variables of new samples from a trained model, with the weights fixed
+
+    PARAMETERS
+    ----------
+    model_file: str
+        hdf5 file of the saved model
+    new_views: dic
+        pandas.DataFrame or ndarray with dimensions (samples,features) for each view name, processed as the training data.
+        The features are matched by name (or by position if they have no names) and the samples by name
+    covariates: ndarray
+        covariates of the new samples with dimensions (samples,covariates), required if the model has covariates other than the intercept
+    batch_size: int
+        number of samples projected together
+    maxiter: int
+        maximum number of iterations for each batch
+    tolerance: float
+        convergence threshold on the change in the mean of the latent variables
+
+    RETURNS
+    -------
+    dictionary with the mean and the variance of the latent variables, pandas.DataFrame with dimensions (samples,factors)
+    """
+    model = loadProjectionModel(model_file)
+    views, data, samples = alignViews(model, new_views)
+    ncovariates = len(model['covariates']) - int(model['intercept'])
+    if ncovariates > 0:
+        assert covariates is not None and covariates.shape == (len(samples),ncovariates), "The model has %d covariates, they are required for the new samples" % ncovariates
+
+    N = len(samples)
+    mean, var = s.zeros((N,model['K'])), s.zeros((N,model['K']))
+    for start in range(0, N, batch_size):
+        batch = slice(start, min(start+batch_size, N))
+        mean[batch,:], var[batch,:] = projectBatch(model, views, [ Y[batch,:] for Y in data ],
+            covariates=covariates[batch,:] if ncovariates > 0 else None, maxiter=maxiter, tolerance=tolerance)
+
+    return { 'mean':pd.DataFrame(mean, index=samples), 'var':pd.DataFrame(var, index=samples) }
+
+def saveProjection(projection, outfile):
+    """ Method to save the latent variables of the projected samples in an hdf5 file, with the layout of the model files
+
+    PARAMETERS
+    ----------
+    projection: dic
+        output of project
+    outfile: str
+    """
+    with h5py.File(outfile, 'w') as hdf5:
+        writeNames(hdf5, "samples", projection['mean'].index)
+        hdf5.create_dataset("expectations/Z/E", data=projection['mean'].values.T)
+        hdf5.create_dataset("parameters/Z/mean", data=projection['mean'].values.T)
+        hdf5.create_dataset("parameters/Z/var", data=projection['var'].values.T)
@@ -0,0 +1,204 @@
+"""
+Module to load the training data, and to read them back from a saved model
+
+The storage of the data in the model file is given by the 'storage' attribute of the group data (see saveTrainingData):
+    full: data/<view> is the processed (D,N) matrix of each view, with nan for the missing values
+    compact: data/<view> of the count and binary views is an integer matrix where the missing values have the code
+        in its 'missing' attribute, and expectations/Y/<view>/E of the gaussian views is a link to data/<view>
+    reference: there is no data/<view>, the attributes of the group data give the absolute paths of the input files,
+        their SHA-256 hashes and the data options of the processing (see dataReference), from which the data are
+        loaded and processed again (or read from the cache of preprocessed data) when they are requested
+trainingData returns the views with the same interface in the three cases: array-likes with dimensions (features,samples).
+"""
+
+from __future__ import division
+from contextlib import contextmanager, redirect_stdout
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .utils import isBinaryInput, loadBinaryData, loadData, removeIncompleteSamples, readNames, decodeIntegers
+from .disk_views import DiskView, loadDiskData
+from .cache import loadCachedData, cacheData, cachePath, hashFile, fileDigest
+
+# Data options that are required to load and process the data again
+REFERENCE_OPTIONS = ['view_names', 'delimiter', 'rownames', 'colnames', 'center_features', 'scale_views', 'scale_features',
+                     'RemoveIncompleteSamples', 'out_of_core', 'block_size', 'cache_dir', 'cache_key']
+
+@contextmanager
+def silenced(enabled=True):
+    """ Context manager discarding the messages printed on the standard output, if enabled """
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        yield
+
+def loadTrainingData(data_opts, verbose=True):
+    """ Method to load and process the training data, from the cache of preprocessed data if it is enabled
+
+    PARAMETERS
+    ----------
+    data_opts: dic
+    verbose: boolean
+        print the progress of the loading and of the data processing, as in the command line interface
+
+    RETURNS
+    -------
+    list of pandas.DataFrame (or DiskView in out-of-core training) with dimensions (samples,features)
+    """
+    # The loaders print the progress of the command line interface
+    with silenced(not verbose):
+        # Load the preprocessed observations from the cache
+        data = None
+        if data_opts.get('cache_dir') is not None:
+            data = loadCachedData(data_opts)
+
+        if data is None:
+            # Load observations (or define the views on disk)
+            if data_opts['out_of_core']:
+                data = loadDiskData(data_opts, verbose)
+            elif all([ isBinaryInput(file) for file in data_opts['input_files'] ]):
+                data = loadBinaryData(data_opts, verbose)
+            else:
+                data = loadData(data_opts, verbose)
+
+            # Remove samples with missing views
+            if data_opts['RemoveIncompleteSamples']:
+                assert not data_opts['out_of_core'], "Removing incomplete samples is not implemented for out-of-core training"
+                data = removeIncompleteSamples(data)
+
+            # Store the preprocessed observations in the cache
+            if data_opts.get('cache_dir') is not None:
+                data = cacheData(data, data_opts)
+
+    return data
+
+def dataReference(data_opts):
+    """ Method to define the reference to the training data that is saved instead of the data (see saveTrainingData)
+
+    PARAMETERS
+    ----------
+    data_opts: dic
+
+    RETURNS
+    -------
+    dictionary with the absolute paths of the input files, their SHA-256 hashes and the data options (json)
+    """
+    assert not any(data_opts.get('maskAtRandom', [0])) and not any(data_opts.get('maskNSamples', [0])), \
+        "The masked data cannot be loaded again, they have to be saved in the model file"
+    files = [ os.path.abspath(file) for file in data_opts['input_files'] ]
+    digests = { file:fileDigest(file, data_opts.get('cache_dir')) for file in set(files) }
+    options = { k:data_opts.get(k) for k in REFERENCE_OPTIONS }
+    if options['cache_dir'] is not None:
+        options['cache_dir'] = os.path.abspath(options['cache_dir'])
+    return { 'input_files':files, 'sha256':[ digests[file] for file in files ], 'data_opts':json.dumps(options) }
+
+def loadReferencedData(hdf5, input_files=None, verbose=True):
+    """ Method to load the training data of a model saved with a reference to the inputs
+
+    PARAMETERS
+    ----------
+    hdf5: h5py.File
+        saved model
+    input_files: list
+        paths of the input files, if they have been moved since the training (by default, the saved paths)
+    verbose: boolean
+        print the progress of the loading (see loadTrainingData)
+
+    RETURNS
+    -------
+    dictionary with the data of each view (pandas.DataFrame or DiskView) with dimensions (samples,features)
+    """
+    attrs = hdf5['data'].attrs
+    data_opts = json.loads(attrs['data_opts'])
+    data_opts['input_files'] = list(input_files) if input_files is not None else [ str(file) for file in attrs['input_files'] ]
+    assert len(data_opts['input_files']) == len(data_opts['view_names']), "There has to be one input file for each view"
+    data_opts['maskAtRandom'] = data_opts['maskNSamples'] = [0]*len(data_opts['view_names'])
+
+    # The preprocessed data are read from the cache if they are still there, otherwise the inputs are processed again
+    data = None
+    if data_opts['cache_dir'] is not None and data_opts['cache_key'] is not None and os.path.isfile(cachePath(data_opts)):
+        with silenced(not verbose):
+            data = loadCachedData(data_opts)
+    if data is None:
+        digests = {}
+        for file, digest in zip(data_opts['input_files'], attrs['sha256']):
+            if file not in digests: digests[file] = hashFile(file)
+            assert digests[file] == str(digest), "The input file %s has changed since the training" % file
+        data_opts['cache_dir'] = None
+        data = loadTrainingData(data_opts, verbose)
+
+    samples = readNames(hdf5['samples'])
+    for m, view in enumerate(data_opts['view_names']):
+        features = readNames(hdf5['features'][view]) if view in hdf5['features'] else None
+        assert np.array_equal(np.asarray(data[m].index.astype(str)), samples.astype(str)) and \
+            (features is None or np.array_equal(np.asarray(data[m].columns.astype(str)), features.astype(str))), \
+            "The data loaded from the inputs do not match the samples and features of view %s" % view
+    return dict(zip(data_opts['view_names'], data))
+
+class SavedView(object):
+    """ Array-like access to the training data of a view of a saved model, with dimensions (features,samples) and nan for the
+    missing values, as data/<view> in the model files. The matrices are read in double precision
+
+    PARAMETERS
+    ----------
+    data: h5py.Dataset, pandas.DataFrame or DiskView
+        data/<view> of the model file, or data loaded from the reference (with dimensions (samples,features))
+    """
+    def __init__(self, data):
+        self.data = data
+        if isinstance(data, pd.DataFrame):
+            self.values = data.values.T
+            self.shape = self.values.shape
+        else:
+            self.shape = (data.shape[1], data.shape[0]) if isinstance(data, DiskView) else data.shape
+        self.ndim = 2
+        self.dtype = np.dtype(np.float64)
+
+    def __getitem__(self, key):
+        """ Method to read a block of the matrix, with slices or arrays of indices (for one of the dimensions) """
+        if isinstance(self.data, pd.DataFrame):
+            return np.asarray(self.values[key], dtype=np.float64)
+        if not isinstance(self.data, DiskView):
+            X = self.data[key]
+            if 'missing' in self.data.attrs:
+                return decodeIntegers(X, self.data.attrs['missing'])
+            return X.astype(np.float64)
+
+        # The features of the views on disk are read as a block
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),)*(2-len(key))
+        features = np.arange(self.shape[0])[key[0]]
+        unique, inverse = np.unique(features, return_inverse=True)
+        Y, observed = self.data.readBlock(unique)
+        Y = Y.astype(np.float64)
+        Y[~observed] = np.nan
+        return Y.T[inverse][:,key[1]]
+
+def trainingData(hdf5, views=None, input_files=None, verbose=True):
+    """ Method to return the training data of a saved model, loaded again from the inputs if they were not saved
+
+    PARAMETERS
+    ----------
+    hdf5: h5py.File
+        saved model
+    views: list
+        view names (by default, all views)
+    input_files: list
+        paths of the input files of a model saved with a reference to the inputs, if they have been moved
+    verbose: boolean
+        print the progress of the loading of a model saved with a reference to the inputs
+
+    RETURNS
+    -------
+    dictionary with a SavedView with dimensions (features,samples) for each view
+    """
+    views = list(hdf5['features'].keys()) if views is None else views
+    if hdf5['data'].attrs.get('storage', "full") == "reference":
+        data = loadReferencedData(hdf5, input_files, verbose)
+    else:
+        data = hdf5['data']
+    return { view:SavedView(data[view]) for view in views }
@@ -47,6 +47,9 @@ All nodes belong to the 'Variational_Node' class. They share the following
 """
 
 class Y_Node(Constant_Variational_Node):
+    # The data are kept in memory
+    out_of_core = False
+
     def __init__(self, dim, value):
         Constant_Variational_Node.__init__(self, dim, value)
 
@@ -59,17 +62,62 @@ class Y_Node(Constant_Variational_Node):
 
     def precompute(self):
         # Precompute some terms to speed up the calculations
-        self.N = self.dim[0] - ma.getmask(self.value).sum(axis=0)
+        # The data do not change during training, so the zero-filled data, the number of observations
+        # and the sum of squares per feature are computed only once and shared by the updates.
+        # The masked array is rebuilt on top of the zero-filled data to avoid keeping two copies.
+        # Fully observed data (e.g. a memory-mapped input) and data that are already zero-filled (e.g. the views shared
+        # by the processes of parallel trials) are used as they are, without any copy.
+        mask = ma.getmaskarray(self.value)
+        filled = ma.getdata(self.value)
+        if mask.any() and filled[mask].any(): filled = ma.filled(self.value, 0.)
+        self.value = ma.array(filled, mask=mask, copy=False)
+        self.alldata = self.value
         self.D = self.dim[1]
+        self.batch, self.scale = None, 1.
+        self.computeStatistics()
+
+        # The statistics of all samples are kept, so that they are restored without a pass over the data after a minibatch
+        self.full_statistics = (self.filled, self.N, self.YY, self.likconst, self.complete, self.incomplete, self.observed)
+
+    def setMinibatch(self, ix):
+        # Restrict the data seen by the other nodes to a minibatch of samples (stochastic inference), or use all samples if ix is None.
+        # The sufficient statistics of the minibatch are rescaled to the full number of samples by 'scale'
+        self.batch = ix
+        if ix is None:
+            self.value, self.scale = self.alldata, 1.
+            self.filled, self.N, self.YY, self.likconst, self.complete, self.incomplete, self.observed = self.full_statistics
+        else:
+            self.value, self.scale = self.alldata[ix], self.alldata.shape[0]/len(ix)
+            self.computeStatistics()
+
+    def computeStatistics(self):
+        # Compute the sufficient statistics of the current data (all samples or a minibatch)
+        mask = ma.getmaskarray(self.value)
+        self.filled = ma.getdata(self.value)
+        self.N = self.value.shape[0] - mask.sum(axis=0)
+        self.YY = s.square(self.filled).sum(axis=0)
         self.likconst = -0.5*s.sum(self.N)*s.log(2.*s.pi)
 
+        # Split the features into the ones that are observed in all samples, which are updated with dense
+        # closed forms, and the ones with missing values, which are updated using the observation mask
+        self.complete, self.incomplete, self.observed = splitFeatures(mask)
+
     def mask(self):
-        # Mask the observations if they have missing values
-        self.value = ma.masked_invalid(self.value)
+        # Mask the observations if they have missing values (the data are copied only when they are zero-filled)
+        self.value = ma.masked_invalid(self.value, copy=False)
+
+    def setDtype(self, dtype):
+        # Cast the data to the given floating point precision and recompute the cached terms
+        Constant_Variational_Node.setDtype(self, dtype)
+        self.precompute()
 
     def getMask(self):
         return ma.getmask(self.value)
 
+    def getFilledExpectation(self):
+        # Return the data with the missing values set to zero
+        return self.filled
+
     def calculateELBO(self):
         # Calculate evidence lower bound
         # We use the trick that the update of Tau already contains the Gaussian likelihod.
@@ -77,9 +125,78 @@ class Y_Node(Constant_Variational_Node):
         tauQ_param = self.markov_blanket["Tau"].getParameters("Q")
         tauP_param = self.markov_blanket["Tau"].getParameters("P")
         tau_exp = self.markov_blanket["Tau"].getExpectations()
-        lik = self.likconst + 0.5*s.sum(self.N*(tau_exp["lnE"])) - s.dot(tau_exp["E"],tauQ_param["b"]-tauP_param["b"])
+        if self.batch is None:
+            lik = self.likconst + 0.5*s.sum(self.N*(tau_exp["lnE"]), dtype=s.float64) - s.dot(tau_exp["E"].astype(s.float64),tauQ_param["b"]-tauP_param["b"])
+        else:
+            # Stochastic inference: the rate parameter of Tau is a running average, so the fit of the minibatch
+            # published by the last update of Tau is used instead
+            lik = self.scale*self.likconst + 0.5*self.scale*s.sum(self.N*(tau_exp["lnE"]), dtype=s.float64) - s.dot(tau_exp["E"].astype(s.float64),self.markov_blanket["Tau"].datafit)
         return lik
 
+class Y_Disk_Node(Y_Node):
+    """ Observed data that stay on disk (out-of-core training), 'value' is a DiskView.
+    The terms of the updates that depend on the data are accumulated by streaming over blocks of features (see iterBlocks),
+    only the statistics with dimensions (D,) and (D,K) are kept in memory """
+    out_of_core = True
+
+    def __init__(self, dim, value):
+        Constant_Variational_Node.__init__(self, dim, value)
+        self.precompute()
+
+    def precompute(self):
+        # One pass over the data to compute the number of observations and the sum of squares per feature
+        self.D = self.dim[1]
+        self.batch, self.scale = None, 1.
+        self.N = s.zeros(self.D, dtype=int)
+        self.YY = s.zeros(self.D)
+        for d, Y, observed in self.iterBlocks():
+            self.N[d] = observed.sum(axis=0)
+            self.YY[d] = s.square(Y).sum(axis=0, dtype=s.float64)
+        self.likconst = -0.5*s.sum(self.N)*s.log(2.*s.pi)
+        self.complete = self.N == self.dim[0]
+        self.incomplete = s.where(~self.complete)[0]
+
+        # Cache of Y'Z: Z does not change between the update of Tau and the update of the weights in the next iteration
+        self.YZ = None
+
+    def setMinibatch(self, ix):
+        if ix is not None:
+            print("Error: stochastic variational inference is not implemented for out-of-core training")
+            exit()
+
+    def setDtype(self, dtype):
+        # The blocks are cast when they are read
+        self.value = self.value.astype(dtype)
+        self.YY = self.YY.astype(dtype)
+
+    def getExpectations(self):
+        return { 'E':self.value }
+
+    def getMask(self):
+        print("Error: the mask of the data is not kept in memory in out-of-core training")
+        exit()
+
+    def getFilledExpectation(self):
+        print("Error: the data are not kept in memory in out-of-core training")
+        exit()
+
+    def iterBlocks(self, features=None):
+        """ Method to stream over blocks of features (see DiskView.iterBlocks) """
+        return self.value.iterBlocks(features)
+
+    def cacheYZ(self, Z, YZ):
+        # Method to store Y'Z for the current expectation of Z
+        self.YZ = (Z.copy(), YZ)
+
+    def getYZ(self, Z):
+        """ Method to return Y'Z with dimensions (D,K), computed with a pass over the data unless it is cached for the same Z """
+        if self.YZ is None or not s.array_equal(self.YZ[0], Z):
+            YZ = s.empty((self.D,Z.shape[1]), dtype=s.result_type(Z,self.value.dtype))
+            for d, Y, observed in self.iterBlocks():
+                YZ[d,:] = s.dot(Y.T,Z)
+            self.cacheYZ(Z, YZ)
+        return self.YZ[1]
+
 class Tau_Node(Gamma_Unobserved_Variational_Node):
     def __init__(self, dim, pa, pb, qa, qb, qE=None):
         super(Tau_Node,self).__init__(dim=dim, pa=pa, pb=pb, qa=qa, qb=qb, qE=qE)
@@ -92,43 +209,57 @@ class Tau_Node(Gamma_Unobserved_Variational_Node):
     def updateParameters(self):
 
         # Collect expectations from other nodes
-        Y = self.markov_blanket["Y"].getExpectation().copy()
+        Y = self.markov_blanket["Y"]
         tmp = self.markov_blanket["SW"].getExpectations()
         SW,SWW = tmp["E"], tmp["ESWW"]
         Ztmp = self.markov_blanket["Z"].getExpectations()
         Z,ZZ = Ztmp["E"],Ztmp["E2"]
-        mask = ma.getmask(Y)
 
         # Collect parameters from the P and Q distributions of this node
         P,Q = self.P.getParameters(), self.Q.getParameters()
         Pa, Pb = P['a'], P['b']
 
-        # Mask matrices
-        Y = Y.data
-        Y[mask] = 0.
-
-        # Calculate terms for the update
-        # term1 = s.square(Y).sum(axis=0).data # not checked numerically with or without mask
-        term1 = s.square(Y).sum(axis=0)
-
-        # term2 = 2.*(Y*s.dot(Z,SW.T)).sum(axis=0).data
-        term2 = 2.*(Y*s.dot(Z,SW.T)).sum(axis=0) # save to modify
-
-        term3 = ma.array(ZZ.dot(SWW.T), mask=mask).sum(axis=0)
-
-        SWZ = ma.array(SW.dot(Z.T), mask=mask.T)
-
-        term4 = dotd(SWZ, SWZ.T) - ma.array(s.dot(s.square(Z),s.square(SW).T), mask=mask).sum(axis=0)
+        # Calculate terms for the update, using the precomputed sum of squares of the (zero-filled) data:
+        #   sum_n E[(y_nd - z_n'w_d)^2] = sum_n y_nd^2 - 2*y_nd*<z_n>'<w_d> + (<z_n>'<w_d>)^2
+        #                                 + sum_k <z_nk^2><s_dk*w_dk^2> - <z_nk>^2<s_dk*w_dk>^2
+        # where all sums over n only involve the observed entries.
+        # For the features that are observed in all samples the sums over n reduce to (K,K) and (K,) statistics of Z,
+        # whereas the terms of the features with missing values are computed using their observation mask
+        ZWZW = (s.dot(SW,s.dot(Z.T,Z))*SW).sum(axis=1) + s.dot(SWW,ZZ.sum(axis=0)) - s.dot(s.square(SW),s.square(Z).sum(axis=0))
+        Zmoments = s.concatenate((ZZ,s.square(Z)),axis=1)
+        if Y.out_of_core:
+            # Out-of-core training: Y'Z and the terms of the features with missing values are accumulated in a single pass over the data.
+            # Y'Z is cached for the update of the weights in the next iteration
+            YZ = s.empty((self.D,Z.shape[1]), dtype=s.result_type(Z,SW))
+            for d, Yd, observed in Y.iterBlocks():
+                YZ[d,:] = s.dot(Yd.T,Z)
+                i = ~Y.complete[d]
+                if i.any(): ZWZW[d[i]] = self.maskedFit(Z, Zmoments, SW[d[i],:], SWW[d[i],:], observed[:,i])
+            Y.cacheYZ(Z, YZ)
+        else:
+            YZ = s.dot(Y.getFilledExpectation().T,Z)
+            if len(Y.incomplete) > 0:
+                d = Y.incomplete
+                ZWZW[d] = self.maskedFit(Z, Zmoments, SW[d,:], SWW[d,:], Y.observed)
 
-        tmp = term1 - term2 + term3 + term4
+        tmp = Y.YY - 2.*(SW*YZ).sum(axis=1) + ZWZW
 
-        # Perform updates of the Q distribution
-        Qa = Pa + (Y.shape[0] - mask.sum(axis=0))/2.
-        Qb = Pb + tmp/2.
+        # Perform updates of the Q distribution, rescaling the statistics of a minibatch to the full number of samples
+        # (the scale is one when all samples are used). The fit of the data is kept for the lower bound
+        self.datafit = Y.scale*tmp/2.
+        Qa = Pa + Y.scale*Y.N/2.
+        Qb = Pb + self.datafit
 
         # Save updated parameters of the Q distribution
         self.Q.setParameters(a=Qa, b=Qb)
 
+    def maskedFit(self, Z, Zmoments, SW, SWW, observed):
+        # Method to compute sum_n E[(z_n'w_d)^2] over the observed samples of a subset of features
+        # Zmoments contains the second moments and the squared expectations of Z
+        ZW = s.dot(Z,SW.T) * observed
+        tmp = s.dot(observed.T, Zmoments)
+        return s.einsum('nd,nd->d',ZW,ZW) + (SWW*tmp[:,:Z.shape[1]]).sum(axis=1) - (s.square(SW)*tmp[:,Z.shape[1]:]).sum(axis=1)
+
     def calculateELBO(self):
         # Collect parameters and expectations from current node
         P,Q = self.P.getParameters(), self.Q.getParameters()
@@ -136,8 +267,8 @@ class Tau_Node(Gamma_Unobserved_Variational_Node):
         QE, QlnE = self.Q.expectations['E'], self.Q.expectations['lnE']
 
         # Do the calculations
-        lb_p = self.lbconst + s.sum((Pa-1.)*QlnE) - s.sum(Pb*QE)
-        lb_q = s.sum(Qa*s.log(Qb)) + s.sum((Qa-1.)*QlnE) - s.sum(Qb*QE) - s.sum(special.gammaln(Qa))
+        lb_p = self.lbconst + s.sum((Pa-1.)*QlnE, dtype=s.float64) - s.sum(Pb*QE, dtype=s.float64)
+        lb_q = s.sum(Qa*s.log(Qb), dtype=s.float64) + s.sum((Qa-1.)*QlnE, dtype=s.float64) - s.sum(Qb*QE, dtype=s.float64) - s.sum(special.gammaln(Qa), dtype=s.float64)
 
         return lb_p - lb_q
 
@@ -176,43 +307,44 @@ class AlphaW_Node_mk(Gamma_Unobserved_Variational_Node):
         QE, QlnE = self.Q.getExpectations()['E'], self.Q.getExpectations()['lnE']
 
         # Do the calculations
-        lb_p = (Pa*s.log(Pb)).sum() - special.gammaln(Pa).sum() + ((Pa-1.)*QlnE).sum() - (Pb*QE).sum()
-        lb_q = (Qa*s.log(Qb)).sum() - special.gammaln(Qa).sum() + ((Qa-1.)*QlnE).sum() - (Qb*QE).sum()
+        lb_p = (Pa*s.log(Pb)).sum(dtype=s.float64) - special.gammaln(Pa).sum(dtype=s.float64) + ((Pa-1.)*QlnE).sum(dtype=s.float64) - (Pb*QE).sum(dtype=s.float64)
+        lb_q = (Qa*s.log(Qb)).sum(dtype=s.float64) - special.gammaln(Qa).sum(dtype=s.float64) + ((Qa-1.)*QlnE).sum(dtype=s.float64) - (Qb*QE).sum(dtype=s.float64)
 
         return lb_p - lb_q
 
 class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
     # TOO MANY ARGUMENTS, SHOULD WE USE **KWARGS AND *KARGS ONLY?
     # def __init__(self, dim, pmean_S0, pmean_S1, pvar_S0, pvar_S1, ptheta, qmean_S0, qmean_S1, qvar_S0, qvar_S1, qtheta, qEW_S0=None, qEW_S1=None, qES=None):
-    def __init__(self, dim, pmean_S0, pmean_S1, pvar_S0, pvar_S1, ptheta, qmean_S0, qmean_S1, qvar_S0, qvar_S1, qtheta, qEW_S0=None, qEW_S1=None, qES=None):
+    def __init__(self, dim, pmean_S0, pmean_S1, pvar_S0, pvar_S1, ptheta, qmean_S0, qmean_S1, qvar_S0, qvar_S1, qtheta, qEW_S0=None, qEW_S1=None, qES=None, vectorised=True):
         super(SW_Node,self).__init__(dim, pmean_S0, pmean_S1, pvar_S0, pvar_S1, ptheta, qmean_S0, qmean_S1, qvar_S0, qvar_S1, qtheta, qEW_S0, qEW_S1, qES)
+        # vectorised (bool): use the update based on cached sufficient statistics (True) or the reference loop (False)
+        self.vectorised = vectorised
         self.precompute()
 
     def precompute(self):
         self.D = self.dim[0]
         self.factors_axis = 1
 
-    def updateParameters(self):
-        # Collect expectations from other nodes
+        # Maximum number of elements of the per-feature Gram tensor (features x factors x factors) kept in memory
+        self.gram_size = 2**22
+
+    def getUpdateTerms(self):
+        # Collect expectations from other nodes and prepare the terms that are shared by both update engines
         Ztmp = self.markov_blanket["Z"].getExpectations()
         Z,ZZ = Ztmp["E"],Ztmp["E2"]
-        tau = self.markov_blanket["Tau"].getExpectation().copy()
+        # The precision is rescaled to the full number of samples when the data is a minibatch (stochastic inference)
+        tau = self.markov_blanket["Y"].scale*self.markov_blanket["Tau"].getExpectation()
         Y = self.markov_blanket["Y"].getExpectation().copy()
         alpha = self.markov_blanket["Alpha"].getExpectation().copy()
         thetatmp = self.markov_blanket['Theta'].getExpectations()
         theta_lnE, theta_lnEInv  = thetatmp['lnE'], thetatmp['lnEInv']
         mask = ma.getmask(Y)
 
-        # Collect parameters and expectations from P and Q distributions of this node
-        SW = self.Q.getExpectations()["E"]
-        Q = self.Q.getParameters()
-        Qmean_S1, Qvar_S1, Qtheta = Q['mean_S1'], Q['var_S1'], Q['theta']
-
         # Check dimensions of Theta and and expand if necessary
-        if theta_lnE.shape != Qmean_S1.shape:
-            theta_lnE = s.repeat(theta_lnE[None,:],Qmean_S1.shape[0],0)
-        if theta_lnEInv.shape != Qmean_S1.shape:
-            theta_lnEInv = s.repeat(theta_lnEInv[None,:],Qmean_S1.shape[0],0)
+        if theta_lnE.shape != (self.D,self.dim[1]):
+            theta_lnE = s.repeat(theta_lnE[None,:],self.D,0)
+        if theta_lnEInv.shape != (self.D,self.dim[1]):
+            theta_lnEInv = s.repeat(theta_lnEInv[None,:],self.D,0)
 
         # Check dimensions of Tau and and expand if necessary
         if tau.shape != Y.shape:
@@ -228,6 +360,45 @@ class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
         Y[mask] = 0.
         tau[mask] = 0.
 
+        return Z, ZZ, tau, Y, alpha, theta_lnE, theta_lnEInv
+
+    def updateParameters(self):
+        if self.markov_blanket["Y"].out_of_core:
+            self.updateParametersStreaming()
+        elif self.vectorised:
+            self.updateParametersGram()
+        else:
+            self.updateParametersLoop()
+
+    def getPriorTerms(self):
+        # Collect the terms of the update that come from the prior: the ARD precision and the log odds of the sparsity parameter
+        alpha = self.markov_blanket["Alpha"].getExpectation().copy()
+        thetatmp = self.markov_blanket['Theta'].getExpectations()
+        theta_lnE, theta_lnEInv  = thetatmp['lnE'], thetatmp['lnEInv']
+        K = self.dim[1]
+
+        # Check dimensions of Theta and Alpha and expand if necessary
+        if theta_lnE.shape != (self.D,K):
+            theta_lnE = s.repeat(theta_lnE[None,:],self.D,0)
+        if theta_lnEInv.shape != (self.D,K):
+            theta_lnEInv = s.repeat(theta_lnEInv[None,:],self.D,0)
+        if alpha.shape[0] == 1:
+            alpha = s.repeat(alpha[:], K, axis=0)
+
+        # Precompute the terms that do not depend on the weights
+        term1 = theta_lnE - theta_lnEInv
+        term2 = 0.5*s.log(alpha)
+        return alpha, term1, term2
+
+    def updateParametersLoop(self):
+        # Reference implementation: the contribution of the other factors is recomputed from the data for every factor
+        Z, ZZ, tau, Y, alpha, theta_lnE, theta_lnEInv = self.getUpdateTerms()
+
+        # Collect parameters and expectations from P and Q distributions of this node
+        SW = self.Q.getExpectations()["E"]
+        Q = self.Q.getParameters()
+        Qmean_S1, Qvar_S1, Qtheta = Q['mean_S1'], Q['var_S1'], Q['theta']
+
         # Update each latent variable in turn
         for k in range(self.dim[1]):
 
@@ -261,6 +432,142 @@ class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
         # Save updated parameters of the Q distribution
         self.Q.setParameters(mean_S0=s.zeros((self.D,self.dim[1])), var_S0=s.repeat(1./alpha[None,:],self.D,0), mean_S1=Qmean_S1, var_S1=Qvar_S1, theta=Qtheta )
 
+    def updateParametersGram(self):
+        # Vectorised implementation: Z does not change while the weights are updated, so the sufficient statistics
+        #   Z'(tau*Y)                         (D,K)
+        #   ZZ'tau                            (D,K)
+        #   sum_n tau_nd * Z_nk * Z_nj        (D,K,K), the per-feature Gram matrices
+        # are computed once per sweep and the sequential updates of the factors only involve (D,K) arrays.
+        # Features that are observed in all samples and have a feature-wise precision share the Gram matrix Z'Z
+        # (scaled by tau_d), the per-feature Gram matrices are only computed for the remaining features,
+        # in blocks to bound the memory usage
+        Ynode = self.markov_blanket["Y"]
+        Ztmp = self.markov_blanket["Z"].getExpectations()
+        Z,ZZ = Ztmp["E"],Ztmp["E2"]
+        tau = Ynode.scale*self.markov_blanket["Tau"].getExpectation()
+        Y = Ynode.getFilledExpectation()
+        mask = ma.getmaskarray(Ynode.getExpectation())
+        alpha, term1, term2 = self.getPriorTerms()
+        K = self.dim[1]
+
+        if tau.shape != Y.shape:
+            # Feature-wise precision: the zero-filled data only need to be scaled by tau
+            ZtauY = tau[:,None]*s.dot(Y.T,Z)
+            dense = Ynode.complete
+        else:
+            # Sample-wise precision (Jaakkola's bound): all features are updated using the observation mask
+            tau = tau.copy()
+            tau[mask] = 0.
+            ZtauY = s.dot((tau*Y).T,Z)
+            dense = s.zeros(self.D, dtype=bool)
+
+        # Update the fully observed features, which share the Gram matrix Z'Z
+        if dense.any():
+            d = s.where(dense)[0]
+            ZZtau = tau[d,None]*ZZ.sum(axis=0)[None,:] + alpha[None,:]
+            self.updateFeatures(d, s.dot(Z.T,Z), ZtauY[d,:], ZZtau, term1[d,:], term2, tau[d])
+
+        # Update the remaining features in blocks, using their per-feature Gram matrices
+        masked = s.where(~dense)[0]
+        blocksize = max(1, self.gram_size//(K*K))
+        for start in range(0, len(masked), blocksize):
+            d = masked[start:(start+blocksize)]
+            if tau.shape != Y.shape:
+                taud = s.repeat(tau[d][None,:], Y.shape[0], axis=0)
+                taud[mask[:,d]] = 0.
+            else:
+                taud = tau[:,d]
+
+            # Per-feature Gram matrices: gram[d,k,j] = sum_n tau[n,d]*Z[n,k]*Z[n,j]
+            gram = s.empty((len(d), K, K), dtype=Z.dtype)
+            for k in range(K):
+                gram[:,k,:] = s.dot((taud*Z[:,k][:,None]).T, Z)
+
+            ZZtau = s.dot(taud.T, ZZ) + alpha[None,:]
+            self.updateFeatures(d, gram, ZtauY[d,:], ZZtau, term1[d,:], term2)
+
+        # Save updated parameters of the Q distribution
+        Q = self.Q.getParameters()
+        self.Q.setParameters(mean_S0=s.zeros((self.D,K), dtype=Q['mean_S1'].dtype), var_S0=s.repeat(1./alpha[None,:],self.D,0), mean_S1=Q['mean_S1'], var_S1=Q['var_S1'], theta=Q['theta'] )
+
+    def updateParametersStreaming(self):
+        # Out-of-core implementation of updateParametersGram: Z'(tau*Y) follows from Y'Z, which is cached by the update of Tau,
+        # and the features with missing values are streamed from disk by blocks to compute their per-feature Gram matrices
+        Ynode = self.markov_blanket["Y"]
+        Ztmp = self.markov_blanket["Z"].getExpectations()
+        Z,ZZ = Ztmp["E"],Ztmp["E2"]
+        tau = self.markov_blanket["Tau"].getExpectation()
+        alpha, term1, term2 = self.getPriorTerms()
+        K = self.dim[1]
+        ZtauY = tau[:,None]*Ynode.getYZ(Z)
+
+        # Update the fully observed features, which share the Gram matrix Z'Z
+        d = s.where(Ynode.complete)[0]
+        if len(d) > 0:
+            ZZtau = tau[d,None]*ZZ.sum(axis=0)[None,:] + alpha[None,:]
+            self.updateFeatures(d, s.dot(Z.T,Z), ZtauY[d,:], ZZtau, term1[d,:], term2, tau[d])
+
+        # Update the features with missing values block by block
+        for d, Y, observed in Ynode.iterBlocks(Ynode.incomplete):
+            taud = tau[d][None,:]*observed
+            gram = s.empty((len(d), K, K), dtype=Z.dtype)
+            for k in range(K):
+                gram[:,k,:] = s.dot((taud*Z[:,k][:,None]).T, Z)
+            ZZtau = s.dot(taud.T, ZZ) + alpha[None,:]
+            self.updateFeatures(d, gram, ZtauY[d,:], ZZtau, term1[d,:], term2)
+
+        # Save updated parameters of the Q distribution
+        Q = self.Q.getParameters()
+        self.Q.setParameters(mean_S0=s.zeros((self.D,K), dtype=Q['mean_S1'].dtype), var_S0=s.repeat(1./alpha[None,:],self.D,0), mean_S1=Q['mean_S1'], var_S1=Q['var_S1'], theta=Q['theta'] )
+
+    def updateFeatures(self, d, gram, ZtauY, ZZtau, term1, term2, tau=None):
+        """ Method to update the factors in turn for a subset of features, given their sufficient statistics
+
+        PARAMETERS
+        ----------
+        d: ndarray
+            indices of the features
+        gram: ndarray
+            Gram matrix Z'Z with dimensions (K,K), shared by all features and scaled by their precision 'tau',
+            or per-feature Gram matrices with dimensions (len(d),K,K)
+        ZtauY: ndarray
+            Z'(tau*Y) with dimensions (len(d),K)
+        ZZtau: ndarray
+            ZZ'tau plus the ARD precision, with dimensions (len(d),K)
+        term1: ndarray
+            log odds of the sparsity parameter with dimensions (len(d),K)
+        term2: ndarray
+            0.5*log(alpha) with dimensions (K,)
+        tau: ndarray
+            precision of the features, only required if 'gram' is shared
+        """
+
+        # Collect parameters and expectations from P and Q distributions of this node
+        SW = self.Q.getExpectations()["E"]
+        Q = self.Q.getParameters()
+        Qmean_S1, Qvar_S1, Qtheta = Q['mean_S1'], Q['var_S1'], Q['theta']
+
+        term3 = 0.5*s.log(ZZtau)
+        for k in range(self.dim[1]):
+            # Contribution of the other factors, excluding the current one
+            if gram.ndim == 2:
+                term4_tmp2 = tau*(s.dot(SW[d,:],gram[:,k]) - SW[d,k]*gram[k,k])
+            else:
+                term4_tmp2 = (gram[:,k,:]*SW[d,:]).sum(axis=1) - gram[:,k,k]*SW[d,k]
+            term4_tmp1 = ZtauY[:,k]
+            term4_tmp3 = ZZtau[:,k]
+            term4 = 0.5*s.divide(s.square(term4_tmp1-term4_tmp2),term4_tmp3)
+
+            # Update S
+            Qtheta[d,k] = 1./(1.+s.exp(-(term1[:,k]+term2[k]-term3[:,k]+term4)))
+
+            # Update W
+            Qvar_S1[d,k] = 1./term4_tmp3
+            Qmean_S1[d,k] = Qvar_S1[d,k]*(term4_tmp1-term4_tmp2)
+
+            # Update Expectations for the next factor
+            SW[d,k] = Qtheta[d,k] * Qmean_S1[d,k]
+
     def calculateELBO(self):
 
         # Collect parameters and expectations
@@ -269,19 +576,18 @@ class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
         Qvar = Qpar['var_S1']
         theta = self.markov_blanket['Theta'].getExpectations()
 
-        # Get ARD sparsity or prior variance
+        # Get ARD sparsity or prior variance (a single precision is broadcasted to all factors)
         if "Alpha" in self.markov_blanket:
-            alpha = self.markov_blanket['Alpha'].getExpectations().copy()
-            if alpha["E"].shape[0] == 1:
-                alpha["E"] = s.repeat(alpha["E"][:], self.dim[1], axis=0)
-                alpha["lnE"] = s.repeat(alpha["lnE"][:], self.dim[1], axis=0)
+            alpha = self.markov_blanket['Alpha'].getExpectations()
+            lnalpha = alpha["lnE"].sum(dtype=s.float64)
+            if alpha["E"].shape[0] == 1: lnalpha *= self.dim[1]
         else:
             print("Not implemented")
             exit()
 
         # Calculate ELBO for W
-        lb_pw = (self.D*alpha["lnE"].sum() - s.sum(alpha["E"]*WW))/2.
-        lb_qw = -0.5*self.dim[1]*self.D - 0.5*(S*s.log(Qvar) + (1.-S)*s.log(1./alpha["E"])).sum() # IS THE FIRST CONSTANT TERM CORRECT???
+        lb_pw = (self.D*lnalpha - s.sum(alpha["E"]*WW, dtype=s.float64))/2.
+        lb_qw = -0.5*self.dim[1]*self.D - 0.5*(S*s.log(Qvar) + (1.-S)*s.log(1./alpha["E"])).sum(dtype=s.float64) # IS THE FIRST CONSTANT TERM CORRECT???
         lb_w = lb_pw - lb_qw
 
         # Calculate ELBO for S
@@ -289,7 +595,7 @@ class SW_Node(BernoulliGaussian_Unobserved_Variational_Node):
         lb_qs = S*s.log(S) + (1.-S)*s.log(1.-S)
         lb_ps[s.isnan(lb_ps)] = 0.
         lb_qs[s.isnan(lb_qs)] = 0.
-        lb_s = s.sum(lb_ps) - s.sum(lb_qs)
+        lb_s = s.sum(lb_ps, dtype=s.float64) - s.sum(lb_qs, dtype=s.float64)
 
         return lb_w + lb_s
 
@@ -314,6 +620,11 @@ class Theta_Node(Beta_Unobserved_Variational_Node):
         self.factors_axis = 0
         self.Ppar = self.P.getParameters()
 
+    def setDtype(self, dtype):
+        # Casting replaces the parameters of the prior, so the shortcut to them is refreshed (otherwise it misses the removed factors)
+        Beta_Unobserved_Variational_Node.setDtype(self, dtype)
+        self.Ppar = self.P.getParameters()
+
     def updateParameters(self, factors_selection=None):
         # factors_selection (np array or list): indices of factors that are non-annotated
 
@@ -350,7 +661,7 @@ class Theta_Node(Beta_Unobserved_Variational_Node):
         lb_q = (Qa-1.)*QlnE + (Qb-1.)*QlnEInv - special.betaln(Qa,Qb)
         lb_q[np.isnan(lb_q)] = 0
 
-        return lb_p.sum() - lb_q.sum()
+        return lb_p.sum(dtype=s.float64) - lb_q.sum(dtype=s.float64)
 
 class Theta_Constant_Node(Constant_Variational_Node):
     """
@@ -370,6 +681,10 @@ class Theta_Constant_Node(Constant_Variational_Node):
     def getExpectations(self):
         return { 'E':self.E, 'lnE':self.lnE, 'lnEInv':self.lnEInv }
 
+    def setDtype(self, dtype):
+        Constant_Variational_Node.setDtype(self, dtype)
+        self.precompute()
+
     def removeFactors(self, idx, axis=1):
         # Ideally we want this node to use the removeFactors defined in Node()
         # but the problem is that we also need to update the "expectations", so i need
@@ -379,8 +694,10 @@ class Theta_Constant_Node(Constant_Variational_Node):
         self.updateDim(axis=axis, new_dim=self.dim[axis]-len(idx))
 
 class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
-    def __init__(self, dim, pmean, pvar, qmean, qvar, qE=None, qE2=None, idx_covariates=None):
+    def __init__(self, dim, pmean, pvar, qmean, qvar, qE=None, qE2=None, idx_covariates=None, vectorised=True):
         super(Z_Node,self).__init__(dim=dim, pmean=pmean, pvar=pvar, qmean=qmean, qvar=qvar, qE=qE, qE2=qE2)
+        # vectorised (bool): use the update based on cached residuals (True) or the reference loop (False)
+        self.vectorised = vectorised
         self.precompute()
 
         # Define indices for covariates
@@ -392,6 +709,28 @@ class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
         self.N = self.dim[0]
         self.covariates = np.zeros(self.dim[1], dtype=bool)
         self.factors_axis = 1
+        self.batch = None
+
+    def setMinibatch(self, ix):
+        # Restrict the updates and the expectations seen by the other nodes to a minibatch of samples
+        # (stochastic inference), or use all samples if ix is None
+        self.batch = ix
+
+    def getBatch(self):
+        # Method to return the index of the samples in the current minibatch
+        return slice(None) if self.batch is None else self.batch
+
+    def getExpectation(self, dist="Q"):
+        return super(Z_Node,self).getExpectation(dist)[self.getBatch(),:]
+
+    def getExpectations(self, dist="Q"):
+        expectations = super(Z_Node,self).getExpectations(dist)
+        if self.batch is None: return expectations
+        return { k:v[self.batch,:] for k,v in expectations.items() }
+
+    def updateStochastic(self, ro):
+        # The latent variables are local to each sample, so they get the optimal update for the samples of the minibatch
+        self.update()
 
     def getLvIndex(self):
         # Method to return the index of the latent variables (without covariates)
@@ -402,45 +741,63 @@ class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
         return latent_variables
 
     def updateParameters(self):
+        if any(Ynode.out_of_core for Ynode in self.markov_blanket["Y"].getNodes()):
+            self.updateParametersStreaming()
+        elif self.vectorised:
+            self.updateParametersCached()
+        else:
+            self.updateParametersLoop()
 
-        # Collect expectations from the markov blanket
+    def getUpdateTerms(self):
+        # Collect expectations from the markov blanket and prepare the terms that are shared by both update engines
         Y = deepcopy(self.markov_blanket["Y"].getExpectation())
         SWtmp = self.markov_blanket["SW"].getExpectations()
         tau = deepcopy(self.markov_blanket["Tau"].getExpectation())
-        latent_variables = self.getLvIndex() # excluding covariates from the list of latent variables
         mask = [ma.getmask(Y[m]) for m in range(len(Y))]
 
-        # Collect parameters from the prior or expectations from the markov blanket
+        # Collect parameters from the prior or expectations from the markov blanket (for the samples of the minibatch)
+        batch = self.getBatch()
         if "Mu" in self.markov_blanket:
-            Mu = self.markov_blanket['Mu'].getExpectation()
+            Mu = self.markov_blanket['Mu'].getExpectation()[batch,:]
         else:
-            Mu = self.P.getParameters()["mean"]
+            Mu = self.P.getParameters()["mean"][batch,:]
 
         if "Alpha" in self.markov_blanket:
             Alpha = self.markov_blanket['Alpha'].getExpectation()
-            Alpha = s.repeat(Alpha[None,:], self.N, axis=0)
+            Alpha = s.repeat(Alpha[None,:], Mu.shape[0], axis=0)
         else:
-            Alpha = 1./self.P.getParameters()["var"]
+            Alpha = 1./self.P.getParameters()["var"][batch,:]
+
+        # Mask Y
+        for m in range(len(Y)):
+            Y[m] = Y[m].data
+            Y[m][mask[m]] = 0.
+
+        return Y, SWtmp, tau, mask, Mu, Alpha
+
+    def updateParametersLoop(self):
+        # Reference implementation: the residuals are recomputed from the data for every factor and view
+        Y, SWtmp, tau, mask, Mu, Alpha = self.getUpdateTerms()
+        latent_variables = self.getLvIndex() # excluding covariates from the list of latent variables
+
+        N = Mu.shape[0]
 
         # Check dimensionality of Tau and expand if necessary (for Jaakola's bound only)
         for m in range(len(Y)):
             if tau[m].shape != Y[m].shape:
-                tau[m] = s.repeat(tau[m].copy()[None,:], self.N, axis=0)
+                tau[m] = s.repeat(tau[m].copy()[None,:], N, axis=0)
             # Mask tau
             # tau[m] = ma.masked_where(ma.getmask(Y[m]), tau[m]) # important to keep this out of the loop to mask non-gaussian tau
             tau[m][mask[m]] = 0.
-            # Mask Y
-            Y[m] = Y[m].data
-            Y[m][mask[m]] = 0.
 
         # Collect parameters from the P and Q distributions of this node
         Q = self.Q.getParameters().copy()
-        Qmean, Qvar = Q['mean'], Q['var']
+        Qmean, Qvar = Q['mean'][self.getBatch(),:], Q['var'][self.getBatch(),:]
 
         M = len(Y)
         for k in latent_variables:
-            foo = s.zeros((self.N,))
-            bar = s.zeros((self.N,))
+            foo = s.zeros((N,))
+            bar = s.zeros((N,))
             for m in range(M):
                 foo += np.dot(tau[m],SWtmp[m]["ESWW"][:,k])
                 bar += np.dot(tau[m]*(Y[m] - s.dot( Qmean[:,s.arange(self.dim[1])!=k] , SWtmp[m]["E"][:,s.arange(self.dim[1])!=k].T )), SWtmp[m]["E"][:,k])
@@ -448,8 +805,157 @@ class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
             Qmean[:,k] = Qvar[:,k] * (  Alpha[:,k]*Mu[:,k] + bar )
 
         # Save updated parameters of the Q distribution
+        self.setBatchParameters(Q, Qmean, Qvar)
+
+    def updateParametersStreaming(self):
+        # Out-of-core implementation of updateParametersCached: the running residuals of the features with missing values
+        # would not fit in memory, so their contribution is expressed with per-sample Gram matrices instead,
+        #   G[n,k,j] = sum_d o_nd * tau_d * <s_dk*w_dk> * <s_dj*w_dj>
+        # where o is the observation mask. The projection (tau*Y)W and the Gram matrices are accumulated in a single
+        # pass over the data, streamed from disk by blocks of features
+        Ynodes = [ self.markov_blanket["Y"].getNodes()[m] for m in self.markov_blanket["Y"].activeM ]
+        SWtmp = self.markov_blanket["SW"].getExpectations()
+        tau = self.markov_blanket["Tau"].getExpectation()
+        latent_variables = self.getLvIndex() # excluding covariates from the list of latent variables
+
+        # Collect parameters from the prior or expectations from the markov blanket
+        if "Mu" in self.markov_blanket:
+            Mu = self.markov_blanket['Mu'].getExpectation()
+        else:
+            Mu = self.P.getParameters()["mean"]
+
+        if "Alpha" in self.markov_blanket:
+            Alpha = self.markov_blanket['Alpha'].getExpectation()
+            Alpha = s.repeat(Alpha[None,:], self.N, axis=0)
+        else:
+            Alpha = 1./self.P.getParameters()["var"]
+
+        # Collect parameters from the P and Q distributions of this node
+        Q = self.Q.getParameters().copy()
+        Qmean, Qvar = Q['mean'], Q['var']
+        N, K = Qmean.shape
+
+        foo = s.zeros((N,K), dtype=Qmean.dtype)
+        proj = s.zeros((N,K), dtype=Qmean.dtype)
+        gram = s.zeros((K,K), dtype=Qmean.dtype)
+        G = None
+        for m in range(len(Ynodes)):
+            SW, SWW = SWtmp[m]["E"], SWtmp[m]["ESWW"]
+            complete = Ynodes[m].complete
+
+            # Fully observed features: shared Gram matrix
+            taum = tau[m]*complete
+            foo += s.dot(taum,SWW)[None,:]
+            gram += s.dot(SW.T, taum[:,None]*SW)
+
+            for d, Y, observed in Ynodes[m].iterBlocks():
+                tauSW = tau[m][d,None]*SW[d,:]
+                proj += s.dot(Y, tauSW)
+
+                # Features with missing values: per-sample Gram matrices
+                i = ~complete[d]
+                if not i.any(): continue
+                if G is None: G = s.zeros((N,K,K), dtype=Qmean.dtype)
+                di = d[i]
+                foo += s.dot(observed[:,i], tau[m][di,None]*SWW[di,:])
+                for k in range(K):
+                    G[:,k,:] += s.dot(observed[:,i]*tauSW[i,k][None,:], SW[di,:])
+
+        for k in latent_variables:
+            bar = proj[:,k] - s.dot(Qmean,gram[:,k]) + Qmean[:,k]*gram[k,k]
+            if G is not None:
+                bar -= (G[:,k,:]*Qmean).sum(axis=1) - Qmean[:,k]*G[:,k,k]
+            Qvar[:,k] = 1./(Alpha[:,k]+foo[:,k])
+            Qmean[:,k] = Qvar[:,k] * (  Alpha[:,k]*Mu[:,k] + bar )
+
+        # Save updated parameters of the Q distribution
+        self.Q.setParameters(mean=Qmean, var=Qvar)
+
+    def setBatchParameters(self, Q, Qmean, Qvar):
+        # Method to save the updated parameters of the Q distribution, which only cover the samples of the minibatch
+        if self.batch is not None:
+            Q['mean'][self.batch,:], Q['var'][self.batch,:] = Qmean, Qvar
+            Qmean, Qvar = Q['mean'], Q['var']
         self.Q.setParameters(mean=Qmean, var=Qvar)
 
+    def updateParametersCached(self):
+        # Vectorised implementation: the weights do not change while the latent variables are updated, so the
+        # contribution of each view is cached once per sweep and corrected after each factor update:
+        # - features without missing values and with feature-wise precision: the projection (tau*Y)W (N,K) and the
+        #   Gram matrix W'diag(tau)W (K,K), so that the residual of each factor only involves (N,K) arrays
+        # - features with missing values or with a sample-wise precision: a running residual Y-ZW',
+        #   which is corrected with a rank-1 update after each factor
+        Ynodes = [ self.markov_blanket["Y"].getNodes()[m] for m in self.markov_blanket["Y"].activeM ]
+        SWtmp = self.markov_blanket["SW"].getExpectations()
+        tau = self.markov_blanket["Tau"].getExpectation()
+        latent_variables = self.getLvIndex() # excluding covariates from the list of latent variables
+
+        # Collect parameters from the prior or expectations from the markov blanket (for the samples of the minibatch)
+        batch = self.getBatch()
+        if "Mu" in self.markov_blanket:
+            Mu = self.markov_blanket['Mu'].getExpectation()[batch,:]
+        else:
+            Mu = self.P.getParameters()["mean"][batch,:]
+
+        if "Alpha" in self.markov_blanket:
+            Alpha = self.markov_blanket['Alpha'].getExpectation()
+            Alpha = s.repeat(Alpha[None,:], Mu.shape[0], axis=0)
+        else:
+            Alpha = 1./self.P.getParameters()["var"][batch,:]
+
+        # Collect parameters from the P and Q distributions of this node
+        Q = self.Q.getParameters().copy()
+        Qmean, Qvar = Q['mean'][self.getBatch(),:], Q['var'][self.getBatch(),:]
+        N = Qmean.shape[0]
+
+        M = len(Ynodes)
+        foo = s.zeros((N,self.dim[1]), dtype=Qmean.dtype)
+        gram, proj = [None]*M, [None]*M
+        res, taures, SWres, tauW2 = [None]*M, [None]*M, [None]*M, [None]*M
+        for m in range(M):
+            Y = Ynodes[m].getFilledExpectation()
+            SW, SWW = SWtmp[m]["E"], SWtmp[m]["ESWW"]
+            if tau[m].shape != Y.shape:
+                # Fully observed features: projection and Gram matrix, the other features get a zero weight
+                taum = tau[m]*Ynodes[m].complete
+                foo += s.dot(taum,SWW)[None,:]
+                proj[m] = s.dot(Y, taum[:,None]*SW)
+                gram[m] = s.dot(SW.T, taum[:,None]*SW)
+
+                # Features with missing values
+                d = Ynodes[m].incomplete
+                if len(d) == 0: continue
+                Y, SW, SWW = Y[:,d], SW[d,:], SWW[d,:]
+                taures[m] = s.repeat(tau[m][d][None,:], N, axis=0) * Ynodes[m].observed
+            else:
+                # Sample-wise precision (Jaakkola's bound): all features are updated using the running residual
+                taures[m] = tau[m].copy()
+                taures[m][ma.getmaskarray(Ynodes[m].getExpectation())] = 0.
+
+            foo += s.dot(taures[m],SWW)
+            res[m] = Y - s.dot(Qmean,SW.T)
+            tauW2[m] = s.dot(taures[m],s.square(SW))
+            SWres[m] = SW
+
+        for k in latent_variables:
+            bar = s.zeros((N,), dtype=Qmean.dtype)
+            for m in range(M):
+                if gram[m] is not None:
+                    bar += proj[m][:,k] - s.dot(Qmean,gram[m][:,k]) + Qmean[:,k]*gram[m][k,k]
+                if res[m] is not None:
+                    bar += s.dot(taures[m]*res[m],SWres[m][:,k]) + Qmean[:,k]*tauW2[m][:,k]
+            Qvar[:,k] = 1./(Alpha[:,k]+foo[:,k])
+            Qmean_k = Qvar[:,k] * (  Alpha[:,k]*Mu[:,k] + bar )
+
+            # Rank-1 correction of the running residuals
+            for m in range(M):
+                if res[m] is not None:
+                    res[m] -= s.outer(Qmean_k-Qmean[:,k], SWres[m][:,k])
+            Qmean[:,k] = Qmean_k
+
+        # Save updated parameters of the Q distribution
+        self.setBatchParameters(Q, Qmean, Qvar)
+
     def calculateELBO(self):
         # Collect parameters and expectations of current node
         Qpar,Qexp = self.Q.getParameters(), self.Q.getExpectations()
@@ -469,24 +975,26 @@ class Z_Node(UnivariateGaussian_Unobserved_Variational_Node):
             Alpha = { 'E':1./self.P.getParameters()["var"], 'lnE':s.log(1./self.P.getParameters()["var"]) }
 
         # This ELBO term contains only cross entropy between Q and P,and entropy of Q. So the covariates should not intervene at all
+        # In stochastic inference only the samples of the minibatch are used and the terms are rescaled to the full number of samples
         latent_variables = self.getLvIndex()
-        Alpha["E"], Alpha["lnE"] = Alpha["E"][:,latent_variables], Alpha["lnE"][:,latent_variables]
-        Qmean, Qvar = Qmean[:, latent_variables], Qvar[:, latent_variables]
-        PE, PE2 = PE[:, latent_variables], PE2[:, latent_variables]
-        QE, QE2 = QE[:, latent_variables], QE2[:, latent_variables]
+        batch = self.getBatch()
+        Alpha["E"], Alpha["lnE"] = Alpha["E"][batch,:][:,latent_variables], Alpha["lnE"][batch,:][:,latent_variables]
+        Qmean, Qvar = Qmean[batch,:][:,latent_variables], Qvar[batch,:][:,latent_variables]
+        PE, PE2 = PE[batch,:][:,latent_variables], PE2[batch,:][:,latent_variables]
+        QE, QE2 = QE[batch,:][:,latent_variables], QE2[batch,:][:,latent_variables]
 
         # compute term from the exponential in the Gaussian
         tmp1 = 0.5*QE2 - PE*QE + 0.5*PE2
-        tmp1 = -(tmp1 * Alpha['E']).sum()
+        tmp1 = -(tmp1 * Alpha['E']).sum(dtype=s.float64)
 
         # compute term from the precision factor in front of the Gaussian
-        tmp2 = 0.5*Alpha["lnE"].sum()
+        tmp2 = 0.5*Alpha["lnE"].sum(dtype=s.float64)
 
         lb_p = tmp1 + tmp2
         # lb_q = -(s.log(Qvar).sum() + self.N*self.dim[1])/2. # I THINK THIS IS WRONG BECAUSE SELF.DIM[1] ICNLUDES COVARIATES
-        lb_q = -(s.log(Qvar).sum() + self.N*len(latent_variables))/2.
+        lb_q = -(s.log(Qvar).sum(dtype=s.float64) + Qvar.shape[0]*len(latent_variables))/2.
 
-        return lb_p-lb_q
+        return (lb_p-lb_q) if self.batch is None else (lb_p-lb_q)*self.N/len(self.batch)
 
 class MuZ_Node(UnivariateGaussian_Unobserved_Variational_Node):
     """ """
@@ -556,11 +1064,11 @@ class MuZ_Node(UnivariateGaussian_Unobserved_Variational_Node):
         Qvar = Qvar[:, latent_variables]
 
         # minus cross entropy
-        tmp = -(0.5 * s.log(PVar)).sum()
-        tmp2 = - ((0.5/PVar) * (QE2 - 2.*QE*Pmean + Pmean**2.)).sum()
+        tmp = -(0.5 * s.log(PVar)).sum(dtype=s.float64)
+        tmp2 = - ((0.5/PVar) * (QE2 - 2.*QE*Pmean + Pmean**2.)).sum(dtype=s.float64)
 
         # entropy of Q
-        tmp3 = 0.5 * (s.log(Qvar)).sum()
+        tmp3 = 0.5 * (s.log(Qvar)).sum(dtype=s.float64)
         tmp3 += 0.5 * self.dim[0] * len(latent_variables)
 
         return tmp + tmp2 + tmp3
@@ -1,5 +1,7 @@
 from __future__ import division
 from time import sleep
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -7,6 +9,8 @@ import numpy.ma as ma
 import os
 import h5py
 
+from .disk_views import DiskView
+
 """
 Module to define some useful util functions
 """
@@ -81,91 +85,442 @@ def maskData(data, data_opts):
 
     return data
 
-# Function to load the data
-def loadData(data_opts, verbose=True):
-    """ Method to load the data
-    
+def isGzipped(file):
+    """ Method to check if a file is compressed with gzip, from its magic number """
+    with open(file, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+def countLines(file, block_size=2**24):
+    """ Method to count the lines of an uncompressed text file with a fast pass over its bytes, without parsing it """
+    nlines, last = 0, b'\n'
+    with open(file, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            nlines += block.count(b'\n')
+            last = block[-1:]
+            block = f.read(block_size)
+    # The last line may not end with a newline character
+    return nlines + (last != b'\n')
+
+def columnStatistics(Y):
+    """ Method to compute the number of observations, the mean and the sum of squared deviations of each column of a matrix,
+    ignoring the missing values. The moments are accumulated in double precision
+
+    PARAMETERS
+    ----------
+    Y: ndarray with dimensions (N,D)
+    """
+    observed = ~np.isnan(Y)
+    nobs = observed.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(Y, axis=0, dtype=np.float64) / nobs
+    m2 = np.nansum(np.square(Y - mean), axis=0, dtype=np.float64)
+    mean[nobs==0] = 0.
+    return nobs, mean, m2
+
+def mergeStatistics(a, b):
+    """ Method to merge the column statistics of two blocks of rows (Chan et al. parallel algorithm)
+
     PARAMETERS
     ----------
+    a, b: tuple
+        (nobs, mean, m2) of each block, as returned by columnStatistics
+    """
+    nobs = a[0] + b[0]
+    delta = b[1] - a[1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(nobs>0, b[0]/nobs, 0.)
+    mean = a[1] + delta*weight
+    m2 = a[2] + b[2] + np.square(delta)*a[0]*weight
+    return nobs, mean, m2
+
+def parseTextFile(file, data_opts, chunk_size=64.):
+    """ Method to parse a text file in chunks of rows into a single precision matrix,
+    computing the statistics of each column in the same pass
+
+    The matrix of an uncompressed file is preallocated from a fast count of its lines. A compressed file is only
+    decompressed once: its chunks are kept and copied into the matrix at the end of the parse
+
+    PARAMETERS
+    ----------
+    file: str
+        path to the file, which can be compressed with gzip
     data_opts: dic
-    verbose: boolean
+    chunk_size: float
+        approximate size of each parsed chunk in MB
+
+    RETURNS
+    -------
+    Y: ndarray with dimensions (N,D)
+    index: pandas.Index with the row names
+    columns: pandas.Index with the column names
+    stats: tuple with the number of observations, the mean and the sum of squared deviations of each column
     """
-    
-    print ("\n")
-    print ("#"*18)
-    print ("## Loading data ##")
-    print ("#"*18)
-    print ("\n")
-    sleep(1)
+    gzipped = isGzipped(file)
 
-    M = len(data_opts['input_files'])
+    reader = pd.read_csv(file, delimiter=data_opts["delimiter"], header=data_opts["colnames"], index_col=data_opts["rownames"],
+        compression='gzip' if gzipped else None, iterator=True)
 
-    Y =  [None]*M
-    for m in range(M):
+    # The first chunk defines the number of columns, and the size of the next chunks.
+    # The matrix is stored by columns, as the data frames parsed by pandas
+    chunk = reader.get_chunk(1000)
+    columns, index, blocks = chunk.columns, [], []
+    if gzipped:
+        Y = None
+    else:
+        # Upper bound on the number of rows, the matrix is trimmed after the parse if there are blank lines
+        nrows = countLines(file) - (data_opts["colnames"] is not None)
+        Y = np.empty((nrows, chunk.shape[1]), dtype=np.float32, order='F')
+    rows = max(1, int(chunk_size*2**20 // (8*max(1,chunk.shape[1]))))
+    stats, n = None, 0
+    while chunk is not None:
+        # Each chunk is parsed in double precision and copied into the matrix (or kept in single precision)
+        if Y is None:
+            block = chunk.values.astype(np.float32)
+            blocks.append(block)
+        else:
+            Y[n:(n+chunk.shape[0]),:] = chunk.values
+            block = Y[n:(n+chunk.shape[0]),:]
+        index.append(chunk.index)
+        chunk_stats = columnStatistics(block)
+        stats = chunk_stats if stats is None else mergeStatistics(stats, chunk_stats)
+        n += chunk.shape[0]
+        try:
+            chunk = reader.get_chunk(rows)
+        except StopIteration:
+            chunk = None
+    reader.close()
+
+    if Y is None:
+        Y, start = np.empty((n, len(columns)), dtype=np.float32, order='F'), 0
+        while blocks:
+            block = blocks.pop(0)
+            Y[start:(start+block.shape[0]),:] = block
+            start += block.shape[0]
+
+    return Y[:n,:], index[0].append(index[1:]), columns, stats
+
+def featureProcessing(nobs, mean, var, data_opts, m):
+    """ Method to define the data processing of a view from the statistics of its features:
+    features with all values missing or with zero variance are removed, and the remaining ones are centered and scaled
 
-        # Read file
-        file = data_opts['input_files'][m]
-        Y[m] = pd.read_csv(file, delimiter=data_opts["delimiter"], header=data_opts["colnames"], index_col=data_opts["rownames"]).astype(pd.np.float32)
+    PARAMETERS
+    ----------
+    nobs: ndarray
+        number of observations of each feature
+    mean: ndarray
+        mean of each feature
+    var: ndarray
+        variance of each feature (with the sample size as denominator)
+    data_opts: dic
+    m: int
+        index of the view
+
+    RETURNS
+    -------
+    keep: ndarray with the indices of the features that are kept
+    center: ndarray or float, value subtracted from each kept feature
+    scale: ndarray or float, value that divides each kept feature (after centering)
+    """
 
-        # Y[m] = pd.read_csv(file, delimiter=data_opts["delimiter"])
-        print("Loaded %s with %d samples and %d features)..." % (file, Y[m].shape[0], Y[m].shape[1]))
+    # Removing features with complete missing values or no variance
+    if np.any(nobs==0):
+        print("Warning: %d features(s) on view %d have missing values in all samples, removing them..." % ( (nobs==0).sum(), m) )
+    if np.any((nobs>1) & (var==0.)):
+        print("Warning: %d features(s) on view %d have zero variance, removing them..." % ( ((nobs>1) & (var==0.)).sum(),m) )
+    keep = np.where((nobs>0) & ~((nobs>1) & (var==0.)))[0]
+    nobs, mean, var = nobs[keep], mean[keep], var[keep]
+    center, scale = 0., 1.
+
+    # Center the features
+    if data_opts['center_features'][m]:
+        print("Centering features for view " + str(m) + "...")
+        center = mean
+
+    # Scale the views to unit variance
+    if data_opts['scale_views'][m]:
+        print("Scaling view " + str(m) + " to unit variance...")
+        sumsq = (nobs*(var + np.square(mean - center))).sum()
+        total = (nobs*(mean - center)).sum()
+        scale = np.sqrt(sumsq/nobs.sum() - np.square(total/nobs.sum()))
+
+    # Scale the features to unit variance
+    if data_opts['scale_features'][m]:
+        print("Scaling features for view " + str(m) + " to unit variance...")
+        scale = np.sqrt(var)
+
+    return keep, center, scale
+
+def readTextFiles(data_opts):
+    """ Method to parse the text inputs without any processing.
+    The views are parsed concurrently (the parser of pandas releases the GIL), each one with parseTextFile
+
+    PARAMETERS
+    ----------
+    data_opts: dic
+        data_opts['load_threads'] is the number of views parsed concurrently (by default, all of them)
 
-        # Checking missing values on features
-        # print max(np.isnan(Y[m]).mean(axis=1))
-        # exit()
+    RETURNS
+    -------
+    lists with the matrix, the row names, the column names and the column statistics of each view, with the samples in the rows
+    """
+    M = len(data_opts['input_files'])
 
-        # Checking missing values on samples
-        # print np.isnan(Y[m]).mean(axis=1)
-        # exit()
+    nthreads = data_opts.get('load_threads') or min(M, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        parsed = list(executor.map(lambda file: parseTextFile(file, data_opts), data_opts['input_files']))
+    Y, index, columns, stats = [list(x) for x in zip(*parsed)]
+    for m in range(M):
+        print("Loaded %s with %d samples and %d features)..." % (data_opts['input_files'][m], Y[m].shape[0], Y[m].shape[1]))
 
     # Check that the dimensions match
     if len(set([Y[m].shape[0] for m in range(M)])) != 1:
         if all([Y[m].shape[1] for m in range(M)]):
             print("\nColumns seem to be the shared axis, transposing the data...")
-            for m in range(M): Y[m] = Y[m].T
+            for m in range(M):
+                Y[m], index[m], columns[m] = Y[m].T, columns[m], index[m]
+                stats[m] = columnStatistics(Y[m])
         else:
             print("\nDimensionalities do not match, aborting. Make sure that either columns or rows are shared!")
             exit()
 
+    return Y, index, columns, stats
+
+def processViews(Y, index, columns, stats, data_opts):
+    """ Method to apply the data processing (see featureProcessing) to the views and wrap them in data frames.
+    The processing is applied in place, a matrix is only copied if features are removed
+
+    PARAMETERS
+    ----------
+    Y: list of ndarrays with dimensions (N,D)
+    index: list of pandas.Index with the sample names
+    columns: list of pandas.Index with the feature names
+    stats: list of tuples with the number of observations, the mean and the sum of squared deviations of each feature
+    data_opts: dic
+    """
+
     # TO-DO: CHECK IF ANY SAMPLE HAS MISSING VALUES IN ALL VIEWS 
 
     # Sanity checks on the data
     print ("\n" +"#"*46)
     print("## Doing sanity checks and parsing the data ##")
     print ("#"*46 + "\n")
+    M = len(Y)
+    data = [None]*M
+    data_opts['dropped_features'] = [None]*M
     for m in range(M):
-
-        # Removing features with complete missing values
-        nas = np.isnan(Y[m]).mean(axis=0)
-        if np.any(nas==1.):
-            print("Warning: %d features(s) on view %d have missing values in all samples, removing them..." % ( (nas==1.).sum(), m) )
-            Y[m].drop(Y[m].columns[np.where(nas==1.)], axis=1, inplace=True)
-
-        # Removing features with no variance
-        var = Y[m].std(axis=0) 
-        if np.any(var==0.):
-            print("Warning: %d features(s) on view %d have zero variance, removing them..." % ( (var==0.).sum(),m) )
-            Y[m].drop(Y[m].columns[np.where(var==0.)], axis=1, inplace=True)
-
-        # Center the features
-        if data_opts['center_features'][m]:
-            print("Centering features for view " + str(m) + "...")
-            Y[m] = (Y[m] - Y[m].mean(axis=0))
-
-        # Scale the views to unit variance
-        if data_opts['scale_views'][m]:
-            print("Scaling view " + str(m) + " to unit variance...")
-            Y[m] = Y[m] / np.nanstd(Y[m].as_matrix())
-
-        # Scale the features to unit variance
-        if data_opts['scale_features'][m]:
-            print("Scaling features for view " + str(m) + " to unit variance...")
-            Y[m] = Y[m] / np.std(Y[m], axis=0, )
+        nobs, mean, m2 = stats[m]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = m2 / nobs
+        keep, center, scale = featureProcessing(nobs, mean, var, data_opts, m)
+
+        # The names of the removed features are kept in data_opts['dropped_features']
+        data_opts['dropped_features'][m] = columns[m].delete(keep)
+        if len(keep) < Y[m].shape[1]:
+            Y[m], columns[m] = Y[m][:,keep], columns[m][keep]
+        # The memory-mapped inputs are not touched if the data is used as it is
+        if np.any(np.asarray(center) != 0.):
+            Y[m] -= np.asarray(center, dtype=Y[m].dtype)
+        if np.any(np.asarray(scale) != 1.):
+            Y[m] /= np.asarray(scale, dtype=Y[m].dtype)
+        data[m] = pd.DataFrame(Y[m], index=index[m], columns=columns[m], copy=False)
 
     print("\nAfter data processing:")
-    for m in range(M): print("view %d has %d samples and %d features..." % (m, Y[m].shape[0], Y[m].shape[1]))
+    for m in range(M): print("view %d has %d samples and %d features..." % (m, data[m].shape[0], data[m].shape[1]))
 
-    return Y
+    return data
+
+# Function to load the data
+def loadData(data_opts, verbose=True):
+    """ Method to load the data from text files.
+    The views are parsed concurrently, each one in chunks of rows into a preallocated single precision matrix,
+    and the statistics required by the data processing are computed during the parse
+
+    PARAMETERS
+    ----------
+    data_opts: dic
+    verbose: boolean
+        print the banner of the command line interface
+    """
+
+    if verbose:
+        print ("\n")
+        print ("#"*18)
+        print ("## Loading data ##")
+        print ("#"*18)
+        print ("\n")
+        sleep(1)
+
+    Y, index, columns, stats = readTextFiles(data_opts)
+    return processViews(Y, index, columns, stats, data_opts)
+
+def isBinaryInput(file):
+    """ Method to check if an input file is in one of the binary formats (.npy or HDF5), from its extension """
+    return os.path.splitext(file)[1].lower() in ('.npy', '.h5', '.hdf5')
+
+def memoryMap(filename, dataset=None):
+    """ Method to map a matrix stored in a binary file into memory, without reading it.
+    The mapping is copy-on-write: the data processing can modify it in place without changing the file.
+    HDF5 datasets can only be mapped if they are contiguous and uncompressed (as written by writeBinaryData),
+    otherwise they are read into memory
+
+    PARAMETERS
+    ----------
+    filename: str
+        path to a .npy file or an HDF5 file
+    dataset: str
+        name of the dataset in the HDF5 file
+    """
+    if dataset is None:
+        return np.load(filename, mmap_mode='c')
+    with h5py.File(filename, 'r') as f:
+        data = f[dataset]
+        offset = data.id.get_offset()
+        if data.chunks is not None or data.compression is not None or offset is None:
+            return data[()]
+        shape, dtype = data.shape, data.dtype
+    return np.memmap(filename, dtype=dtype, mode='c', offset=offset, shape=shape)
+
+def readBinaryView(file, view):
+    """ Method to memory-map a view from a binary file, with its sample and feature names
+
+    PARAMETERS
+    ----------
+    file: str
+        path to a .npy file (without names) or an HDF5 file with the layout described in disk_views
+    view: str
+        name of the view in the HDF5 file
+
+    RETURNS
+    -------
+    Y: ndarray with dimensions (N,D)
+    index: pandas.Index with the sample names
+    columns: pandas.Index with the feature names
+    """
+    index, columns = None, None
+    if file.lower().endswith('.npy'):
+        Y = memoryMap(file)
+    else:
+        Y = memoryMap(file, "data/"+view)
+        with h5py.File(file, 'r') as f:
+            if 'samples' in f: index = pd.Index(readNames(f['samples']))
+            if 'features' in f and view in f['features']: columns = pd.Index(readNames(f['features'][view]))
+    if index is None: index = pd.RangeIndex(Y.shape[0])
+    if columns is None: columns = pd.RangeIndex(Y.shape[1])
+    return Y, index, columns
+
+def blockStatistics(Y, block_size=64.):
+    """ Method to compute the column statistics (see columnStatistics) of a matrix by blocks of rows,
+    so that a memory-mapped matrix is read once and never entirely in memory
+
+    PARAMETERS
+    ----------
+    Y: ndarray with dimensions (N,D)
+    block_size: float
+        approximate size of each block in MB
+    """
+    rows = max(1, int(block_size*2**20 // (Y.dtype.itemsize*max(1,Y.shape[1]))))
+    stats = None
+    for n in range(0, max(1,Y.shape[0]), rows):
+        block_stats = columnStatistics(Y[n:(n+rows),:])
+        stats = block_stats if stats is None else mergeStatistics(stats, block_stats)
+    return stats
+
+def loadBinaryData(data_opts, verbose=True):
+    """ Method to load the data from binary files, which are memory-mapped instead of parsed.
+    The inputs are either one .npy file per view with dimensions (samples,features), or a single HDF5 file
+    with the layout described in disk_views (data/<view>, samples and features/<view>)
+
+    PARAMETERS
+    ----------
+    data_opts: dic
+    verbose: boolean
+        print the banner of the command line interface
+    """
+
+    if verbose:
+        print ("\n")
+        print ("#"*18)
+        print ("## Loading data ##")
+        print ("#"*18)
+        print ("\n")
+        sleep(1)
+
+    M = len(data_opts['input_files'])
+    Y, index, columns = [None]*M, [None]*M, [None]*M
+    for m in range(M):
+        file = data_opts['input_files'][m]
+        Y[m], index[m], columns[m] = readBinaryView(file, data_opts['view_names'][m])
+        print("Loaded %s with %d samples and %d features)..." % (file, Y[m].shape[0], Y[m].shape[1]))
+
+    # Check that the dimensions match
+    if len(set([Y[m].shape[0] for m in range(M)])) != 1:
+        print("\nThe number of samples does not match between the views, aborting. The matrices must have dimensions (samples,features)")
+        exit()
+
+    stats = [ blockStatistics(Y[m]) for m in range(M) ]
+    return processViews(Y, index, columns, stats, data_opts)
+
+def writeBinaryData(filename, data, view_names, out_of_core=False):
+    """ Method to write the views to an HDF5 file that can be memory-mapped by loadBinaryData, or streamed in
+    out-of-core training. The matrices are stored uncompressed in single precision
+
+    PARAMETERS
+    ----------
+    filename: str
+    data: list of pandas.DataFrame with dimensions (samples,features)
+    view_names: list of str
+    out_of_core: bool
+        if False, the matrices are contiguous so that they can be memory-mapped. If True, they are chunked by blocks of
+        features with all samples (the layout of the model files, see datasetOptions), so that out-of-core training reads
+        a block of features without reading the rows of all features
+    """
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset("samples", data=np.array(data[0].index.astype(str), dtype='S'))
+        for m in range(len(data)):
+            f.create_dataset("features/"+view_names[m], data=np.array(data[m].columns.astype(str), dtype='S'))
+            Y = np.asarray(data[m].values, dtype=np.float32)
+            chunks = datasetOptions(Y.shape[::-1], Y.dtype).get('chunks') if out_of_core else None
+            f.create_dataset("data/"+view_names[m], data=Y, chunks=None if chunks is None else chunks[::-1])
+
+def splitFeatures(mask):
+    """ Method to split the features of a view into fully observed features and features with missing values
+
+    PARAMETERS
+    ----------
+    mask: boolean ndarray with dimensions (N,D), True for the missing values
+
+    RETURNS
+    -------
+    complete: boolean ndarray with dimensions (D,), True for the features that are observed in all samples
+    incomplete: ndarray with the indices of the features with missing values
+    observed: boolean ndarray with the observation mask of the features with missing values, with dimensions (N,len(incomplete))
+    """
+    complete = ~mask.any(axis=0)
+    incomplete = np.where(~complete)[0]
+    observed = ~mask[:,incomplete]
+    return complete, incomplete, observed
+
+@contextmanager
+def limitBLASThreads(nthreads):
+    """ Context manager to limit the number of threads used by the BLAS library (requires the threadpoolctl package)
+
+    PARAMETERS
+    ----------
+    nthreads: int or None
+        maximum number of BLAS threads used by each call. If None, the BLAS settings are not modified
+    """
+    if nthreads is None:
+        yield
+        return
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        print("Warning: the threadpoolctl package is not installed, the number of BLAS threads cannot be limited")
+        yield
+        return
+    with threadpool_limits(limits=nthreads, user_api='blas'):
+        yield
 
 def dotd(A, B, out=None):
     """Diagonal of :math:`\mathrm A\mathrm B^\intercal`.
@@ -250,7 +605,104 @@ def ddot(d, mtx, left=True):
 def lambdafn(X):
     return np.tanh(X/2.)/(4.*X)
 
-def saveParameters(model, hdf5, view_names=None):
+# Version of the layout of the model files, saved in the 'format_version' attribute of the file
+#   1 (no attribute): contiguous datasets and fixed-length names
+#   2: chunked (and optionally compressed) datasets, one chunk per factor for the expectations and parameters with a factor axis,
+#      and variable-length names
+MODEL_FORMAT_VERSION = 2
+
+# Nodes whose matrices are saved with the factors in the first dimension
+FACTOR_NODES = ["Z", "SW", "Theta"]
+
+def datasetOptions(shape, dtype, save_opts=None, factors=False):
+    """ Method to define the storage of a dataset of the model file: chunks, compression and floating point precision.
+    The matrices are chunked by rows, which are either factors or features, so that a factor or a block of features
+    is read without reading the whole dataset
+
+    PARAMETERS
+    ----------
+    shape: tuple
+        shape of the saved (transposed) array
+    dtype: numpy dtype
+        type of the array
+    save_opts: dic
+        'compression' ("gzip", "lzf" or None), 'compression_opts' (level of gzip), 'dtype' (floating point precision of the
+        stored arrays, None keeps the precision of the model) and 'chunk_size' (maximum size of a chunk in MB)
+    factors: bool
+        whether the first dimension of the array indexes the factors
+    """
+    save_opts = save_opts or {}
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f' and save_opts.get('dtype') is not None:
+        dtype = np.dtype(save_opts['dtype'])
+    options = { 'dtype':dtype }
+    if len(shape) == 0 or 0 in shape:
+        return options
+
+    if len(shape) == 2:
+        length = max(1, int(save_opts.get('chunk_size', 1.)*2**20 // dtype.itemsize))
+        columns = min(shape[1], length)
+        options['chunks'] = (1 if factors else min(shape[0], max(1, length // columns)), columns)
+    if save_opts.get('compression') is not None:
+        options['compression'] = save_opts['compression']
+        if save_opts['compression'] == "gzip": options['compression_opts'] = save_opts.get('compression_opts', 4)
+        options['shuffle'] = True
+    return options
+
+def createDataset(group, name, data, save_opts=None, factors=False):
+    """ Method to write an array to the model file with the storage options of datasetOptions """
+    data = np.asarray(data)
+    return group.create_dataset(name, data=data, **datasetOptions(data.shape, data.dtype, save_opts, factors))
+
+# Storage of the training data in the model files (see saveTrainingData)
+DATA_STORAGE = ["full", "compact", "reference"]
+
+# Integer types of the compact storage, from the smallest
+INTEGER_TYPES = [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32]
+
+def observedViews(model):
+    """ Method to return, for each view, whether the expectation of Y is the data itself (gaussian views) or pseudodata """
+    return [ Ynode.getExpectation() is Ynode.getValue() for Ynode in model.getNodes()["Y"].getNodes() ]
+
+def encodeIntegers(Y):
+    """ Method to store a matrix of integer values (counts or binary data) in the smallest integer type,
+    with the missing values (nan) coded by the largest value of the unsigned types or the smallest value of the signed types
+
+    PARAMETERS
+    ----------
+    Y: ndarray
+
+    RETURNS
+    -------
+    the encoded matrix and the code of the missing values, or None if the observed values are not all integers
+    """
+    observed = ~np.isnan(Y)
+    values = Y[observed]
+    if values.size == 0 or not np.all(values == np.round(values)):
+        return None
+    low, high = values.min(), values.max()
+    for dtype in INTEGER_TYPES:
+        info = np.iinfo(dtype)
+        code = info.max if info.min == 0 else info.min
+        if low >= info.min + int(info.min != 0) and high <= info.max - int(info.min == 0):
+            return np.where(observed, Y, code).astype(dtype), code
+    return None
+
+def decodeIntegers(X, code):
+    """ Method to read a matrix stored by encodeIntegers, with nan for the missing values """
+    Y = X.astype(np.float64)
+    Y[X == code] = np.nan
+    return Y
+
+def writeNames(group, name, names):
+    """ Method to write sample or feature names as variable-length UTF-8 strings """
+    return group.create_dataset(name, data=[ str(x) for x in names ], dtype=h5py.string_dtype())
+
+def readNames(dataset):
+    """ Method to read sample or feature names, stored either as fixed-length or as variable-length strings """
+    return np.array([ x.decode() if isinstance(x, bytes) else str(x) for x in dataset[()] ], dtype=object)
+
+def saveParameters(model, hdf5, view_names=None, save_opts=None):
     """ Method to save the parameters of the model in an hdf5 file
     
     PARAMETERS
@@ -258,6 +710,7 @@ def saveParameters(model, hdf5, view_names=None):
     model: a BayesNet instance
     hdf5: 
     view_names
+    save_opts: storage options of the datasets (see datasetOptions)
     """
     
     # Get nodes from the model
@@ -291,18 +744,18 @@ def saveParameters(model, hdf5, view_names=None):
                     if type(parameters[m]) == dict:
                         for param_name in parameters[m].keys():
                             if parameters[m][param_name] is not None:
-                                view_subgrp.create_dataset(param_name, data=parameters[m][param_name].T)
+                                createDataset(view_subgrp, param_name, parameters[m][param_name].T, save_opts, node in FACTOR_NODES)
                     # Non-variational nodes (no distributions)
                     elif type(parameters[m]) == np.ndarray:
-                           view_subgrp.create_dataset("value", data=parameters[m].T)
+                           createDataset(view_subgrp, "value", parameters[m].T, save_opts, node in FACTOR_NODES)
 
         # Single-view nodes
         else:
             for param_name in parameters.keys():
-                node_subgrp.create_dataset("%s" % (param_name), data=parameters[param_name].T)
+                createDataset(node_subgrp, "%s" % (param_name), parameters[param_name].T, save_opts, node in FACTOR_NODES)
     pass
 
-def saveExpectations(model, hdf5, view_names=None, only_first_moments=True):
+def saveExpectations(model, hdf5, view_names=None, only_first_moments=True, save_opts=None):
     """ Method to save the expectations of the model in an hdf5 file
     
     PARAMETERS
@@ -311,10 +764,15 @@ def saveExpectations(model, hdf5, view_names=None, only_first_moments=True):
     hdf5: 
     view_names
     only_first_moments
+    save_opts: storage options of the datasets (see datasetOptions)
     """
     # Get nodes from the model
     nodes = model.getNodes()
 
+    # The expectations of Y of the gaussian views are the data, which are not duplicated unless the storage is "full" (see saveTrainingData)
+    storage = (save_opts or {}).get('data', "full")
+    observed = observedViews(model) if storage != "full" else None
+
     exp_grp = hdf5.create_group("expectations")
 
     # Iterate over nodes
@@ -339,6 +797,12 @@ def saveExpectations(model, hdf5, view_names=None, only_first_moments=True):
                 # Create subsubgroup for the view
                 view_subgrp = node_subgrp.create_group(tmp)
 
+                # Data of the gaussian views: a link to data/<view>, or nothing if the data are stored as a reference
+                if node == "Y" and observed is not None and observed[m]:
+                    if storage == "compact":
+                        view_subgrp["E"] = h5py.SoftLink("/data/%s" % tmp)
+                    continue
+
                 # Loop through the expectations
                 if only_first_moments: 
                     if node == "SW":
@@ -348,17 +812,21 @@ def saveExpectations(model, hdf5, view_names=None, only_first_moments=True):
 
                 if expectations[m] is not None:
                     for exp_name in expectations[m].keys():
-                        if type(expectations[m][exp_name]) == ma.core.MaskedArray:
+                        if isinstance(expectations[m][exp_name], DiskView):
+                            # Data of out-of-core training, copied by blocks
+                            view = expectations[m][exp_name]
+                            view.writeTransposed(view_subgrp, exp_name, **datasetOptions(view.shape[::-1], view.dtype, save_opts))
+                        elif type(expectations[m][exp_name]) == ma.core.MaskedArray:
                             tmp = ma.filled(expectations[m][exp_name], fill_value=np.nan)
-                            view_subgrp.create_dataset(exp_name, data=tmp.T)
+                            createDataset(view_subgrp, exp_name, tmp.T, save_opts, node in FACTOR_NODES)
                         else:
-                            view_subgrp.create_dataset(exp_name, data=expectations[m][exp_name].T)
+                            createDataset(view_subgrp, exp_name, expectations[m][exp_name].T, save_opts, node in FACTOR_NODES)
 
         # Single-view nodes
         else:
             if only_first_moments: expectations = {'E':expectations["E"]}
             for exp_name in expectations.keys():
-                node_subgrp.create_dataset("%s" % (exp_name), data=expectations[exp_name].T)
+                createDataset(node_subgrp, "%s" % (exp_name), expectations[exp_name].T, save_opts, node in FACTOR_NODES)
 
 def saveTrainingStats(model, hdf5):
     """ Method to save the training statistics in an hdf5 file
@@ -375,6 +843,91 @@ def saveTrainingStats(model, hdf5):
     stats_grp.create_dataset("elbo_terms", data=stats["elbo_terms"].T)
     stats_grp['elbo_terms'].attrs['colnames'] = [a.encode('utf8') for a in stats["elbo_terms"].columns.values]
 
+def calculateVarianceExplained(model, block_size=64.):
+    """ Method to calculate the variance explained (coefficient of determination, R2) per view, per factor and view, and per feature,
+    as calculateVarianceExplained in MOFAtools (with respect to the total variance). The R2 is calculated on the data for the gaussian views
+    and on the pseudodata for the other views, using the observed values only.
+
+    The residuals R of the null model (the intercept if it is learnt, otherwise the feature means) are compared with the predictions.
+    The R2 of factor k in feature d follows from the (masked) projections of the residuals and of the observation mask O on Z:
+        ( 2*w_dk*(R'Z)_dk - w_dk^2*(O'Z^2)_dk ) / |R_d|^2
+    so that the predictions of each factor are never formed. The data are processed by blocks of features.
+
+    PARAMETERS
+    ----------
+    model: a BayesNet instance
+    block_size: float
+        maximum size of a block of features in MB
+
+    RETURNS
+    -------
+    r2_view: ndarray (M,) R2 of each view using all factors
+    r2_factor: ndarray (M,K) R2 of each factor in each view (nan for the intercept)
+    r2_feature: list of ndarrays (D[m],) R2 of each feature using all factors
+    """
+    nodes = model.getNodes()
+    Z = nodes["Z"].getExpectation()
+    W = nodes["SW"].getExpectation()
+    N, K = Z.shape
+    M = len(W)
+
+    # The intercept is part of the null model
+    intercept = np.all(Z[:,0]==1.)
+    Znc = Z.copy()
+    if intercept: Znc[:,0] = 0.
+    Z2 = np.square(Znc)
+
+    r2_view, r2_factor, r2_feature = np.zeros(M), np.zeros((M,K)), [None]*M
+    for m in range(M):
+        Ynode = nodes["Y"].getNodes()[m]
+        D = W[m].shape[0]
+        SS, RSS, explained = np.zeros(D), np.zeros(D), np.zeros((D,K))
+
+        if Ynode.out_of_core:
+            blocks = Ynode.iterBlocks()
+        else:
+            Y = Ynode.getExpectation()
+            filled, observed = ma.filled(Y, 0.), ~ma.getmaskarray(Y)
+            length = max(1, int(block_size*2**20 // (N*filled.dtype.itemsize)))
+            blocks = ( (d, filled[:,d], observed[:,d]) for d in [ np.arange(j,min(j+length,D)) for j in range(0,D,length) ] )
+
+        for d, Y, observed in blocks:
+            Wd = W[m][d,:]
+            if intercept:
+                null = Wd[:,0]
+            else:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    null = (Y*observed).sum(axis=0, dtype=np.float64) / observed.sum(axis=0)
+            R = (Y - null) * observed
+            SS[d] = np.square(R).sum(axis=0)
+            RSS[d] = np.square((Y - np.dot(Z,Wd.T)) * observed).sum(axis=0)
+            explained[d,:] = 2.*Wd*np.dot(R.T,Znc) - np.square(Wd)*np.dot(observed.T.astype(Z2.dtype),Z2)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            r2_view[m] = 1. - RSS.sum()/SS.sum()
+            r2_factor[m,:] = explained.sum(axis=0)/SS.sum()
+            r2_feature[m] = 1. - RSS/SS
+        if intercept: r2_factor[m,0] = np.nan
+
+    return r2_view, r2_factor, r2_feature
+
+def saveVarianceExplained(model, hdf5, view_names=None):
+    """ Method to save the variance explained (see calculateVarianceExplained) in an hdf5 file
+
+    PARAMETERS
+    ----------
+    model: a BayesNet instance
+    hdf5:
+    view_names
+    """
+    r2_view, r2_factor, r2_feature = calculateVarianceExplained(model)
+    grp = hdf5.create_group("variance_explained")
+    for m in range(len(r2_view)):
+        view = view_names[m] if view_names is not None else str(m)
+        grp.create_dataset("total/%s" % view, data=r2_view[m])
+        grp.create_dataset("per_factor/%s" % view, data=r2_factor[m,:])
+        grp.create_dataset("per_feature/%s" % view, data=r2_feature[m])
+
 def saveTrainingOpts(opts, hdf5):
     """ Method to save the training options in an hdf5 file
     
@@ -390,9 +943,14 @@ def saveTrainingOpts(opts, hdf5):
                 opts[str(k)+"_"+str(k1)] = v1
             opts.pop(k)
 
+    # Options that are not numeric (i.e. the floating point precision) are saved as attributes
+    strings = { k:v for k,v in opts.items() if isinstance(v,str) }
+    opts = { k:v for k,v in opts.items() if k not in strings }
+
     # Create HDF5 data set
     hdf5.create_dataset("training_opts", data=np.array(list(opts.values()), dtype=np.float))
     hdf5['training_opts'].attrs['names'] = np.asarray(list(opts.keys())).astype('S')
+    for k,v in strings.items(): hdf5['training_opts'].attrs[k] = np.asarray(v).astype('S')
 
 def saveModelOpts(opts, hdf5):
     """ Method to save the model options in an hdf5 file
@@ -409,7 +967,7 @@ def saveModelOpts(opts, hdf5):
         grp.create_dataset(k, data=np.asarray(v).astype('S'))
     grp[k].attrs['names'] = np.asarray(list(opts.keys())).astype('S')
 
-def saveTrainingData(model, hdf5, view_names=None, sample_names=None, feature_names=None):
+def saveTrainingData(model, hdf5, view_names=None, sample_names=None, feature_names=None, save_opts=None):
     """ Method to save the training data in an hdf5 file
     
     PARAMETERS
@@ -419,24 +977,50 @@ def saveTrainingData(model, hdf5, view_names=None, sample_names=None, feature_na
     view_names
     sample_names
     feature_names
+    save_opts: storage options of the datasets (see datasetOptions). save_opts['data'] defines the storage of the data:
+        "full" (default): the processed data of each view
+        "compact": the views with integer values (count or binary views) are stored in the smallest integer type (see encodeIntegers)
+            and the expectations of Y of the gaussian views are links to the data
+        "reference": the data are not stored, only the reference to the inputs and the data processing in save_opts['reference']
+            (see training_data.dataReference), from which they are loaded again on demand (see training_data.trainingData)
     """
+    storage = (save_opts or {}).get('data', "full")
+    assert storage in DATA_STORAGE, "The storage of the data has to be one of %s" % ", ".join(DATA_STORAGE)
     data = model.getTrainingData()
+    observed = observedViews(model)
     data_grp = hdf5.create_group("data")
+    data_grp.attrs['storage'] = storage
+    if storage == "reference":
+        for k,v in save_opts['reference'].items(): data_grp.attrs[k] = v
     featuredata_grp = hdf5.create_group("features")
     # hdf5.create_dataset("samples", data=sample_names)
-    hdf5.create_dataset("samples", data=np.array(sample_names, dtype='S50'))
+    writeNames(hdf5, "samples", sample_names)
     for m in range(len(data)):
         view = view_names[m] if view_names is not None else str(m)
-        data_grp.create_dataset(view, data=data[m].data.T)
+        if storage == "reference":
+            # Only the names are saved
+            pass
+        elif isinstance(data[m], DiskView):
+            data[m].writeTransposed(data_grp, view, **datasetOptions(data[m].shape[::-1], data[m].dtype, save_opts))
+        else:
+            Y = ma.filled(data[m], np.nan).T
+            encoded = encodeIntegers(Y) if storage == "compact" and not observed[m] else None
+            if encoded is None:
+                createDataset(data_grp, view, Y, save_opts)
+            else:
+                createDataset(data_grp, view, encoded[0], save_opts)
+                data_grp[view].attrs['missing'] = encoded[1]
         if feature_names is not None:
             # data_grp.attrs['features'] = np.array(feature_names[m], dtype='S')
-            featuredata_grp.create_dataset(view, data=np.array(feature_names[m], dtype='S50'))
+            writeNames(featuredata_grp, view, feature_names[m])
 
-def saveModel(model, outfile, train_opts, model_opts, view_names=None, sample_names=None, feature_names=None):
+def saveModel(model, outfile, train_opts, model_opts, view_names=None, sample_names=None, feature_names=None, save_opts=None):
     """ Method to save the model in an hdf5 file
     
     PARAMETERS
     ----------
+    save_opts: dic
+        storage options of the datasets (see datasetOptions)
     """
     assert model.trained == True, "Model is not trained yet"
     assert len(np.unique(view_names)) == len(view_names), 'View names must be unique'
@@ -448,10 +1032,12 @@ def saveModel(model, outfile, train_opts, model_opts, view_names=None, sample_na
     model_opts["likelihood"] = tmp
 
     hdf5 = h5py.File(outfile,'w')
-    saveExpectations(model,hdf5,view_names)
-    saveParameters(model,hdf5,view_names)
+    hdf5.attrs['format_version'] = MODEL_FORMAT_VERSION
+    saveExpectations(model,hdf5,view_names,save_opts=save_opts)
+    saveParameters(model,hdf5,view_names,save_opts)
     saveTrainingStats(model,hdf5)
+    saveVarianceExplained(model,hdf5,view_names)
     saveTrainingOpts(train_opts,hdf5)
     saveModelOpts(model_opts,hdf5)
-    saveTrainingData(model, hdf5, view_names, sample_names, feature_names)
+    saveTrainingData(model, hdf5, view_names, sample_names, feature_names, save_opts)
     hdf5.close()
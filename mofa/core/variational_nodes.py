@@ -59,6 +59,14 @@ class Unobserved_Variational_Node(Variational_Node):
         # Method to update expectations of the node
         if dist == "Q": self.Q.updateExpectations()
 
+    def updateStochastic(self, ro):
+        # Method to take a natural gradient step of size 'ro' from the current Q distribution towards its optimal update.
+        # The parameters are copied because some updates modify them in place
+        old = { k:s.array(v, copy=True) for k,v in self.Q.getParameters().items() }
+        self.updateParameters()
+        self.Q.naturalGradientStep(old, ro)
+        self.updateExpectations()
+
     def getExpectation(self, dist="Q"):
         # Method to get the first moment (expectation) of the node
         if dist == "Q": expectations = self.Q.getExpectations()
@@ -77,6 +85,21 @@ class Unobserved_Variational_Node(Variational_Node):
         elif dist == "P": params = self.P.getParameters()
         return params
 
+    def setDtype(self, dtype):
+        # Method to set the floating point precision of the P and Q distributions
+        self.P.setDtype(dtype)
+        self.Q.setDtype(dtype)
+
+    def getState(self):
+        # Method to get the parameters and the expectations of the Q distribution, to save a checkpoint
+        return { 'params':self.Q.getParameters(), 'expectations':self.Q.getExpectations() }
+
+    def setState(self, state):
+        # Method to restore the parameters and the expectations of the Q distribution from a checkpoint.
+        # The expectations are not recomputed from the parameters, as they can differ before the first update of the node
+        self.Q.setParameters(**state['params'])
+        self.Q.expectations = state['expectations']
+
     def removeFactors(self, idx, axis=None):
         # Method to remove entire factors from the nodes
 
@@ -0,0 +1,105 @@
+"""
+Module to initialise a model from a previously trained one (warm start)
+
+The expectations and parameters saved by saveExpectations and saveParameters are used as the initial values of the
+variational distributions. The samples, features and views are matched by name: the samples and features that are
+not in the saved model keep the default initialisation (random values for the latent variables). The factors have
+no names and are matched by position, so the covariates and the intercept have to be the same as in the saved model.
+"""
+
+from __future__ import division
+import scipy as s
+import numpy as np
+import h5py
+
+from .utils import readNames
+
+def matchNames(saved, names):
+    """ Method to return, for each name, its position in the saved names (-1 if it is not saved)
+
+    PARAMETERS
+    ----------
+    saved: h5py.Dataset
+        names saved in the model
+    names: list
+        names in the new data
+    """
+    # The first versions of the model files truncate the names to a fixed length
+    names = [ str(name) for name in names ]
+    if saved.dtype.kind == 'S':
+        names = [ name.encode()[:saved.dtype.itemsize].decode(errors='ignore') for name in names ]
+    positions = {}
+    for i, name in enumerate(readNames(saved)):
+        positions.setdefault(name, i)
+    return s.array([ positions.get(name, -1) for name in names ], dtype=int)
+
+def loadInitialisation(filename, data, data_opts, model_opts):
+    """ Method to define the initialisation of the variational distributions from a saved model (model_opts is modified in place)
+
+    PARAMETERS
+    ----------
+    filename: str
+        hdf5 file of the saved model
+    data: list of pandas.DataFrame
+        input data for each view
+    data_opts: dic
+    model_opts: dic
+    """
+    print("Initialising the model from %s..." % filename)
+
+    N = data[0].shape[0]
+    K = model_opts['k']
+    M = len(data)
+
+    with h5py.File(filename, 'r') as f:
+        assert str(f['model_opts']['learnIntercept'][()].decode()) == str(model_opts['learnIntercept']), \
+            "The intercept has to be learnt in both models to initialise the factors from %s" % filename
+        expectations, parameters = f['expectations'], f['parameters']
+
+        # Factors, matched by position
+        Ksaved = f['parameters']['Z']['mean'].shape[0]
+        k = min(K, Ksaved)
+        if Ksaved != K:
+            print("The saved model has %d factors, the first %d are used to initialise the model..." % (Ksaved, k))
+
+        # Latent variables: the new samples are initialised randomly (with nan, see initModel.initZ)
+        samples = matchNames(f['samples'], data[0].index)
+        found = samples >= 0
+        print("%d out of %d samples are initialised from the saved model..." % (found.sum(), N))
+
+        mean = s.full((N,K), s.nan) if isinstance(model_opts["initZ"]['mean'],str) else s.array(model_opts["initZ"]['mean'], dtype=float)
+        var = s.ones((N,1)) * model_opts["initZ"]['var']
+        ncov = data_opts['covariates'].shape[1] if data_opts.get('covariates') is not None else 0
+        mean[found,:k] = parameters['Z']['mean'][:k,:].T[samples[found]]
+        var[found,ncov:k] = parameters['Z']['var'][ncov:k,:].T[samples[found]]
+        model_opts["initZ"]['mean'], model_opts["initZ"]['var'] = mean, var
+
+        # Weights, sparsity and precisions of each view: the new features keep the default initialisation
+        for m in range(M):
+            view = data_opts['view_names'][m]
+            if view not in parameters['SW']:
+                print("View %s is not in the saved model, it keeps the default initialisation..." % view)
+                continue
+            features = matchNames(f['features'][view], data[m].columns)
+            found = features >= 0
+            print("%d out of %d features of view %s are initialised from the saved model..." % (found.sum(), len(features), view))
+
+            # The Q distribution of the weights and the sparsity parameter share the same initial array, they are now set separately
+            model_opts["initSW"]['Theta'][m] = model_opts["initSW"]['Theta'][m].copy()
+            for param, key in [('mean_S0','mean_S0'), ('var_S0','var_S0'), ('mean_S1','mean_S1'), ('var_S1','var_S1'), ('theta','Theta')]:
+                model_opts["initSW"][key][m][found,:k] = parameters['SW'][view][param][:k,:].T[features[found]]
+            # A learnt sparsity is saved with dimensions (K,), as it is the same for all features, and a constant one with dimensions (K,D)
+            theta = expectations['Theta'][view]['E']
+            if theta.ndim == 1:
+                model_opts["initTheta"]['E'][m][:,:k] = theta[:k]
+            else:
+                theta = theta[:k,:]
+                model_opts["initTheta"]['E'][m][found,:k] = theta.T[features[found]]
+                # The sparsity of the learnt factors is the same for all features
+                learnt = s.where(model_opts['learnTheta'][m][:k]==1)[0]
+                model_opts["initTheta"]['E'][m][:,learnt] = theta[learnt,:].mean(axis=1)
+            model_opts["initAlphaW"]['E'][m][:k] = expectations['AlphaW'][view]['E'][:k]
+
+            # Only the precision of the gaussian views is a learnt distribution
+            if model_opts['likelihood'][m] == "gaussian" and 'a' in parameters['Tau'][view]:
+                model_opts["initTau"]['E'][m][found] = expectations['Tau'][view]['E'][()][features[found]]
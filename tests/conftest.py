@@ -0,0 +1,50 @@
+"""
+Fixtures of the tests: small simulated views written as text inputs, and the options of a run built by the command line
+interface (the trials are built and trained by the tests themselves)
+"""
+
+import sys
+
+import numpy as np
+import pytest
+
+from mofa.core import init_asd, build_model
+
+
+def simulateViews(N=40, D=(30,25,20), K=3, likelihoods=("gaussian","gaussian","bernoulli"), missing=0., seed=1):
+    """ Method to simulate views from a factor model, with a fraction of missing values in every view """
+    rng = np.random.RandomState(seed)
+    Z = rng.normal(size=(N,K))
+    views = []
+    for d, likelihood in zip(D, likelihoods):
+        Y = np.dot(Z, rng.normal(size=(d,K)).T) + rng.normal(scale=0.5, size=(N,d))
+        if likelihood == "bernoulli":
+            Y = (Y > 0).astype(float)
+        Y[rng.rand(N,d) < missing] = np.nan
+        views.append(Y)
+    return views
+
+@pytest.fixture(autouse=True)
+def noSleep(monkeypatch):
+    # The command line interface pauses after printing each step
+    for module in (init_asd, build_model):
+        monkeypatch.setattr(module, "sleep", lambda seconds: None)
+
+@pytest.fixture
+def cliOptions(tmp_path, monkeypatch):
+    """ Fixture returning a function that writes the simulated views and returns the data and the options of the run
+    defined by the command line arguments (see init_asd.entry_point), without training """
+    def options(argv, likelihoods=("gaussian","gaussian","bernoulli"), missing=0.):
+        views = simulateViews(likelihoods=likelihoods, missing=missing)
+        files = []
+        for m, Y in enumerate(views):
+            files.append(str(tmp_path / ("view%d.txt" % m)))
+            np.savetxt(files[-1], Y, delimiter=" ")
+        captured = {}
+        monkeypatch.setattr(init_asd, "runMultipleTrials", lambda *args: captured.update(args=args))
+        monkeypatch.setattr(sys, "argv", ["mofa", "--inFiles"] + files + ["--likelihoods"] + list(likelihoods) +
+            ["--views"] + [ "view%d" % m for m in range(len(views)) ] + ["--outFile", str(tmp_path / "model.hdf5")] + argv)
+        init_asd.entry_point()
+        data, data_opts, model_opts, train_opts, keep_best_run, seed = captured['args']
+        return data, data_opts, model_opts, train_opts, seed
+    return options
@@ -0,0 +1,42 @@
+"""
+Tests of the training of the Bayesian network: the closed form of the r2 used to drop factors
+"""
+
+import numpy as np
+import pytest
+
+from mofa.core.build_model import buildTrial, trainModel
+
+
+def explicitR2(net):
+    """ Reference r2 of each factor, from the residuals of the masked predictions with and without the factor """
+    Z = net.nodes['Z'].getExpectation()
+    W = net.nodes["SW"].getExpectation()
+    intercept = np.all(Z[:,0]==1.)
+    r2 = np.zeros([net.dim['M'], net.dim['K']])
+    if intercept: r2[:,0] = 1.
+    for m in range(net.dim['M']):
+        mask = net.nodes["Y"].getNodes()[m].getMask()
+        Ypred = np.dot(Z, W[m].T)
+        if intercept: Ypred -= np.outer(Z[:,0], W[m][:,0])
+        Ypred[mask] = 0.
+        SS = np.square(Ypred).sum()
+        for k in range(int(intercept), net.dim['K']):
+            Ypred_k = np.outer(Z[:,k], W[m][:,k])
+            Ypred_k[mask] = 0.
+            r2[m,k] = 1. - np.square(Ypred - Ypred_k).sum()/SS
+    return r2
+
+@pytest.mark.parametrize("likelihoods,missing,intercept", [
+    (("gaussian","gaussian"), 0., False),
+    (("gaussian","gaussian"), 0.1, False),
+    (("gaussian","gaussian"), 0.1, True),
+    (("gaussian","bernoulli"), 0.1, False),
+])
+def test_r2_closed_form_matches_residuals(cliOptions, likelihoods, missing, intercept):
+    argv = ["--factors","5","--iter","10","--startSparsity","2","--seed","3"] + (["--learnIntercept"] if intercept else [])
+    data, data_opts, model_opts, train_opts, seed = cliOptions(argv, likelihoods=likelihoods, missing=missing)
+    net = buildTrial(list(data), data_opts, model_opts, train_opts, seed)
+    trainModel(net, train_opts)
+
+    np.testing.assert_allclose(net.calculateR2(), explicitR2(net), rtol=1e-8, atol=1e-10)
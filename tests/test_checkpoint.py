@@ -0,0 +1,53 @@
+"""
+Tests of the checkpoints: a training resumed from a checkpoint gives the same model as an uninterrupted training
+"""
+
+import numpy as np
+import pytest
+
+from mofa.core.build_model import buildTrial, trainModel
+from mofa.core.checkpoint import saveCheckpoint, loadCheckpoint
+
+
+def assertSameState(state1, state2, name):
+    """ Method to compare the states of two nodes (see Node.getState), which are nested in lists and dictionaries """
+    if isinstance(state1, dict):
+        assert set(state1) == set(state2), name
+        for key in state1: assertSameState(state1[key], state2[key], "%s %s" % (name,key))
+    elif isinstance(state1, (list,tuple)):
+        assert len(state1) == len(state2), name
+        for i in range(len(state1)): assertSameState(state1[i], state2[i], "%s %d" % (name,i))
+    else:
+        np.testing.assert_array_equal(state1, state2, err_msg=name)
+
+def assertSameNodes(net1, net2):
+    assert net1.dim['K'] == net2.dim['K']
+    for name, node in net1.getNodes().items():
+        assertSameState(node.getState(), net2.getNodes()[name].getState(), name)
+
+@pytest.mark.parametrize("argv", [
+    [],
+    ["--dropR2","0.2"],
+    ["--batchSize","0.3","--dropR2","0.2"],
+])
+def test_resume_matches_uninterrupted_training(cliOptions, tmp_path, argv):
+    argv = ["--factors","5","--iter","20","--startSparsity","2","--seed","3","--tolerance","0"] + argv
+    data, data_opts, model_opts, train_opts, seed = cliOptions(argv, likelihoods=("gaussian","gaussian"), missing=0.1)
+
+    uninterrupted = buildTrial(list(data), data_opts, model_opts, train_opts, seed)
+    trainModel(uninterrupted, train_opts)
+
+    interrupted = buildTrial(list(data), data_opts, model_opts, train_opts, seed)
+    trainModel(interrupted, train_opts, niter=9)
+    filename = str(tmp_path / "checkpoint.hdf5")
+    saveCheckpoint(interrupted, filename)
+
+    resumed = buildTrial(list(data), data_opts, model_opts, train_opts, seed)
+    loadCheckpoint(resumed, filename)
+    assert resumed.iteration == 9
+    assertSameNodes(interrupted, resumed)
+    trainModel(resumed, train_opts)
+
+    assert resumed.iteration == uninterrupted.iteration == 20
+    assertSameNodes(uninterrupted, resumed)
+    np.testing.assert_array_equal(resumed.train_stats['elbo'], uninterrupted.train_stats['elbo'])
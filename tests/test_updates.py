@@ -0,0 +1,35 @@
+"""
+Tests of the vectorised updates of the nodes against the reference loops (--referenceUpdates)
+"""
+
+import numpy as np
+import pytest
+
+from mofa.core.build_model import buildTrial, trainModel
+
+
+@pytest.mark.parametrize("likelihoods,missing", [
+    (("gaussian","gaussian"), 0.),
+    (("gaussian","gaussian"), 0.1),
+    (("gaussian","bernoulli"), 0.1),
+])
+def test_vectorised_updates_match_loops(cliOptions, likelihoods, missing):
+    data, data_opts, model_opts, train_opts, seed = cliOptions(["--factors","5","--iter","10","--startSparsity","2","--seed","3"],
+        likelihoods=likelihoods, missing=missing)
+
+    nets = {}
+    for vectorised in (True, False):
+        opts = dict(train_opts, vectorised=vectorised)
+        nets[vectorised] = buildTrial(list(data), data_opts, model_opts, opts, seed)
+        trainModel(nets[vectorised], opts)
+        assert nets[vectorised].iteration == 10
+
+    for node in ("SW", "Z"):
+        vectorised, loop = nets[True].nodes[node].getParameters(), nets[False].nodes[node].getParameters()
+        if node == "SW":
+            for m in range(len(data)):
+                for param in vectorised[m]:
+                    np.testing.assert_allclose(vectorised[m][param], loop[m][param], rtol=1e-10, atol=1e-12, err_msg="%s %s" % (node,param))
+        else:
+            for param in vectorised:
+                np.testing.assert_allclose(vectorised[param], loop[param], rtol=1e-10, atol=1e-12, err_msg="%s %s" % (node,param))